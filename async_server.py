@@ -0,0 +1,238 @@
+import asyncio
+import socket
+import threading
+
+from framing import FrameDecoder, encode_text
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class AsyncConnection:
+    """Socket-like wrapper so the shared command code can write to a transport."""
+    __slots__ = ('transport',)
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendall(self, data):
+        self.transport.write(data)
+
+    def send(self, data):
+        self.transport.write(data)
+        return len(data)
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self.transport.abort()
+
+    def close(self):
+        self.transport.close()
+
+
+class FlushScheduler:
+    """
+    Coalesces writer flushes for every connection on the loop: connections
+    with queued frames are marked dirty and a single callback (after the
+    flush window, if any) writes them all out. A broadcast to N clients costs
+    one loop callback rather than N, and frames arriving inside the window
+    leave in one write per socket.
+    """
+
+    def __init__(self, loop, window=0.0):
+        self.loop = loop
+        self.window = window
+        self.dirty = []
+        self.scheduled = False
+
+    def mark(self, proto):
+        """Must run on the loop thread."""
+        self.dirty.append(proto)
+        if not self.scheduled:
+            self.scheduled = True
+            if self.window:
+                self.loop.call_later(self.window, self.run)
+            else:
+                self.loop.call_soon(self.run)
+
+    def run(self):
+        self.scheduled = False
+        dirty, self.dirty = self.dirty, []
+        for proto in dirty:
+            proto.flush()
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """One client connection served by the event loop instead of a thread."""
+    __slots__ = ('on_register', 'on_message', 'on_disconnect', 'scheduler', 'conn',
+                 'session', 'decoder', 'loop', 'loop_thread', 'paused', 'flush_pending',
+                 'handshake_timeout', 'deadline', 'busy')
+
+    def __init__(self, on_register, on_message, on_disconnect, scheduler, handshake_timeout=0):
+        self.on_register = on_register
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.scheduler = scheduler
+        self.handshake_timeout = handshake_timeout
+        self.deadline = None
+        self.conn = None
+        self.session = None
+        self.decoder = FrameDecoder()
+        self.loop = None
+        self.loop_thread = None
+        self.paused = False
+        self.flush_pending = False
+        self.busy = False  # a blocking command of this client is running on a worker thread
+
+    def connection_made(self, transport):
+        print(f"Connected with {str(transport.get_extra_info('peername'))}")
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.conn = AsyncConnection(transport)
+        transport.write(encode_text('NICK'))
+        if self.handshake_timeout:
+            self.deadline = self.loop.call_later(self.handshake_timeout, self.handshake_expired)
+
+    def handshake_expired(self):
+        if self.session is None:
+            print(f"Handshake with {str(self.conn.transport.get_extra_info('peername'))} timed out")
+            self.conn.close()
+
+    def get_buffer(self, sizehint):
+        # The transport reads straight into the frame decoder's buffer
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.process()
+
+    def process(self):
+        """Handle the buffered frames, up to one that went to a worker thread."""
+        if self.busy:
+            return
+        try:
+            for kind, payload in self.decoder.frames():
+                if self.session is None:
+                    # First frame after the NICK prompt is the username (and options)
+                    hello = str(payload, 'utf-8')
+                    address = self.conn.transport.get_extra_info('peername')
+                    if self.deadline is not None:
+                        self.deadline.cancel()
+                    self.session = self.on_register(self.conn, hello, address)
+                    # This protocol is the session's writer from now on
+                    self.session.outq.waker = self.wake
+                    self.wake()
+                else:
+                    self.on_message(self.session, payload, kind, self.offload)
+                    if self.busy:
+                        break  # the rest stays in the decoder until it is done
+        except Exception as e:
+            print(f"Error handling {self.session}: {e}")
+            self.conn.close()
+
+    def offload(self, fn, *args):
+        """
+        Run fn(*args) in the loop's thread pool: disk reads and scans would
+        stall every client on the loop. Reading from this client pauses
+        until it returns, so its commands still run in order.
+        """
+        self.busy = True
+        self.conn.transport.pause_reading()
+        self.loop.run_in_executor(None, fn, *args).add_done_callback(self.offload_done)
+
+    def offload_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Error handling {self.session}: {future.exception()}")
+        self.busy = False
+        if not self.conn.transport.is_closing():
+            self.conn.transport.resume_reading()
+            self.process()
+
+    def wake(self):
+        """Schedule a flush of the outbound queue (callable from any thread)."""
+        if self.flush_pending:
+            return
+        self.flush_pending = True
+        if threading.get_ident() == self.loop_thread:
+            self.scheduler.mark(self)
+        else:
+            self.loop.call_soon_threadsafe(self.scheduler.mark, self)
+
+    def flush(self):
+        """Move queued frames to the transport unless the peer is backed up."""
+        self.flush_pending = False
+        if self.paused or self.conn.transport.is_closing():
+            return
+        outq = self.session.outq
+        batch = outq.take_batch()
+        if batch:
+            if self.session.compressor is not None:
+                batch = [self.session.compressor.pack(batch)]
+            self.conn.transport.writelines(batch)
+            outq.note_sent(sum(map(len, batch)))
+        if len(outq):
+            self.wake()
+
+    def pause_writing(self):
+        # Transport buffer is above its high-water mark: let our queue absorb it
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.session is not None:
+            self.flush()
+
+    def connection_lost(self, exc):
+        if self.deadline is not None:
+            self.deadline.cancel()
+        if self.session is not None:
+            self.on_disconnect(self.session)
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit so many clients fit."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+async def serve(host, port, on_register, on_message, on_disconnect, flush_window=0.0,
+                reuse_port=False, on_tick=None, tick=1.0, handshake_timeout=0):
+    loop = asyncio.get_running_loop()
+    scheduler = FlushScheduler(loop, flush_window)
+    if on_tick is not None:
+        # Periodic housekeeping (heartbeats) runs on the loop, next to the connections it touches
+        def run_tick():
+            try:
+                on_tick()
+            except Exception as e:
+                print(f"Tick error: {e}")
+            loop.call_later(tick, run_tick)
+        loop.call_later(tick, run_tick)
+    server = await loop.create_server(
+        lambda: ChatProtocol(on_register, on_message, on_disconnect, scheduler, handshake_timeout),
+        host, port, family=socket.AF_INET, reuse_address=True, reuse_port=reuse_port or None,
+        backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+def run(host, port, on_register, on_message, on_disconnect, flush_window=0.0,
+        reuse_port=False, on_tick=None, tick=1.0, handshake_timeout=0):
+    """
+    Serve every client from a single asyncio event loop; on_tick(), if
+    given, is called on the loop every tick seconds. Connections that have
+    not sent their nickname within handshake_timeout seconds are closed.
+    """
+    raise_fd_limit()
+    try:
+        asyncio.run(serve(host, port, on_register, on_message, on_disconnect,
+                          flush_window, reuse_port, on_tick, tick, handshake_timeout))
+    except KeyboardInterrupt:
+        pass
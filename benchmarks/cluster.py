@@ -0,0 +1,172 @@
+"""
+Cluster benchmark: chat throughput at 1, 2 and 4 server nodes.
+
+    python -m benchmarks.cluster --nodes 1 2 4 --receivers 400 --mode broadcast
+
+Starts a bus broker (bus.py) and N server.py nodes joined to it, spreads
+the receivers evenly over the nodes and puts one sender on every node. In
+broadcast mode each sender broadcasts --messages lines that every receiver
+must get; in private mode each sender sends --messages /msg lines to
+receivers picked round-robin across the whole cluster, so most of them
+cross the bus. Prints one JSON object per node count with messages and
+deliveries per second.
+
+Every node does the same amount of fan-out work whatever the node count,
+so with a core per node the delivery rate grows with the number of nodes.
+On fewer cores than nodes the processes just take turns and it cannot.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from framing import encode_text
+from benchmarks.fanout import ROOT, free_port, connect
+
+MARK = b': ~'
+SYNC = b': ~sync'
+
+
+def wait_for_port(proc, port):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def start_cluster(nodes, engine, shared_dir):
+    """Start a broker and `nodes` servers; returns (processes, chat ports)."""
+    bus_port = free_port()
+    broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bus.py'), str(bus_port)],
+                              cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(broker, bus_port)
+    procs, ports = [broker], []
+    env = dict(os.environ, SERVER_SHARED_FILES=shared_dir)
+    for i in range(nodes):
+        port = free_port()
+        cmd = [sys.executable, os.path.join(ROOT, 'server.py'), str(port),
+               '--engine', engine, '--bus', f"tcp://127.0.0.1:{bus_port}",
+               '--node-id', f"node{i}", '--log-dir', '', '--offline-dir', '', '--file-cache', '0',
+               '--queue-frames', '1000000', '--queue-bytes', str(1 << 30), '--rate-limits', '']
+        proc = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proc)
+        wait_for_port(proc, port)
+        ports.append(port)
+    return procs, ports
+
+
+async def receive_frames(reader, decoder, expected, synced, counts, index):
+    """Count benchmark frames after the sync marker, which every receiver reports."""
+    seen, waiting = 0, True
+    while waiting or seen < expected:
+        data = await reader.read(65536)
+        if not data:
+            break
+        decoder.feed(data)
+        for kind, payload in decoder.frames():
+            payload = bytes(payload)
+            if SYNC in payload:
+                waiting = False
+                synced[0] -= 1
+                if not synced[0]:
+                    synced[1].set()
+            elif MARK in payload:
+                seen += 1
+    counts[index] = (seen, time.perf_counter())
+
+
+async def run_once(ports, receivers, messages, size, mode, batch=100):
+    nodes = len(ports)
+    names = [f"r{i}" for i in range(receivers)]
+    conns = []
+    for start in range(0, receivers, batch):
+        conns += await asyncio.gather(
+            *(connect(ports[i % nodes], names[i]) for i in range(start, min(receivers, start + batch))))
+    senders = [await connect(port, f"bench{i}") for i, port in enumerate(ports)]
+    # Give the join announcements time to reach every node
+    await asyncio.sleep(0.5 + 0.001 * receivers)
+
+    expected = [0] * receivers
+    plans = []
+    body = 'x' * size
+    for n in range(nodes):
+        if mode == 'broadcast':
+            lines = [f"~{n}.{i} {body}" for i in range(messages)]
+            expected = [e + messages for e in expected]
+        else:
+            lines = []
+            for i in range(messages):
+                target = (n * messages + i) % receivers
+                lines.append(f"/msg {names[target]} ~{n}.{i} {body}")
+                expected[target] += 1
+        plans.append(lines)
+
+    synced = [receivers, asyncio.Event()]
+    counts = [None] * receivers
+    tasks = [asyncio.ensure_future(receive_frames(r, d, expected[i], synced, counts, i))
+             for i, (r, w, d) in enumerate(conns)]
+    senders[0][1].write(encode_text('~sync'))
+    await synced[1].wait()
+
+    started = time.perf_counter()
+    for (reader, writer, _), lines in zip(senders, plans):
+        writer.write(b''.join(encode_text(line) for line in lines))
+    await asyncio.gather(*(w.drain() for r, w, d in senders))
+    await asyncio.gather(*tasks)
+    elapsed = max(t for _, t in counts) - started
+    delivered = sum(seen for seen, _ in counts)
+
+    for r, w, d in conns + senders:
+        w.close()
+    return {
+        'nodes': nodes,
+        'mode': mode,
+        'receivers': receivers,
+        'messages': messages * nodes,
+        'payload_bytes': size,
+        'delivered': delivered,
+        'expected': sum(expected),
+        'elapsed_s': round(elapsed, 4),
+        'messages_per_s': round(messages * nodes / elapsed, 1),
+        'deliveries_per_s': round(delivered / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster scale-out benchmark")
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--receivers', type=int, default=400, help="receivers across the whole cluster")
+    parser.add_argument('--messages', type=int, default=100, help="messages sent by each node's sender")
+    parser.add_argument('--size', type=int, default=64, help="payload bytes per message")
+    parser.add_argument('--mode', choices=['broadcast', 'private'], default='broadcast')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='async')
+    args = parser.parse_args()
+
+    shared_dir = tempfile.mkdtemp(prefix='bench-shared-')
+    print(json.dumps({'cpus': os.cpu_count()}), flush=True)
+    for nodes in args.nodes:
+        procs, ports = start_cluster(nodes, args.engine, shared_dir)
+        try:
+            result = asyncio.run(run_once(ports, args.receivers, args.messages, args.size, args.mode))
+            result['engine'] = args.engine
+            print(json.dumps(result), flush=True)
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Compression benchmark: bandwidth saved against CPU spent.
+
+    python -m benchmarks.compression --receivers 100 --messages 500
+
+Chat: starts a server, connects the receivers with and without
+compress=zlib in the handshake, has one sender broadcast chat-like lines
+and compares the bytes that reached the receivers on the wire with the
+bytes of the frames they decoded, along with the server's CPU time.
+
+Downloads: fetches a text-like file and a random (incompressible) file
+over TCP with and without zlib, twice each so the second fetch comes from
+the hot-file cache and its cached compressed chunks, and reports bytes on
+the wire, time and server CPU.
+
+Prints one JSON object per measurement.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import compression
+from framing import FrameDecoder, encode_text
+from benchmarks.fanout import free_port, start_server
+
+WORDS = ("the a to and of in is it you that for on are with this be have not but "
+         "what can all just so about lecture tomorrow coursework deadline meeting "
+         "library exam group project slides anyone know when where thanks ok lol "
+         "yes no maybe later today tonight room assignment question answer").split()
+
+
+def chat_lines(count, seed=1):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))) for _ in range(count)]
+
+
+def server_cpu(pid):
+    """User + system CPU seconds the process has used (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Receiver:
+    """A chat connection that counts wire bytes and decoded frame bytes."""
+
+    def __init__(self, reader, writer, decoder, inflater):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = decoder
+        self.inflater = inflater
+        self.wire = self.plain = self.seen = 0
+
+    async def pump(self, messages):
+        while self.seen < messages:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            self.wire += len(data)
+            self.decoder.feed(self.inflater.unpack(data) if self.inflater else data)
+            for kind, payload in self.decoder.frames():
+                self.plain += len(payload) + 5
+                if bytes(payload[:7]) == b'bench: ':
+                    self.seen += 1
+
+
+async def connect(port, nickname, compress):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    decoder = FrameDecoder()
+    hello = nickname + ("\ncompress=zlib" if compress else '')
+    inflater = None
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            raise ConnectionError("closed during handshake")
+        decoder.feed(data)
+        for kind, payload in decoder.frames():
+            text = str(payload, 'utf-8')
+            if text == 'NICK':
+                writer.write(encode_text(hello))
+                if not compress:
+                    return Receiver(reader, writer, decoder, None)
+            elif text.startswith('COMPRESS:'):
+                inflater = compression.StreamDecompressor()
+                decoder.feed(inflater.unpack(decoder.drain()))
+                return Receiver(reader, writer, decoder, inflater)
+
+
+async def chat_run(port, pid, receivers, messages, compress):
+    conns = [await connect(port, f"r{i}", compress) for i in range(receivers)]
+    sender = await connect(port, 'bench', False)
+    lines = chat_lines(messages)
+    tasks = [asyncio.ensure_future(c.pump(messages)) for c in conns]
+    await asyncio.sleep(0.5)  # handshakes and join notices out of the way
+    wire = sum(c.wire for c in conns)
+    plain = sum(c.plain for c in conns)
+    cpu = server_cpu(pid)
+    started = time.perf_counter()
+    for line in lines:
+        sender.writer.write(encode_text(line))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    cpu = server_cpu(pid) - cpu if cpu is not None else None
+    wire = sum(c.wire for c in conns) - wire
+    plain = sum(c.plain for c in conns) - plain
+    for c in conns + [sender]:
+        c.writer.close()
+    return {
+        'test': 'chat', 'compress': compress, 'receivers': receivers, 'messages': messages,
+        'wire_bytes': wire, 'frame_bytes': plain,
+        'saved': round(1 - wire / plain, 3) if plain else None,
+        'elapsed_s': round(elapsed, 3),
+        'server_cpu_s': round(cpu, 3) if cpu is not None else None,
+    }
+
+
+async def download(port, filename, compress):
+    """Fetch a whole file over a TCP data connection; returns (wire bytes, file bytes)."""
+    control = await connect(port, f"dl{random.randrange(1 << 30)}", False)
+    control.writer.write(encode_text(f"/download {filename} tcp"))
+    decoder = control.decoder
+    offer = None
+    while offer is None:
+        for kind, payload in decoder.frames():
+            text = str(payload, 'utf-8')
+            if text.startswith(('FILE_READY:', 'FILE_ERROR:')):
+                offer = text
+        if offer is None:
+            decoder.feed(await control.reader.read(65536))
+    control.writer.close()
+    if offer.startswith('FILE_ERROR:'):
+        raise RuntimeError(offer)
+    data_port, token = offer.split(':')[1:3]
+    reader, writer = await asyncio.open_connection('127.0.0.1', int(data_port))
+    option = ' zlib' if compress else ''
+    writer.write(encode_text(f"GET {token}{option}"))
+    wire = 0
+    decoder = FrameDecoder()
+    reply = None
+    while reply is None:
+        data = await reader.read(65536)
+        wire += len(data)
+        decoder.feed(data)
+        for kind, payload in decoder.frames():
+            reply = str(payload, 'utf-8')
+            break
+    total = int(reply.split(':')[1])
+    got = 0
+    if reply.endswith(':zlib'):
+        while got < total:
+            for kind, payload in decoder.frames():
+                got += len(compression.unpack_block(kind, payload))
+            if got < total:
+                data = await reader.read(1 << 20)
+                wire += len(data)
+                decoder.feed(data)
+    else:
+        got = len(decoder.drain())
+        while got < total:
+            data = await reader.read(1 << 20)
+            wire += len(data)
+            got += len(data)
+    writer.close()
+    return wire, total
+
+
+async def download_runs(port, pid, files):
+    results = []
+    for filename in files:
+        for compress in (False, True):
+            for attempt in ('cold', 'cached'):
+                cpu = server_cpu(pid)
+                started = time.perf_counter()
+                wire, size = await download(port, filename, compress)
+                elapsed = time.perf_counter() - started
+                cpu = server_cpu(pid) - cpu if cpu is not None else None
+                results.append({
+                    'test': 'download', 'file': filename, 'compress': compress, 'cache': attempt,
+                    'file_bytes': size, 'wire_bytes': wire,
+                    'saved': round(1 - wire / size, 3),
+                    'elapsed_s': round(elapsed, 3),
+                    'server_cpu_s': round(cpu, 3) if cpu is not None else None,
+                })
+            # Next pair starts cold again: touching the file drops it from the cache
+            os.utime(os.path.join(files[filename], filename))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression savings vs CPU benchmark")
+    parser.add_argument('--receivers', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--file-size', type=int, default=8 << 20)
+    parser.add_argument('--engine', choices=['thread', 'async'], default='async')
+    args = parser.parse_args()
+
+    shared_dir = tempfile.mkdtemp(prefix='bench-shared-')
+    text = '\n'.join(chat_lines(args.file_size // 40, seed=2)).encode('utf-8')
+    with open(os.path.join(shared_dir, 'notes.txt'), 'wb') as f:
+        f.write(text[:args.file_size])
+    with open(os.path.join(shared_dir, 'random.bin'), 'wb') as f:
+        f.write(os.urandom(args.file_size))
+
+    try:
+        for compress in (False, True):
+            port = free_port()
+            proc = start_server(port, args.engine, 1.0, shared_dir)
+            try:
+                result = asyncio.run(chat_run(port, proc.pid, args.receivers, args.messages, compress))
+                print(json.dumps(result), flush=True)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+        port = free_port()
+        proc = start_server(port, args.engine, 1.0, shared_dir)
+        try:
+            files = {'notes.txt': shared_dir, 'random.bin': shared_dir}
+            for result in asyncio.run(download_runs(port, proc.pid, files)):
+                print(json.dumps(result), flush=True)
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Fan-out benchmark: broadcast throughput at 1k/5k/10k recipients.
+
+    python -m benchmarks.fanout --recipients 1000 5000 10000 --engine async
+
+Starts server.py in a subprocess, connects N receivers and one sender, fires
+a burst of broadcasts and measures how long it takes for every receiver to
+get all of them. Prints one JSON object per recipient count with broadcasts
+per second, deliveries per second and (on Linux) the server's write
+syscalls per delivery, which shows the effect of the flush window.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from framing import FrameDecoder, encode_text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIX = b'bench: '
+
+
+def free_port():
+    """Find a TCP port whose UDP neighbour (port + 1) is also free."""
+    while True:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as u:
+                u.bind(('127.0.0.1', port + 1))
+            return port
+        except OSError:
+            continue
+
+
+def start_server(port, engine, flush_ms, shared_dir):
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), str(port),
+           '--engine', engine, '--flush-window', str(flush_ms),
+           '--queue-frames', '1000000', '--queue-bytes', str(1 << 30), '--rate-limits', '',
+           '--log-dir', '', '--offline-dir', '']
+    env = dict(os.environ, SERVER_SHARED_FILES=shared_dir)
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def write_syscalls(pid):
+    """Write-type syscalls made so far by pid (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                if line.startswith('syscw:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def connect(port, nickname):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    decoder = FrameDecoder()
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            raise ConnectionError("closed during handshake")
+        decoder.feed(data)
+        if any(str(payload, 'utf-8') == 'NICK' for kind, payload in decoder.frames()):
+            break
+    writer.write(encode_text(nickname))
+    return reader, writer, decoder
+
+
+class Receivers:
+    """Shared progress of all receiver tasks."""
+
+    def __init__(self, count):
+        self.remaining = count
+        self.synced = asyncio.Event()
+        self.finished = [None] * count
+        self.seen = [0] * count
+
+    def arrived(self):
+        self.remaining -= 1
+        if not self.remaining:
+            self.synced.set()
+
+
+async def receive_frames(reader, decoder, messages, progress, index):
+    """
+    Count benchmark frames. The first one is the sync marker, sent after
+    every receiver joined: once all receivers saw it, the join
+    announcements queued before it are out of the way and timing starts.
+    """
+    seen = -1
+    while seen < messages:
+        data = await reader.read(65536)
+        if not data:
+            break
+        decoder.feed(data)
+        for kind, payload in decoder.frames():
+            if payload[:len(PREFIX)] == PREFIX:
+                seen += 1
+                if seen == 0:
+                    progress.arrived()
+    progress.seen[index] = max(seen, 0)
+    progress.finished[index] = time.perf_counter()
+
+
+async def run_once(port, pid, recipients, messages, size, batch=100):
+    receivers = []
+    for start in range(0, recipients, batch):
+        n = min(batch, recipients - start)
+        receivers += await asyncio.gather(
+            *(connect(port, f"r{start + i}") for i in range(n)))
+    sender_reader, sender, _ = await connect(port, 'bench')
+
+    progress = Receivers(recipients)
+    tasks = [asyncio.ensure_future(receive_frames(r, d, messages, progress, i))
+             for i, (r, w, d) in enumerate(receivers)]
+    sender.write(encode_text('sync'))
+    await progress.synced.wait()
+
+    body = 'x' * size
+    syscalls_before = write_syscalls(pid)
+    started = time.perf_counter()
+    for i in range(messages):
+        sender.write(encode_text(f"{i} {body}"))
+    await sender.drain()
+    await asyncio.gather(*tasks)
+    syscalls_after = write_syscalls(pid)
+
+    elapsed = max(progress.finished) - started
+    delivered = sum(progress.seen)
+    result = {
+        'recipients': recipients,
+        'messages': messages,
+        'payload_bytes': size,
+        'delivered': delivered,
+        'elapsed_s': round(elapsed, 4),
+        'broadcasts_per_s': round(messages / elapsed, 1),
+        'deliveries_per_s': round(delivered / elapsed, 1),
+    }
+    if syscalls_before is not None and syscalls_after and syscalls_after > syscalls_before:
+        result['write_syscalls'] = syscalls_after - syscalls_before
+        result['syscalls_per_delivery'] = round(result['write_syscalls'] / max(delivered, 1), 4)
+
+    for r, w, d in receivers:
+        w.close()
+    sender.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out benchmark")
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--size', type=int, default=64, help="payload bytes per message")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='async')
+    parser.add_argument('--flush-window', type=float, default=1.0, help="server flush window in ms")
+    args = parser.parse_args()
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    shared_dir = tempfile.mkdtemp(prefix='bench-shared-')
+    for recipients in args.recipients:
+        port = free_port()
+        proc = start_server(port, args.engine, args.flush_window, shared_dir)
+        try:
+            result = asyncio.run(run_once(port, proc.pid, recipients, args.messages, args.size))
+            result['engine'] = args.engine
+            result['flush_window_ms'] = args.flush_window
+            print(json.dumps(result), flush=True)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+Load generator: N synthetic clients driving a mix of chat and file traffic.
+
+    python -m benchmarks.load --clients 200 --duration 20 --rate 2 \\
+        --mix broadcast=60,msg=25,group=10,files=4,download=1 --output run.json
+    python -m benchmarks.load --compare old.json run.json
+
+Starts server.py (or targets a running one with --port, plus --pid to
+sample it), connects every client with the real NICK handshake, puts each
+one in a group, then has each client issue --rate commands per second
+drawn from --mix for --duration seconds:
+
+- broadcast, msg and group lines carry their send time, so every delivery
+  gives a latency sample (all clients live in this process and share one
+  clock);
+- files sends /files and times the reply;
+- download fetches the file over TCP or UDP (--protocol) with
+  chat_client, the library client.py is built on, and times the whole
+  download (one at a time per client).
+
+--commands binary sends every command as a CMD frame (commands.py)
+instead of a text line.
+
+Prints one JSON object with throughput, p50/p99/p999 latency per kind and
+the server's memory and thread counts. --compare prints the change of each
+number between two such reports.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import commands
+from chat_client import ChatClient, DownloadError
+from benchmarks.fanout import ROOT, free_port
+
+KINDS = ('broadcast', 'msg', 'group', 'files', 'download')
+MARK = '~L '
+SAMPLE_INTERVAL = 0.5
+BENCH_FILE = 'load.bin'
+
+
+def parse_mix(text):
+    """'broadcast=60,msg=25' -> ([kinds], [weights])."""
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown command kind {kind!r}")
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def percentiles(samples):
+    """p50/p99/p999 and max of latency samples (seconds) in milliseconds."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {'count': len(samples), 'p50_ms': at(0.5), 'p99_ms': at(0.99),
+            'p999_ms': at(0.999), 'max_ms': round(samples[-1] * 1000, 3)}
+
+
+def process_stats(pid):
+    """Resident memory (current and peak, KB) and thread count of pid from /proc."""
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'VmRSS':
+                    stats['rss_kb'] = int(value.split()[0])
+                elif key == 'VmHWM':
+                    stats['peak_rss_kb'] = int(value.split()[0])
+                elif key == 'Threads':
+                    stats['threads'] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+def start_server(port, engine, shared_dir, log_dir, rate_limits=''):
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), str(port),
+           '--engine', engine, '--log-dir', log_dir, '--offline-dir', '', '--rate-limits', rate_limits,
+           '--queue-frames', '1000000', '--queue-bytes', str(1 << 30)]
+    env = dict(os.environ, SERVER_SHARED_FILES=shared_dir)
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+class Stats:
+    """Counters and latency samples shared by all clients."""
+
+    def __init__(self):
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.latency = {kind: [] for kind in KINDS}
+        self.deliveries = 0
+        self.download_bytes = 0
+        self.errors = 0
+
+
+class LoadClient:
+    """One synthetic user: a ChatClient and a command loop."""
+
+    def __init__(self, index, nickname, group, stats, args, download_dir):
+        self.index = index
+        self.nickname = nickname
+        self.group = group
+        self.stats = stats
+        self.args = args
+        protocol_mode = commands.BINARY if args.commands == 'binary' else ''
+        self.client = ChatClient(nickname, '127.0.0.1', None, download_dir, compression_mode='',
+                                 protocol_mode=protocol_mode, on_message=self.on_line)
+        self.files_sent = []      # send times of /files awaiting their reply
+        self.tasks = set()
+
+    async def connect(self, port):
+        self.client.port = port
+        os.makedirs(self.client.download_dir, exist_ok=True)
+        await self.client.connect()
+        self.send(f"/join {self.group}")
+
+    def send(self, text):
+        self.client.send(text)
+
+    def on_line(self, line):
+        now = time.perf_counter()
+        mark = line.find(MARK)
+        if mark >= 0 and not line.startswith('[To '):  # '[To x] ...' is our own /msg echoed back
+            sent, kind = line[mark + len(MARK):].split(' ', 2)[:2]
+            self.stats.latency[kind].append(now - float(sent))
+            self.stats.deliveries += 1
+        elif line.startswith('FILES:') and self.files_sent:
+            self.stats.latency['files'].append(now - self.files_sent.pop(0))
+
+    async def fetch(self):
+        started = time.perf_counter()
+        try:
+            result = await self.client.download(BENCH_FILE, self.args.protocol, resume=False)
+        except (OSError, ConnectionError, ValueError, DownloadError):
+            self.stats.errors += 1
+            return
+        self.stats.latency['download'].append(time.perf_counter() - started)
+        self.stats.download_bytes += result['fetched']
+
+    async def command_loop(self, peers, kinds, weights, deadline):
+        rng = random.Random(self.args.seed * 100003 + self.index)
+        interval = 1 / self.args.rate
+        # Spread the clients' first commands over one interval
+        await asyncio.sleep(rng.random() * interval)
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            self.stats.sent[kind] += 1
+            stamp = f"{MARK}{time.perf_counter():.9f} {kind}"
+            if kind == 'broadcast':
+                self.send(stamp)
+            elif kind == 'msg':
+                self.send(f"/msg {rng.choice(peers).nickname} {stamp}")
+            elif kind == 'group':
+                self.send(f"/group {self.group} {stamp}")
+            elif kind == 'files':
+                self.files_sent.append(time.perf_counter())
+                self.send('/files')
+            elif BENCH_FILE in self.client.downloading:
+                self.stats.sent[kind] -= 1  # one download at a time per client, like a real one
+            else:
+                task = asyncio.ensure_future(self.fetch())
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            await asyncio.sleep(interval * rng.uniform(0.5, 1.5))
+
+
+async def sample_server(pid, samples, stop):
+    while not stop.is_set():
+        samples.append(process_stats(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args, port, pid):
+    kinds, weights = args.mix
+    stats = Stats()
+    download_root = tempfile.mkdtemp(prefix='load-downloads-')
+    clients = [LoadClient(i, f"load{i}", f"g{i % args.groups}", stats, args,
+                          os.path.join(download_root, str(i)))
+               for i in range(args.clients)]
+    connect_started = time.perf_counter()
+    for start in range(0, len(clients), 100):
+        await asyncio.gather(*(c.connect(port) for c in clients[start:start + 100]))
+    connect_time = time.perf_counter() - connect_started
+    await asyncio.sleep(0.5)  # join notices out of the way
+    idle = process_stats(pid) if pid else {}
+
+    samples, stop = [], asyncio.Event()
+    sampler = asyncio.ensure_future(sample_server(pid, samples, stop)) if pid else None
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(c.command_loop(clients, kinds, weights, deadline) for c in clients))
+    # Let deliveries and downloads still in flight land
+    await asyncio.sleep(args.drain)
+    for c in clients:
+        if c.tasks:
+            await asyncio.wait(list(c.tasks), timeout=args.drain)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if sampler is not None:
+        await sampler
+    await asyncio.gather(*(c.client.close() for c in clients))
+    shutil.rmtree(download_root, ignore_errors=True)
+
+    sent = sum(stats.sent.values())
+    result = {
+        'config': {
+            'clients': args.clients, 'groups': args.groups, 'duration_s': args.duration,
+            'rate_per_client': args.rate, 'mix': dict(zip(kinds, weights)),
+            'protocol': args.protocol, 'commands': args.commands, 'rate_limits': args.rate_limits,
+            'engine': args.engine, 'file_bytes': args.file_size,
+        },
+        'connect_s': round(connect_time, 3),
+        'elapsed_s': round(elapsed, 3),
+        'commands_sent': stats.sent,
+        'commands_per_s': round(sent / args.duration, 1),
+        'deliveries': stats.deliveries,
+        'deliveries_per_s': round(stats.deliveries / args.duration, 1),
+        'download_bytes': stats.download_bytes,
+        'download_mb_per_s': round(stats.download_bytes / args.duration / 1e6, 2),
+        'errors': stats.errors,
+        'latency': {kind: percentiles(stats.latency[kind]) for kind in kinds},
+    }
+    if pid:
+        result['server'] = {
+            'idle': idle,
+            'end': process_stats(pid),
+            'max_threads': max((s.get('threads', 0) for s in samples), default=0),
+            'max_rss_kb': max((s.get('rss_kb', 0) for s in samples), default=0),
+        }
+    return result
+
+
+def flatten(report, prefix=''):
+    """Numeric leaves of a report as {'a.b.c': value}."""
+    out = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            out.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix + key] = value
+    return out
+
+
+def compare(old_path, new_path):
+    """Print every number in two reports side by side with the change."""
+    with open(old_path) as f:
+        old = flatten(json.load(f))
+    with open(new_path) as f:
+        new = flatten(json.load(f))
+    for key in sorted(set(old) | set(new)):
+        a, b = old.get(key), new.get(key)
+        change = f"{(b - a) / a:+.1%}" if a and b is not None else ''
+        print(f"{key:40} {a!s:>14} {b!s:>14} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--groups', type=int, default=10, help="clients are spread over this many groups")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--rate', type=float, default=2, help="commands per second per client")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('broadcast=60,msg=25,group=10,files=4,download=1'),
+                        help="weighted command mix, e.g. broadcast=60,msg=25,group=10,files=4,download=1")
+    parser.add_argument('--protocol', choices=['tcp', 'udp'], default='tcp', help="download protocol")
+    parser.add_argument('--commands', choices=['text', 'binary'], default='text',
+                        help="send commands as text lines or binary CMD frames")
+    parser.add_argument('--file-size', type=int, default=1 << 20, help="bytes in the file clients download")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='async')
+    parser.add_argument('--rate-limits', default='',
+                        help="the started server's --rate-limits (default off, so they do not skew results)")
+    parser.add_argument('--port', type=int, help="use the server already running on this port")
+    parser.add_argument('--pid', type=int, help="process to sample when using --port")
+    parser.add_argument('--drain', type=float, default=2, help="seconds to wait for stragglers")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the report to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two reports instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    proc = None
+    port, pid = args.port, args.pid
+    if port is None:
+        shared_dir = tempfile.mkdtemp(prefix='load-shared-')
+        with open(os.path.join(shared_dir, BENCH_FILE), 'wb') as f:
+            f.write(os.urandom(args.file_size))
+        port = free_port()
+        proc = start_server(port, args.engine, shared_dir, tempfile.mkdtemp(prefix='load-log-'),
+                            args.rate_limits)
+        pid = proc.pid
+    try:
+        result = asyncio.run(run(args, port, pid))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report = json.dumps(result)
+    print(report, flush=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Reliable UDP under loss: goodput against packet loss rate.
+
+    python -m benchmarks.udp_loss --loss 0 0.01 0.05 0.1 0.2 --delay 10
+    python -m benchmarks.udp_loss --loss 0 0.05 --parallel 8
+
+Runs the UDP file server in-process behind a local proxy that drops each
+datagram with the given probability (both directions) and delays it by
+delay +/- jitter milliseconds. Each run downloads a random file through
+the proxy, checks it byte for byte and prints one JSON line with goodput
+and the sender's retransmit counters. With --parallel N, N clients download
+at once (each through its own proxy) and the line reports aggregate
+goodput plus how evenly it was shared (Jain's fairness index, 1.0 = equal).
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import random
+import select
+import socket
+import tempfile
+import threading
+import time
+
+import reliable_udp
+
+
+class LossyProxy:
+    """UDP relay between one client and the server that loses and delays datagrams."""
+
+    def __init__(self, server_addr, loss=0.0, delay=0.0, jitter=0.0, seed=None):
+        self.server_addr = server_addr
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(('127.0.0.1', 0))
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.bind(('127.0.0.1', 0))
+        for sock in (self.front, self.back):
+            reliable_udp.tune_socket(sock)
+        self.address = self.front.getsockname()
+        self.client_addr = None
+        self.queue = []  # (release time, order, socket, data, destination)
+        self.order = 0
+        self.dropped = 0
+        self.forwarded = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _enqueue(self, sock, data, dest):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = max(0.0, self.delay + self.random.uniform(-self.jitter, self.jitter))
+        self.order += 1
+        heapq.heappush(self.queue, (time.monotonic() + delay, self.order, sock, data, dest))
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, sock, data, dest = heapq.heappop(self.queue)
+                sock.sendto(data, dest)
+                self.forwarded += 1
+            timeout = max(0.0, self.queue[0][0] - now) if self.queue else 0.05
+            readable, _, _ = select.select([self.front, self.back], [], [], timeout)
+            for sock in readable:
+                data, source = sock.recvfrom(65536)
+                if sock is self.front:
+                    self.client_addr = source
+                    self._enqueue(self.back, data, self.server_addr)
+                elif self.client_addr is not None:
+                    self._enqueue(self.front, data, self.client_addr)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.front.close()
+        self.back.close()
+
+
+def run_once(server_addr, filepath, filename, loss, delay, jitter, seed, results):
+    proxy = LossyProxy(server_addr, loss, delay, jitter, seed)
+    out_path = filepath + '.received'
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        received = reliable_udp.receive_file(sock, proxy.address, filename, out_path)
+    finally:
+        sock.close()
+        proxy.close()
+    # Give the server a moment to see the final ACK and report
+    deadline = time.time() + 5
+    while filename not in results and time.time() < deadline:
+        time.sleep(0.01)
+    sent = results.pop(filename, {})
+    with open(filepath, 'rb') as a, open(out_path, 'rb') as b:
+        intact = hashlib.sha256(a.read()).digest() == hashlib.sha256(b.read()).digest()
+    os.remove(out_path)
+    return {
+        'loss': loss,
+        'delay_ms': delay * 1000,
+        'jitter_ms': jitter * 1000,
+        'bytes': received['bytes'],
+        'elapsed_s': round(received['elapsed'], 3),
+        'goodput_mbps': round(received['bytes'] * 8 / received['elapsed'] / 1e6, 2),
+        'intact': intact,
+        'packets': sent.get('packets'),
+        'retransmits': sent.get('retransmits'),
+        'timeouts': sent.get('timeouts'),
+        'srtt_ms': sent.get('srtt_ms'),
+        'proxy_dropped': proxy.dropped,
+    }
+
+
+def run_parallel(server_addr, shared_dir, count, size, loss, delay, jitter, seed, results):
+    runs = []
+    for i in range(count):
+        filename = f"parallel-{i}.bin"
+        filepath = os.path.join(shared_dir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(size))
+        runs.append((filepath, filename))
+    outcomes = [None] * count
+
+    def client(i):
+        filepath, filename = runs[i]
+        outcomes[i] = run_once(server_addr, filepath, filename, loss, delay, jitter,
+                               seed + i, results)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    rates = [o['goodput_mbps'] for o in outcomes]
+    return {
+        'loss': loss,
+        'delay_ms': delay * 1000,
+        'parallel': count,
+        'bytes': size * count,
+        'elapsed_s': round(elapsed, 3),
+        'goodput_mbps': round(size * count * 8 / elapsed / 1e6, 2),
+        'min_mbps': min(rates),
+        'max_mbps': max(rates),
+        'fairness': round(sum(rates) ** 2 / (count * sum(r * r for r in rates)), 3),
+        'intact': all(o['intact'] for o in outcomes),
+        'retransmits': sum(o['retransmits'] or 0 for o in outcomes),
+        'timeouts': sum(o['timeouts'] or 0 for o in outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reliable UDP goodput vs packet loss")
+    parser.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.01, 0.05, 0.1, 0.2])
+    parser.add_argument('--delay', type=float, default=10.0, help="one-way delay in ms")
+    parser.add_argument('--jitter', type=float, default=2.0, help="delay jitter in ms")
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help="file size in bytes")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--parallel', type=int, default=1, help="concurrent downloads")
+    args = parser.parse_args()
+
+    shared_dir = tempfile.mkdtemp(prefix='udp-loss-')
+    results = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    resolve = lambda name: os.path.join(shared_dir, name) if os.path.isfile(os.path.join(shared_dir, name)) else None
+    on_done = lambda name, addr, stats: results.__setitem__(name, stats)
+    threading.Thread(target=reliable_udp.serve, args=(sock, resolve, on_done), daemon=True).start()
+
+    for i, loss in enumerate(args.loss):
+        if args.parallel > 1:
+            result = run_parallel(sock.getsockname(), shared_dir, args.parallel, args.size, loss,
+                                  args.delay / 1000, args.jitter / 1000, args.seed + i * 1000,
+                                  results)
+            print(json.dumps(result), flush=True)
+            continue
+        filename = f"payload-{i}.bin"
+        filepath = os.path.join(shared_dir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(args.size))
+        result = run_once(sock.getsockname(), filepath, filename, loss,
+                          args.delay / 1000, args.jitter / 1000, args.seed + i, results)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Upload benchmark: throughput of concurrent /upload transfers, and chat
+latency while they run.
+
+    python -m benchmarks.upload --uploads 1 4 8 --file-size 33554432
+
+For each count N, starts a server with an empty shared directory, connects
+N uploaders and a probe, and has every uploader send its own copy of one
+file at the same moment. Meanwhile the probe sends itself private messages
+and times how long each takes to come back, which shows whether chat
+handlers stall behind the disk writes. Prints one JSON object per N with
+the aggregate and per-upload MB/s, the server's CPU time and the probe's
+p50/p99 round trip.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from chat_client import ChatClient
+from benchmarks.fanout import free_port, start_server
+from benchmarks.compression import server_cpu
+
+
+async def probe_loop(client, stop, latencies, interval=0.01):
+    """Private messages to ourselves, timed until they come back."""
+    n = 0
+    while not stop.is_set():
+        n += 1
+        sent = time.perf_counter()
+        client.send(f"/msg probe ping{n}")
+        while True:
+            line = await client.receive()
+            if line is None:
+                return
+            if line.endswith(f"ping{n}") and line.startswith('[Private]'):
+                break
+        latencies.append(time.perf_counter() - sent)
+        await asyncio.sleep(interval)
+
+
+async def run(port, pid, uploads, source, shared_dir):
+    size = os.path.getsize(source)
+    clients = [ChatClient(f"u{i}", port=port, compression_mode='') for i in range(uploads)]
+    probe = ChatClient('probe', port=port, compression_mode='')
+    for client in clients + [probe]:
+        await client.connect()
+    await asyncio.sleep(0.5)  # join notices out of the way
+    while not probe.inbox.empty():
+        probe.inbox.get_nowait()
+
+    stop = asyncio.Event()
+    latencies = []
+    prober = asyncio.ensure_future(probe_loop(probe, stop, latencies))
+    cpu = server_cpu(pid)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[client.upload(source, f"upload{i}.bin")
+                                     for i, client in enumerate(clients)])
+    elapsed = time.perf_counter() - started
+    cpu = server_cpu(pid) - cpu if cpu is not None else None
+    stop.set()
+    await prober
+    for client in clients + [probe]:
+        await client.close()
+
+    stored = all(os.path.getsize(os.path.join(shared_dir, f"upload{i}.bin")) == size
+                 for i in range(uploads))
+    rates = [r['size'] / r['elapsed'] / 1e6 for r in results]
+    latencies.sort()
+    return {
+        'uploads': uploads, 'file_bytes': size, 'stored': stored,
+        'elapsed_s': round(elapsed, 3),
+        'aggregate_mb_s': round(uploads * size / elapsed / 1e6, 1),
+        'per_upload_mb_s': round(statistics.median(rates), 1),
+        'server_cpu_s': round(cpu, 3) if cpu is not None else None,
+        'chat_probes': len(latencies),
+        'chat_p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'chat_p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent upload throughput benchmark")
+    parser.add_argument('--uploads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--file-size', type=int, default=32 << 20)
+    parser.add_argument('--engine', choices=['thread', 'async'], default='async')
+    args = parser.parse_args()
+
+    source_dir = tempfile.mkdtemp(prefix='bench-upload-')
+    source = os.path.join(source_dir, 'source.bin')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(args.file_size))
+    try:
+        for uploads in args.uploads:
+            shared_dir = tempfile.mkdtemp(prefix='bench-shared-')
+            port = free_port()
+            proc = start_server(port, args.engine, 1.0, shared_dir)
+            try:
+                result = asyncio.run(run(port, proc.pid, uploads, source, shared_dir))
+                print(json.dumps(result), flush=True)
+            finally:
+                proc.terminate()
+                proc.wait()
+                shutil.rmtree(shared_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+Pub/sub message bus linking the nodes of a server cluster.
+
+A bus carries opaque byte payloads on named topics. A node subscribes to
+the topics it cares about and publishes to topics; every subscriber except
+the publisher gets the message, in the order that publisher sent it. Two
+stand-ins ship with the server:
+
+- LocalHub / LocalBus: nodes living in one process (tests, embedding).
+- BusBroker / TcpBus: a small relay on a local TCP port that node
+  processes connect to. Start it with `python bus.py [port]`.
+
+Anything with the same publish(), subscribe(), unsubscribe() and close()
+methods (an adapter over an external broker, say) can take their place.
+"""
+import argparse
+import socket
+import struct
+import threading
+
+from framing import FrameDecoder, encode_frame, encode_text, TEXT, DATA
+from outbound import OutboundQueue, send_frames
+
+DEFAULT_PORT = 55600
+TOPIC_LENGTH = struct.Struct('!H')
+# A node that stops reading may fall this far behind before it loses messages
+QUEUE_FRAMES = 1 << 20
+QUEUE_BYTES = 256 * 1024 * 1024
+
+
+def encode_message(topic, payload):
+    """One bus message as a DATA frame: topic length, topic, payload."""
+    name = topic.encode('utf-8')
+    return encode_frame(TOPIC_LENGTH.pack(len(name)) + name + payload, DATA)
+
+
+def decode_message(body):
+    """Split a DATA frame body back into (topic, payload)."""
+    (n,) = TOPIC_LENGTH.unpack_from(body)
+    end = TOPIC_LENGTH.size + n
+    return str(body[TOPIC_LENGTH.size:end], 'utf-8'), body[end:]
+
+
+class LocalHub:
+    """In-process stand-in for a broker: connect() one LocalBus per node."""
+
+    def __init__(self):
+        self.topics = {}  # topic -> {bus: handler}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return LocalBus(self)
+
+
+class LocalBus:
+    """
+    A node's handle on a LocalHub. Handlers run synchronously in the
+    publisher's thread, so they must not block.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def subscribe(self, topic, handler):
+        """Deliver messages on topic to handler(topic, payload)."""
+        with self.hub.lock:
+            self.hub.topics.setdefault(topic, {})[self] = handler
+
+    def unsubscribe(self, topic):
+        with self.hub.lock:
+            subscribers = self.hub.topics.get(topic)
+            if subscribers is not None:
+                subscribers.pop(self, None)
+                if not subscribers:
+                    del self.hub.topics[topic]
+
+    def publish(self, topic, payload):
+        with self.hub.lock:
+            handlers = [h for bus, h in self.hub.topics.get(topic, {}).items() if bus is not self]
+        for handler in handlers:
+            handler(topic, bytes(payload))
+
+    def close(self):
+        with self.hub.lock:
+            topics = [t for t, subs in self.hub.topics.items() if self in subs]
+        for topic in topics:
+            self.unsubscribe(topic)
+
+
+class TcpBus:
+    """
+    A node's connection to a BusBroker. Publishing only queues the frame;
+    a writer thread sends batches and a reader thread runs the handlers, so
+    handlers must not block either.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.handlers = {}  # topic -> handler
+        self.outq = OutboundQueue(QUEUE_FRAMES, QUEUE_BYTES)
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def subscribe(self, topic, handler):
+        """Deliver messages on topic to handler(topic, payload)."""
+        self.handlers[topic] = handler
+        self.outq.put(encode_text(f"SUB {topic}"))
+
+    def unsubscribe(self, topic):
+        if self.handlers.pop(topic, None) is not None:
+            self.outq.put(encode_text(f"UNSUB {topic}"))
+
+    def publish(self, topic, payload):
+        self.outq.put(encode_message(topic, payload))
+
+    def close(self):
+        """Send whatever is queued, then hang up."""
+        self.closed = True
+        self.outq.close()
+        self.writer.join(1)
+
+    def _write_loop(self):
+        while True:
+            batch = self.outq.get_batch()
+            if not batch:
+                break
+            try:
+                self.outq.note_sent(send_frames(self.sock, batch))
+            except OSError:
+                break
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_into(self.sock):
+                for kind, body in decoder.frames():
+                    if kind != DATA:
+                        continue
+                    topic, payload = decode_message(body)
+                    handler = self.handlers.get(topic)
+                    if handler is not None:
+                        handler(topic, bytes(payload))
+        except OSError:
+            pass
+        if not self.closed:
+            print("Lost connection to the cluster bus")
+        self.outq.close()
+        self.sock.close()
+
+
+def connect(url):
+    """
+    Bus for a --bus URL: 'tcp://host:port' for a BusBroker, 'local' for the
+    process-wide LocalHub.
+    """
+    if url == 'local':
+        return local_hub.connect()
+    if url.startswith('tcp://'):
+        host, _, port = url[len('tcp://'):].rpartition(':')
+        return TcpBus(host or '127.0.0.1', int(port))
+    raise ValueError(f"unknown bus {url!r} (expected 'local' or 'tcp://host:port')")
+
+
+local_hub = LocalHub()
+
+
+class BusBroker:
+    """
+    Relay for TcpBus nodes. Each node gets a reader thread and a writer
+    thread with its own outbound queue; a published frame is forwarded as
+    is (encoded once) to every other node subscribed to its topic.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.topics = {}  # topic -> set of OutboundQueue
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen()
+        print(f"Cluster bus listening on {self.host}:{self.port}")
+        while True:
+            conn, address = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Node connected from {address}")
+            outq = OutboundQueue(QUEUE_FRAMES, QUEUE_BYTES)
+            threading.Thread(target=self._write_loop, args=(conn, outq), daemon=True).start()
+            threading.Thread(target=self._read_loop, args=(conn, address, outq), daemon=True).start()
+
+    def _write_loop(self, conn, outq):
+        while True:
+            batch = outq.get_batch()
+            if not batch:
+                break
+            try:
+                outq.note_sent(send_frames(conn, batch))
+            except OSError:
+                break
+
+    def _read_loop(self, conn, address, outq):
+        decoder = FrameDecoder()
+        subscribed = set()
+        try:
+            while decoder.recv_into(conn):
+                for kind, body in decoder.frames():
+                    if kind == TEXT:
+                        command, _, topic = str(body, 'utf-8').partition(' ')
+                        with self.lock:
+                            if command == 'SUB':
+                                self.topics.setdefault(topic, set()).add(outq)
+                                subscribed.add(topic)
+                            elif command == 'UNSUB':
+                                self._unsubscribe(topic, outq)
+                                subscribed.discard(topic)
+                        continue
+                    topic, _ = decode_message(body)
+                    with self.lock:
+                        targets = list(self.topics.get(topic, ()))
+                    if targets:
+                        frame = encode_frame(bytes(body), DATA)
+                        for target in targets:
+                            if target is not outq:
+                                target.put(frame)
+        except OSError:
+            pass
+        print(f"Node at {address} disconnected")
+        with self.lock:
+            for topic in subscribed:
+                self._unsubscribe(topic, outq)
+        outq.close()
+        conn.close()
+
+    def _unsubscribe(self, topic, outq):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(outq)
+            if not subscribers:
+                del self.topics[topic]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local TCP message bus for server clusters")
+    parser.add_argument('port', nargs='?', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+    try:
+        BusBroker(args.host, args.port).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+"""
+Asyncio client core: one chat connection multiplexing chat, commands and
+any number of concurrent TCP and UDP downloads and TCP uploads.
+
+client.py puts a terminal on top of it; benchmarks.load runs hundreds of
+them in one event loop with no terminal at all. Nothing the server sends
+is ever dropped: every chat line goes to on_message (or the inbox queue)
+as soon as it arrives, whatever downloads are running, because downloads
+use their own data connections (TCP) or a worker thread (UDP) and only
+their answers to /download and /upload are taken off the chat stream.
+"""
+import asyncio
+import os
+import socket
+import time
+
+import framing
+from framing import FrameDecoder, encode_frame, encode_text
+import compression
+import commands
+import manifest
+import reliable_udp
+
+READ_SIZE = 1 << 20
+SEND_SLICE = 4 << 20  # bytes handed to sendfile() between progress reports
+PONG_FRAME = encode_frame(b'', framing.PONG)
+
+
+class DownloadError(Exception):
+    """The server refused a download, or fetched chunks failed their checksum."""
+
+
+class UploadError(Exception):
+    """The server refused an upload or could not store it."""
+
+
+class Offer:
+    """Where to fetch a range of a file, from FILE_READY or UDP_INFO."""
+    __slots__ = ('protocol', 'host', 'port', 'token', 'offset', 'length', 'streams',
+                 'filename', 'manifest')
+
+    @classmethod
+    def parse(cls, line, host):
+        offer = cls()
+        if line.startswith('FILE_READY:'):
+            _, port, offer.token, _, offset, length, streams, filename = line.split(':', 7)
+            offer.protocol, offer.host = 'TCP', host
+        else:
+            _, offer.host, port, offset, length, streams, filename = line.split(':', 6)
+            offer.protocol, offer.token = 'UDP', None
+        offer.port, offer.offset, offer.length = int(port), int(offset), int(length)
+        offer.streams, offer.filename = int(streams), filename.strip()
+        return offer
+
+
+async def read_reply(reader, decoder):
+    """The next TEXT frame on a data connection, as str."""
+    while True:
+        for kind, payload in decoder.frames():
+            return str(payload, 'utf-8')
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError("data connection closed")
+        decoder.feed(data)
+
+
+def preallocate(filepath, size):
+    """Open (creating if needed) a partial download sized to the full file."""
+    f = open(filepath, 'r+b' if os.path.exists(filepath) else 'w+b')
+    if os.fstat(f.fileno()).st_size != size:
+        f.truncate(size)
+    return f
+
+
+class ChatClient:
+    """
+    One user's connection. on_message(line), if given, is called on the
+    event loop for every chat line; otherwise lines queue up in inbox,
+    read with receive(). Protocol replies (manifests, download offers,
+    handshake confirmations) are handled here and never reach either.
+    """
+
+    def __init__(self, nickname, host='127.0.0.1', port=55555, download_dir='.',
+                 compression_mode=compression.ZLIB, protocol_mode=commands.BINARY, on_message=None,
+                 presence=None, admin_token=''):
+        self.nickname = nickname
+        self.host = host
+        self.port = port
+        self.download_dir = download_dir
+        self.compression_mode = compression.normalize(compression_mode)
+        self.compressed = False  # the server agreed (COMPRESS:) on this connection
+        self.protocol_mode = protocol_mode
+        self.on_message = on_message
+        self.presence = presence  # presence deltas to ask for ('all', 'off', 'g1,g2'); None = server default
+        self.admin_token = admin_token  # unlocks /stats, /queues and /cache on servers with one set
+        self.roster = {}          # scope ('*' or '#group') -> [version, set of nicknames online]
+        self.inbox = None
+        self.reader = self.writer = None
+        self.binary = False  # set once the server agrees to binary commands
+        self.connected = False
+        self.offers = {}     # filename -> futures waiting for the server's answer, oldest first
+        self.upload_offers = {}  # the same for /upload
+        self.manifests = {}  # filename -> (size, chunk size, digests) from the latest MANIFEST
+        self.downloading = set()  # filenames being written, each to its one .part file
+        self.read_task = None
+        self.session_token = None  # from SESSION:, to resume with after a disconnect
+        self.position = 0          # bytes of frames received since the SESSION frame
+        self.resumed = None        # bytes lost when the last reconnect resumed, or None
+
+    async def connect(self, resume=False):
+        """
+        Connect and send the nickname straight away, without waiting for the
+        server's NICK prompt, so commands sent right after connect() go out
+        in the same round trip. With resume, asks to get the last session
+        back (see reconnect()).
+        """
+        if self.inbox is None:
+            self.inbox = asyncio.Queue()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Handshake reply: nickname, then options one per line
+        hello = self.nickname
+        hello += f"\ncompress={self.compression_mode}" if self.compression_mode else ''
+        hello += f"\nprotocol={self.protocol_mode}" if self.protocol_mode else ''
+        hello += f"\npresence={self.presence}" if self.presence else ''
+        hello += f"\nadmin={self.admin_token}" if self.admin_token else ''
+        if resume and self.session_token:
+            hello += f"\nresume={self.session_token}:{self.position}"
+        self.resumed = None
+        self.compressed = False
+        self.writer.write(encode_text(hello))
+        self.connected = True
+        self.read_task = asyncio.ensure_future(self.read_loop(FrameDecoder(65536)))
+
+    async def reconnect(self):
+        """
+        Connect again after the connection dropped. If the server still has
+        the session, it comes back as it was: same nickname and groups, and
+        every frame after the last one received is sent again; resumed is
+        then the number of bytes that could not be (0 if none).
+        """
+        await self.close()
+        # The old connection's end-of-stream None would end a receive() loop; keep only the lines
+        lines = []
+        while not self.inbox.empty():
+            line = self.inbox.get_nowait()
+            if line is not None:
+                lines.append(line)
+        for line in lines:
+            self.inbox.put_nowait(line)
+        await self.connect(resume=True)
+
+    async def read_loop(self, decoder):
+        inflater = None  # set once the server agrees to compress
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(inflater.unpack(data) if inflater is not None else data)
+                for kind, payload in decoder.frames():
+                    self.position += framing.HEADER_SIZE + len(payload)
+                    if kind == framing.PING:
+                        self.writer.write(PONG_FRAME)  # heartbeat: we are still here
+                        continue
+                    line = str(payload, 'utf-8', errors='replace')
+                    if line == 'NICK':
+                        continue  # the prompt the hello was sent ahead of
+                    if inflater is None and line.startswith('COMPRESS:'):
+                        # Everything after this frame is one deflate stream
+                        inflater = compression.StreamDecompressor()
+                        self.compressed = True
+                        decoder.feed(inflater.unpack(decoder.drain()))
+                        continue
+                    self.on_line(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.connected = False
+            for offers in (self.offers, self.upload_offers):
+                for waiting in offers.values():
+                    for future in waiting:
+                        if not future.done():
+                            future.set_exception(ConnectionError("disconnected from the server"))
+                offers.clear()
+            if self.on_message is None:
+                self.inbox.put_nowait(None)
+
+    def on_line(self, line):
+        if line.startswith('MANIFEST:'):
+            parts = line.split(':', 4)
+            if len(parts) == 5:
+                self.manifests[parts[4].strip()] = (int(parts[1]), int(parts[2]), manifest.decode(parts[3]))
+        elif line.startswith(('FILE_READY:', 'UDP_INFO:')):
+            offer = Offer.parse(line, self.host)
+            offer.manifest = self.manifests.pop(offer.filename, None)
+            self.answer(offer.filename, offer, line)
+        elif line.startswith('FILE_ERROR:'):
+            # FILE_ERROR:<message>, then the filename on a line of its own
+            error, _, filename = line[len('FILE_ERROR:'):].partition('\n')
+            self.answer(filename, DownloadError(error), line)
+        elif line.startswith('UPLOAD_READY:'):
+            _, port, token, size, filename = line.split(':', 4)
+            self.answer(filename, (int(port), token, int(size)), line, self.upload_offers)
+        elif line.startswith('UPLOAD_ERROR:'):
+            error, _, filename = line[len('UPLOAD_ERROR:'):].partition('\n')
+            self.answer(filename, UploadError(error), line, self.upload_offers)
+        elif line == f"PROTOCOL:{commands.BINARY}":
+            self.binary = True
+        elif line.startswith('SESSION:'):
+            # The resume position is counted from the start of this frame
+            self.session_token = line[len('SESSION:'):]
+            self.position = framing.HEADER_SIZE + len(line)
+        elif line.startswith('RESUMED:'):
+            self.resumed = int(line.split(':', 2)[1])
+        else:
+            if line.startswith(('USERS:', 'PRESENCE:')):
+                self.track_presence(line)
+            self.deliver(line)
+
+    def track_presence(self, line):
+        """Keep roster up to date from /users snapshots and the presence deltas after them."""
+        head, *names = line.split('\n')
+        if head.startswith('USERS:'):
+            _, version, scope, _ = head.split(':', 3)
+            self.roster[scope] = [int(version), set(names)]
+            return
+        _, version, scope = head.split(':', 2)
+        entry = self.roster.get(scope)
+        if entry is None or int(version) <= entry[0]:
+            return  # no snapshot to apply it to, or already in it
+        entry[0] = int(version)
+        for name in names:
+            if name[:1] == '+':
+                entry[1].add(name[1:])
+            else:
+                entry[1].discard(name[1:])
+
+    def answer(self, filename, result, line, offers=None):
+        """Hand an offer or error to the oldest download (or upload) waiting for it."""
+        offers = self.offers if offers is None else offers
+        waiting = offers.get(filename)
+        if not waiting:
+            self.deliver(line)  # somebody else's /download, e.g. typed raw
+            return
+        future = waiting.pop(0)
+        if not waiting:
+            del offers[filename]
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def deliver(self, line):
+        if self.on_message is not None:
+            self.on_message(line)
+        else:
+            self.inbox.put_nowait(line)
+
+    async def receive(self):
+        """Next chat line from the inbox; None once the connection is gone."""
+        return await self.inbox.get()
+
+    def send(self, line):
+        """Send one command or chat line, in binary form if the server agreed to it."""
+        frame = None
+        if self.binary:
+            try:
+                frame = commands.encode_line(line)
+            except ValueError:
+                pass  # target too long for the binary form
+        self.writer.write(frame or encode_text(line))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+    async def download(self, filename, protocol='tcp', offset=0, length=0, streams=1,
+                       resume=True, progress=None):
+        """
+        Resumable download of [offset, offset + length) of filename (length 0
+        = to the end) into download_dir. Chunks already on disk are checked
+        against the server's manifest, only the missing or damaged ones are
+        fetched, over up to `streams` connections at once, and the fetched
+        chunks are checked before the file is renamed into place. With
+        resume=False whatever is on disk is overwritten.
+
+        progress(filename, bytes fetched, bytes to fetch) is called on the
+        event loop as data arrives. Returns a summary dict; raises
+        DownloadError or ConnectionError on failure, leaving the .part file
+        for a later resume.
+        """
+        if filename in self.downloading:
+            raise DownloadError("already being downloaded")
+        self.downloading.add(filename)
+        try:
+            return await self.fetch_file(filename, protocol, offset, length, streams, resume, progress)
+        finally:
+            self.downloading.discard(filename)
+
+    async def fetch_file(self, filename, protocol, offset, length, streams, resume, progress):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.offers.setdefault(filename, []).append(future)
+        line = f"/download {filename} {protocol}"
+        if offset or length:
+            line += f" {offset} {length}"
+        if streams != 1:
+            line += f" -n {streams}"
+        self.send(line)
+        offer = await future
+        if offer.manifest is None:
+            raise DownloadError("no manifest from the server")
+        filesize, chunk_size, digests = offer.manifest
+
+        filepath = os.path.join(self.download_dir, filename)
+        partpath = filepath + '.part'
+        if resume:
+            if not os.path.exists(partpath) and os.path.exists(filepath):
+                os.replace(filepath, partpath)  # refresh an earlier copy in place
+            good = await asyncio.to_thread(manifest.verify, partpath, filesize, digests, chunk_size)
+        else:
+            good = [False] * len(digests)
+        # Whole chunks around the range asked for, so every chunk fetched can be checked
+        low = offer.offset // chunk_size * chunk_size
+        high = min(filesize, -(-(offer.offset + offer.length) // chunk_size) * chunk_size)
+        ranges = manifest.missing_ranges(good, filesize, chunk_size, low, high - low)
+        fetched = sum(size for _, size in ranges)
+        started = time.monotonic()
+        used = 0
+        if ranges:
+            preallocate(partpath, filesize).close()
+            done = [0]
+
+            def report(n):
+                done[0] += n
+                if progress is not None:
+                    progress(filename, done[0], fetched)
+
+            shares = manifest.split_ranges(ranges, offer.streams, chunk_size)
+            used = len(shares)
+            if offer.protocol == 'TCP':
+                fetches = [self.fetch_tcp(offer, share, partpath, report) for share in shares]
+            else:
+                fetches = [self.fetch_udp(offer, share, partpath, report) for share in shares]
+            await asyncio.gather(*fetches)
+            first = ranges[0][0] // chunk_size
+            last = (ranges[-1][0] + ranges[-1][1] - 1) // chunk_size
+            checked = await asyncio.to_thread(manifest.verify, partpath, filesize, digests, chunk_size,
+                                              indices=range(first, last + 1))
+            for i in range(first, last + 1):
+                good[i] = good[i] or checked[i]
+        elif not os.path.exists(partpath):
+            preallocate(partpath, filesize).close()  # empty file
+
+        bad = manifest.missing_ranges(good, filesize, chunk_size, low, high - low)
+        if bad:
+            raise DownloadError(f"{sum(size for _, size in bad):,} bytes failed the checksum; "
+                                f"/download it again to refetch them")
+        complete = all(good)
+        if complete:
+            os.replace(partpath, filepath)
+        return {
+            'filename': filename, 'protocol': offer.protocol, 'size': filesize,
+            'offset': offer.offset, 'length': offer.length,
+            'fetched': fetched, 'reused': high - low - fetched, 'streams': used,
+            'elapsed': time.monotonic() - started, 'complete': complete,
+            'path': filepath if complete else partpath,
+        }
+
+    async def fetch_tcp(self, offer, ranges, filepath, report):
+        """Fetch byte ranges over one TCP data connection, writing each in place."""
+        reader, writer = await asyncio.open_connection(offer.host, offer.port)
+        try:
+            specs = ' '.join(f"{start}:{size}" for start, size in ranges)
+            option = f" {compression.ZLIB}" if self.compressed else ''  # only what the server offers
+            writer.write(encode_text(f"GET {offer.token}{option} {specs}"))
+
+            # Reply is one TEXT frame, followed by the ranges back to back
+            decoder = FrameDecoder()
+            reply = await read_reply(reader, decoder)
+            if not reply.startswith('OK:'):
+                raise ConnectionError(reply.split(':', 1)[-1])
+            compressed = reply.endswith(f":{compression.ZLIB}")
+            leftover = b'' if compressed else decoder.drain()  # file bytes that came with the reply
+
+            with open(filepath, 'r+b', buffering=0) as f:
+                for start, size in ranges:
+                    received = 0
+                    while received < size:
+                        if compressed:
+                            # Each range arrives as DATA/ZDATA frames of up to a chunk each
+                            for kind, payload in decoder.frames():
+                                data = compression.unpack_block(kind, payload)
+                                break
+                            else:
+                                data = await reader.read(READ_SIZE)
+                                if not data:
+                                    raise ConnectionError("connection dropped")
+                                decoder.feed(data)
+                                continue
+                        elif leftover:
+                            data = leftover[:size - received]
+                            leftover = leftover[len(data):]
+                        else:
+                            data = await reader.read(min(READ_SIZE, size - received))
+                            if not data:
+                                raise ConnectionError("connection dropped")
+                        reliable_udp.write_at(f, start + received, data)
+                        received += len(data)
+                        report(len(data))
+        finally:
+            writer.close()
+
+    async def fetch_udp(self, offer, ranges, filepath, report):
+        """Fetch byte ranges with reliable UDP in a worker thread, one transfer per range."""
+        loop = asyncio.get_running_loop()
+
+        def run():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                for start, size in ranges:
+                    seen = [0]
+
+                    def progress(n):
+                        loop.call_soon_threadsafe(report, n - seen[0])
+                        seen[0] = n
+
+                    reliable_udp.receive_file(sock, (offer.host, offer.port), offer.filename,
+                                              filepath, start, size, progress)
+            finally:
+                sock.close()
+
+        await asyncio.to_thread(run)
+
+    async def upload(self, path, filename=None, progress=None):
+        """
+        Upload the file at path into the server's shared files, as filename
+        (default its own name). The bytes go over a TCP data connection with
+        sendfile(), so chat keeps flowing meanwhile, and the file appears in
+        /files only once the server has all of it.
+
+        progress(filename, bytes sent, bytes to send) is called on the
+        event loop as data goes out. Returns a summary dict; raises
+        UploadError or ConnectionError on failure.
+        """
+        filename = filename or os.path.basename(path)
+        size = os.path.getsize(path)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.upload_offers.setdefault(filename, []).append(future)
+        self.send(f"/upload {filename} {size}")
+        port, token, _ = await future
+
+        started = time.monotonic()
+        reader, writer = await asyncio.open_connection(self.host, port)
+        try:
+            writer.write(encode_text(f"PUT {token}"))
+            decoder = FrameDecoder()
+            reply = await read_reply(reader, decoder)
+            if not reply.startswith('OK:'):
+                raise UploadError(reply.split(':', 1)[-1])
+            with open(path, 'rb') as f:
+                sent = 0
+                while sent < size:
+                    # Kernel copies the file to the socket where it can (os.sendfile)
+                    n = await loop.sendfile(writer.transport, f, sent, min(SEND_SLICE, size - sent))
+                    if not n:
+                        raise UploadError("file shrank while being uploaded")
+                    sent += n
+                    if progress is not None:
+                        progress(filename, sent, size)
+            reply = await read_reply(reader, decoder)
+            if not reply.startswith('DONE:'):
+                raise UploadError(reply.split(':', 1)[-1])
+        finally:
+            writer.close()
+        return {'filename': filename, 'size': size, 'elapsed': time.monotonic() - started}
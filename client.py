@@ -1,12 +1,23 @@
-import socket
+import asyncio
 import threading
 import os
+import sys
 import time
 
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client.connect(('127.0.0.1', 55555))
-running = True
-receiving_file = False
+from chat_client import ChatClient, DownloadError, UploadError
+import compression
+import commands
+
+server_host = '127.0.0.1'
+server_port = 55555
+# Ask the server to compress chat and downloads ('' = never)
+compression_mode = os.environ.get("CLIENT_COMPRESSION", compression.ZLIB)
+# Ask to send commands in the binary form of commands.py ('' = always text)
+protocol_mode = os.environ.get("CLIENT_PROTOCOL", commands.BINARY)
+# Sent at login to servers that keep /stats, /queues and /cache for admins ('' = none)
+admin_token = os.environ.get("CLIENT_ADMIN_TOKEN", "")
+PROGRESS_STEP = 25  # percent between progress lines
+RECONNECT_DELAYS = (0, 0.5, 1, 2, 4, 8)  # seconds before each attempt to get the session back
 
 nickname = input("Choose your username: ")
 
@@ -16,89 +27,6 @@ if not os.path.exists(user_dir):
     os.makedirs(user_dir)
     print(f"Created download directory: {user_dir}")
 
-def receive_file_tcp(filename, filesize):
-    """Receive file via TCP."""
-    global receiving_file
-    try:
-        filepath = os.path.join(user_dir, filename)
-        received = 0
-
-        with open(filepath, 'wb') as f:
-            while received < filesize:
-                chunk = client.recv(4096)
-                if not chunk:
-                    break
-                # Check if we got FILE_END marker
-                if b'FILE_END' in chunk:
-                    data_part = chunk.split(b'FILE_END')[0]
-                    if data_part:
-                        f.write(data_part)
-                        received += len(data_part)
-                    break
-                f.write(chunk)
-                received += len(chunk)
-
-        actual_size = os.path.getsize(filepath)
-        print(f"\n[Downloaded] {filename} via TCP - {actual_size} bytes")
-        print(f"[Saved to] {filepath}")
-    except Exception as e:
-        print(f"\nError downloading file: {e}")
-    finally:
-        receiving_file = False
-
-def receive_file_udp(host, port, filename):
-    """Receive file via UDP."""
-    try:
-        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_sock.settimeout(5.0)
-
-        # Request file
-        udp_sock.sendto(f"REQUEST:{filename.strip()}".encode(), (host, port))
-
-        # Receive start message with filesize
-        data, _ = udp_sock.recvfrom(2048)
-        msg = data.decode('utf-8', errors='ignore')
-
-        if msg.startswith('ERROR:'):
-            print(f"\n{msg}")
-            return
-
-        if msg.startswith('START:'):
-            filesize = int(msg.split(':')[1])
-            filepath = os.path.join(user_dir, filename)
-
-            chunks = {}
-            with open(filepath, 'wb') as f:
-                while True:
-                    try:
-                        data, _ = udp_sock.recvfrom(2048)
-                        msg = data.decode('utf-8', errors='ignore')
-
-                        if data == b'END':
-                            break
-
-                        if data.startswith(b'DATA:'):
-                            # Extract sequence number and data
-                            parts = data.split(b':', 2)
-                            if len(parts) == 3:
-                                seq = int(parts[1])
-                                chunk_data = parts[2]
-                                chunks[seq] = chunk_data
-                    except socket.timeout:
-                        break
-
-                # Write chunks in order
-                for seq in sorted(chunks.keys()):
-                    f.write(chunks[seq])
-
-            actual_size = os.path.getsize(filepath)
-            print(f"\n[Downloaded] {filename} via UDP - {actual_size} bytes")
-            print(f"[Saved to] {filepath}")
-    except Exception as e:
-        print(f"\nError downloading via UDP: {e}")
-    finally:
-        udp_sock.close()
-
 def display(message):
     """Format and display messages with timestamps and appropriate spacing."""
     timestamp = time.strftime("%H:%M:%S")
@@ -108,83 +36,247 @@ def display(message):
     else:
         print(f"  [{timestamp}] {message}")
 
-def receive():
-    global running, receiving_file
-    files_list = []
-    collecting_files = False
+def show_files(message):
+    """Print one page of the file list (a single FILES frame)."""
+    lines = message.split('\n')
+    _, page, pages, total, pattern = lines[0].split(':', 4)
+    if total == '0':
+        print(f"\nNo files {'matching ' + pattern + ' ' if pattern else ''}in shared directory")
+        return
+    print("\n=== Available Files ===")
+    for line in lines[1:]:
+        fname, fsize = line.rsplit(':', 1)
+        print(f"{fname:30} - {int(fsize):,} bytes")
+    print(f"=== Page {page} of {pages} ({total} files) ===")
+    if page != pages:
+        print(f"Next page: /files {pattern + ' ' if pattern else ''}{int(page) + 1}")
+    print("Use: /download <filename> <tcp|udp>")
+
+def show_history(message):
+    """Print one page of stored messages (a single HISTORY frame)."""
+    lines = message.split('\n')
+    _, label, more = lines[0].split(':', 2)
+    if len(lines) == 1:
+        print(f"\nNo history for {label}")
+        return
+    print(f"\n=== History: {label} ===")
+    for line in lines[1:]:
+        timestamp, text = line.split(':', 1)
+        stamp = time.strftime("%m-%d %H:%M:%S", time.localtime(float(timestamp)))
+        print(f"  [{stamp}] {text}")
+    if more:
+        target = '' if label == 'all' else label + ' '
+        print(f"=== Older: /history {target}{len(lines) - 1} before {more} ===")
+
+def names(nicks, limit=10):
+    return ', '.join(nicks[:limit]) + (f" and {len(nicks) - limit} others" if len(nicks) > limit else '')
+
+def show_presence(message):
+    """Print a presence delta (one PRESENCE frame) as join/leave lines."""
+    lines = message.split('\n')
+    scope = lines[0].split(':', 2)[2]
+    came = [line[1:] for line in lines[1:] if line[:1] == '+']
+    went = [line[1:] for line in lines[1:] if line[:1] == '-']
+    if scope == '*':
+        if came:
+            display(f"{names(came)} joined the chat!")
+        if went:
+            display(f"{names(went)} left the chat!")
+    else:
+        if came:
+            display(f"[{scope[1:]}] online: {names(came)}")
+        if went:
+            display(f"[{scope[1:]}] offline: {names(went)}")
+
+def show_users(message):
+    """Print a roster snapshot (one USERS frame)."""
+    lines = message.split('\n')
+    _, _, scope, count = lines[0].split(':', 3)
+    label = "Online" if scope == '*' else f"Online in {scope[1:]}"
+    print(f"\n=== {label} ({count}) ===")
+    for nick in lines[1:]:
+        print(f"  {nick}")
+
+def handle_line(message):
+    """React to one chat line from the server."""
+    if message.startswith('PRESENCE:'):
+        show_presence(message)
+    elif message.startswith('USERS:'):
+        show_users(message)
+    elif message.startswith('FILES:'):
+        show_files(message)
+    elif message.startswith('HISTORY:'):
+        show_history(message)
+    elif message.startswith('FILE_ERROR:'):
+        error = message.split(':', 1)[1].split('\n')[0]
+        print(f"\n[Error] {error}")
+    else:
+        display(message)
+
+def show_progress(steps):
+    """A progress callback printing a line every PROGRESS_STEP percent."""
+    def progress(filename, done, total):
+        step = done * 100 // total // PROGRESS_STEP if total else 0
+        if step > steps.get(filename, 0) and done < total:
+            steps[filename] = step
+            print(f"  [{filename}] {step * PROGRESS_STEP}% ({done:,} of {total:,} bytes)")
+    return progress
+
+async def download(client, filename, protocol, offset, length, streams):
+    """Run one download alongside the chat and report how it went."""
+    protocol_name = protocol.upper()
+    try:
+        result = await client.download(filename, protocol, offset, length, streams,
+                                       progress=show_progress({}))
+    except DownloadError as e:
+        print(f"\n[Error] {filename}: {e}")
+        return
+    except Exception as e:
+        print(f"\nError downloading {filename} via {protocol_name}: {e}")
+        partpath = os.path.join(user_dir, filename) + '.part'
+        if os.path.exists(partpath):
+            print(f"[Partial] kept in {partpath}; /download again to resume")
+        return
+    fetched, reused, elapsed = result['fetched'], result['reused'], result['elapsed']
+    rate = (f", {fetched / elapsed / 1e6:.1f} MB/s over {result['streams']} stream(s)"
+            if result['streams'] and elapsed else "")
+    if result['complete']:
+        print(f"\n[Downloaded] {filename} via {protocol_name} - {result['size']} bytes "
+              f"({fetched:,} fetched, {reused:,} already here{rate})")
+    else:
+        start, end = result['offset'], result['offset'] + result['length']
+        print(f"\n[Downloaded] bytes {start}-{end} of {filename} via {protocol_name} "
+              f"({fetched:,} fetched, {reused:,} already here{rate})")
+    print(f"[Saved to] {result['path']}")
+
+async def upload(client, path, filename):
+    """Run one upload alongside the chat and report how it went."""
+    try:
+        result = await client.upload(path, filename, progress=show_progress({}))
+    except UploadError as e:
+        print(f"\n[Error] {filename or os.path.basename(path)}: {e}")
+        return
+    except Exception as e:
+        print(f"\nError uploading {path}: {e}")
+        return
+    size, elapsed = result['size'], result['elapsed']
+    rate = f", {size / elapsed / 1e6:.1f} MB/s" if elapsed else ""
+    print(f"\n[Uploaded] {path} as {result['filename']} - {size} bytes{rate}")
 
-    while running:
+async def reconnect(client):
+    """After the connection dropped: resume the session, retrying with backoff."""
+    print("\n[Disconnected] Reconnecting...")
+    for delay in RECONNECT_DELAYS:
+        await asyncio.sleep(delay)
         try:
-            message = client.recv(1024).decode('utf-8')
-            if not message:
-                break
-            if message == 'NICK':
-                client.send(nickname.encode('utf-8'))
-            elif message == 'FILES_LIST_START':
-                files_list = []
-                collecting_files = True
-            elif message == 'FILES_LIST_END':
-                collecting_files = False
-                if files_list:
-                    print("\n=== Available Files ===")
-                    for fname, fsize in files_list:
-                        print(f"{fname:30} - {fsize:,} bytes")
-                    print("=======================")
-                    print("Use: /download <filename> <tcp|udp>")
-            elif collecting_files and message.startswith('FILE:'):
-                parts = message.split(':', 2)
-                if len(parts) == 3:
-                    files_list.append((parts[1], int(parts[2])))
-            elif message.startswith('FILE_START:'):
-                parts = message.split(':', 2)
-                if len(parts) == 3:
-                    filename = parts[1].strip()
-                    filesize = int(parts[2])
-                    receiving_file = True
-                    receive_file_tcp(filename, filesize)
-            elif message.startswith('FILE_ERROR:'):
-                error = message.split(':', 1)[1]
-                print(f"\n[Error] {error}")
-            elif message.startswith('UDP_INFO:'):
-                parts = message.split(':')
-                if len(parts) == 4:
-                    udp_host = parts[1]
-                    udp_port = int(parts[2])
-                    filename = parts[3].strip()
-                    threading.Thread(target=receive_file_udp, args=(udp_host, udp_port, filename), daemon=True).start()
-            else:
-                if not receiving_file:
-                    display(message)
-        except:
+            await client.reconnect()
+        except OSError:
+            continue
+        print("[Reconnected]")
+        return True
+    print("Could not reach the server.")
+    return False
+
+def parse_download(text):
+    """(filename, protocol, offset, length, streams) from a /download line, or None."""
+    parts = text.split()[1:]
+    streams = 1
+    if '-n' in parts[:-1]:
+        i = parts.index('-n')
+        if not parts[i + 1].isdigit():
+            return None
+        streams = int(parts[i + 1])
+        del parts[i:i + 2]
+    if len(parts) < 2 or parts[1].lower() not in ('tcp', 'udp'):
+        return None
+    try:
+        offset = int(parts[2]) if len(parts) > 2 else 0
+        length = int(parts[3]) if len(parts) > 3 else 0
+    except ValueError:
+        return None
+    return parts[0], parts[1].lower(), offset, length, streams
+
+def show_help():
+    print("\n=== Commands ===")
+    print("/msg <nickname> <message>    - Send private message")
+    print("/join <group>                - Join a group")
+    print("/leave <group>               - Leave a group")
+    print("/group <group> <message>     - Send message to group")
+    print("/users [group]               - List who is online (everyone or a group)")
+    print("/presence <all|off|groups>   - Choose whose joins and leaves you see")
+    print("/history [#group|@nick] [n]  - Show stored messages (add 'before <id>' or 'since <HH:MM>')")
+    print("/files [prefix|glob] [page]  - List available files")
+    print("/download <file> <tcp|udp>   - Download file (resumes a partial one)")
+    print("/download <file> <tcp|udp> <offset> [length] - Download a byte range")
+    print("/download <file> <tcp|udp> -n <streams>        - Download over parallel streams")
+    print("/upload <path> [name]        - Share a file of yours with everyone")
+    print("/help                        - Show this help")
+    print("/quit                        - Exit chat")
+    print("================")
+
+def read_input(loop, lines):
+    """Blocking stdin reader on its own thread, handing each line to the event loop."""
+    while True:
+        try:
+            text = input()
+        except EOFError:
+            text = '/quit'
+        loop.call_soon_threadsafe(lines.put_nowait, text)
+        if text == '/quit':
             break
-    client.close()
 
-def write():
-    global running
-    while running:
-        text = input()
+async def main():
+    client = ChatClient(nickname, server_host, server_port, user_dir,
+                        compression_mode, protocol_mode, on_message=handle_line,
+                        admin_token=admin_token)
+    await client.connect()
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    threading.Thread(target=read_input, args=(loop, lines), daemon=True).start()
+    transfers = set()
+
+    while client.connected:
+        getter = asyncio.ensure_future(lines.get())
+        await asyncio.wait([getter, client.read_task], return_when=asyncio.FIRST_COMPLETED)
+        if not getter.done():
+            getter.cancel()
+            # Connection lost: the typed lines wait in the queue meanwhile
+            if not await reconnect(client):
+                break
+            continue
+        text = getter.result()
         if text == '/quit':
-            running = False
-            client.close()
             print("You have left the chat.")
             break
         elif text == '/help':
-            print("\n=== Commands ===")
-            print("/msg <nickname> <message>    - Send private message")
-            print("/join <group>                - Join a group")
-            print("/leave <group>               - Leave a group")
-            print("/group <group> <message>     - Send message to group")
-            print("/files                       - List available files")
-            print("/download <file> <tcp|udp>   - Download file")
-            print("/help                        - Show this help")
-            print("/quit                        - Exit chat")
-            print("================")
-        else:
+            show_help()
+        elif text.startswith('/download '):
+            args = parse_download(text)
+            if args is None:
+                client.send(text)  # the server explains the usage
+            else:
+                # Runs next to the chat; any number may be in flight
+                task = asyncio.ensure_future(download(client, *args))
+                transfers.add(task)
+                task.add_done_callback(transfers.discard)
+        elif text.startswith('/upload '):
+            args = text.split()[1:]
+            if not 1 <= len(args) <= 2 or not os.path.isfile(args[0]):
+                print("\n[Error] Usage: /upload <path to a file> [name to share it as]")
+            else:
+                task = asyncio.ensure_future(upload(client, args[0], args[1] if len(args) > 1 else None))
+                transfers.add(task)
+                task.add_done_callback(transfers.discard)
+        elif text:
             # Only send message, do NOT print locally
-            client.send(f"{nickname}: {text}".encode('utf-8'))
+            client.send(text)
+    await client.close()
+    for task in transfers:
+        task.cancel()
 
-thread_receive = threading.Thread(target=receive)
-thread_receive.start()
-
-thread_write = threading.Thread(target=write)
-thread_write.start()
\ No newline at end of file
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
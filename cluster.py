@@ -0,0 +1,271 @@
+"""
+Cluster mode: several server nodes sharing users and groups over a bus.
+
+Every node keeps serving its own clients from its own registry and tells
+the others, over the bus (see bus.py), who connected, who left and who
+joined which group. From that each node knows where every remote user is
+and which nodes have members in a group, so:
+
+- broadcasts go out once on the 'chat' topic and every node fans them
+  out to its own users;
+- /group messages go out once on 'group.<name>', which only nodes with
+  local members of that group subscribe to, and only if some other node
+  has members at all;
+- /msg to a user on another node goes straight to that node's own
+  'node.<id>' topic.
+
+Chat frames cross the bus already encoded, so a receiving node queues the
+same bytes to all its users without re-encoding. Control messages
+(presence and private messages) are small JSON objects.
+
+A node joining announces itself with 'hello' and every other node answers
+with a snapshot of its users and groups; a node shutting down says 'bye'.
+A node that dies without saying goodbye keeps its users listed until it
+comes back under the same id and says hello again.
+"""
+import json
+import threading
+
+CHAT = 'chat'
+PRESENCE = 'presence'
+
+
+def group_topic(group):
+    return f"group.{group}"
+
+
+def node_topic(node_id):
+    return f"node.{node_id}"
+
+
+class Cluster:
+    """This node's end of the cluster and its view of all the others."""
+
+    def __init__(self, bus, node_id, on_broadcast, on_group, on_private, on_presence=None):
+        """
+        on_broadcast(frame, channel), on_group(group, frame, channel) and
+        on_private(nick, sender, line) deliver messages from other nodes to
+        local users; channel is the history channel to log under, or None.
+        on_presence(change, nick, groups), if given, hears about remote users
+        as they come ('online'), go ('offline', with the groups they were
+        in) and join or leave groups ('joined', 'left').
+        """
+        self.bus = bus
+        self.node_id = node_id
+        self.on_broadcast = on_broadcast
+        self.on_group = on_group
+        self.on_private = on_private
+        self.on_presence = on_presence
+        self.users = {}         # remote nick -> node id
+        self.nodes = {}         # remote node id -> set of nicks
+        self.groups = {}        # group -> {remote node id -> set of nicks}
+        self.local_groups = {}  # group -> set of local nicks
+        self.local_users = set()
+        self.lock = threading.Lock()
+        self.remote_messages = 0
+
+        bus.subscribe(CHAT, self._chat)
+        bus.subscribe(PRESENCE, self._presence)
+        bus.subscribe(node_topic(node_id), self._direct)
+        self._publish(PRESENCE, op='hello')
+
+    def close(self):
+        self._publish(PRESENCE, op='bye')
+        self.bus.close()
+
+    # Local events, published to the other nodes
+
+    def user_joined(self, nick):
+        with self.lock:
+            self.local_users.add(nick)
+        self._publish(PRESENCE, op='join', nick=nick)
+
+    def user_left(self, nick, groups):
+        """A local user disconnected; groups are the ones it was still in."""
+        with self.lock:
+            self.local_users.discard(nick)
+        for group in groups:
+            self._local_group_change(group, nick, False)
+        self._publish(PRESENCE, op='leave', nick=nick, groups=sorted(groups))
+
+    def group_joined(self, group, nick):
+        self._local_group_change(group, nick, True)
+        self._publish(PRESENCE, op='group', nick=nick, group=group)
+
+    def group_left(self, group, nick):
+        self._local_group_change(group, nick, False)
+        self._publish(PRESENCE, op='ungroup', nick=nick, group=group)
+
+    def _local_group_change(self, group, nick, joined):
+        """Track local membership and hold a subscription while it is non-empty."""
+        topic = group_topic(group)
+        with self.lock:
+            members = self.local_groups.get(group)
+            if joined:
+                if members is None:
+                    members = self.local_groups[group] = set()
+                    self.bus.subscribe(topic, self._group)
+                members.add(nick)
+            elif members is not None:
+                members.discard(nick)
+                if not members:
+                    del self.local_groups[group]
+                    self.bus.unsubscribe(topic)
+
+    # Outgoing messages
+
+    def broadcast(self, frame, channel=None):
+        self.bus.publish(CHAT, self._pack(channel, frame))
+
+    def group(self, group, frame, channel=None):
+        """Hand a group message to the nodes that have members of group."""
+        if self.groups.get(group):
+            self.bus.publish(group_topic(group), self._pack(channel, frame))
+
+    def remote_users(self, group=None):
+        """Nicknames online on other nodes, or only the members of group."""
+        with self.lock:
+            if group is None:
+                return list(self.users)
+            return [nick for nicks in self.groups.get(group, {}).values() for nick in nicks]
+
+    def locate(self, nick):
+        """Node id of a remote user, or None."""
+        return self.users.get(nick)
+
+    def private(self, nick, sender, line):
+        """Route a /msg line to the node nick is on; False if nick is unknown."""
+        node_id = self.users.get(nick)
+        if node_id is None:
+            return False
+        self._publish(node_topic(node_id), op='msg', to=nick, sender=sender, line=line)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'node': self.node_id,
+                'nodes': {n: len(nicks) for n, nicks in self.nodes.items()},
+                'remote_users': len(self.users),
+                'groups': len(set(self.groups) | set(self.local_groups)),
+                'remote_messages': self.remote_messages,
+            }
+
+    # Bus handlers
+
+    @staticmethod
+    def _pack(channel, frame):
+        # Frames are handed on untouched behind a one-line channel header
+        return (channel or '').encode('utf-8') + b'\n' + frame
+
+    @staticmethod
+    def _unpack(payload):
+        end = payload.index(b'\n')
+        return str(payload[:end], 'utf-8') or None, payload[end + 1:]
+
+    def _chat(self, topic, payload):
+        channel, frame = self._unpack(payload)
+        self.remote_messages += 1
+        self.on_broadcast(frame, channel)
+
+    def _group(self, topic, payload):
+        channel, frame = self._unpack(payload)
+        self.remote_messages += 1
+        self.on_group(topic[len('group.'):], frame, channel)
+
+    def _publish(self, topic, **message):
+        message['node'] = self.node_id
+        self.bus.publish(topic, json.dumps(message).encode('utf-8'))
+
+    def _direct(self, topic, payload):
+        message = json.loads(payload)
+        if message['op'] == 'msg':
+            self.remote_messages += 1
+            self.on_private(message['to'], message['sender'], message['line'])
+        elif message['op'] == 'state':
+            with self.lock:
+                self._forget(message['node'])
+                for nick in message['users']:
+                    self._add_user(message['node'], nick)
+                for group, nicks in message['groups'].items():
+                    for nick in nicks:
+                        self._add_member(group, message['node'], nick)
+            if self.on_presence is not None:
+                groups_of = {}
+                for group, nicks in message['groups'].items():
+                    for nick in nicks:
+                        groups_of.setdefault(nick, []).append(group)
+                for nick in message['users']:
+                    self.on_presence('online', nick, groups_of.get(nick, ()))
+
+    def _presence(self, topic, payload):
+        message = json.loads(payload)
+        op, node_id = message['op'], message['node']
+        if node_id == self.node_id:
+            return
+        gone = ()
+        with self.lock:
+            if op == 'hello':
+                # A (re)started node: drop what it had and send it our side
+                self._forget(node_id)
+                state = {
+                    'users': sorted(self.local_users),
+                    'groups': {g: sorted(nicks) for g, nicks in self.local_groups.items()},
+                }
+            elif op == 'bye':
+                gone = [(nick, [g for g, by_node in self.groups.items() if nick in by_node.get(node_id, ())])
+                        for nick in self.nodes.get(node_id, ())]
+                self._forget(node_id)
+            elif op == 'join':
+                self._add_user(node_id, message['nick'])
+            elif op == 'leave':
+                for group in message['groups']:
+                    self._remove_member(group, node_id, message['nick'])
+                nicks = self.nodes.get(node_id)
+                if nicks is not None:
+                    nicks.discard(message['nick'])
+                if self.users.get(message['nick']) == node_id:
+                    del self.users[message['nick']]
+            elif op == 'group':
+                self._add_member(message['group'], node_id, message['nick'])
+            elif op == 'ungroup':
+                self._remove_member(message['group'], node_id, message['nick'])
+        if op == 'hello':
+            self._publish(node_topic(node_id), op='state', **state)
+        if self.on_presence is not None:
+            if op == 'join':
+                self.on_presence('online', message['nick'], ())
+            elif op == 'leave':
+                self.on_presence('offline', message['nick'], message['groups'])
+            elif op == 'group':
+                self.on_presence('joined', message['nick'], (message['group'],))
+            elif op == 'ungroup':
+                self.on_presence('left', message['nick'], (message['group'],))
+            for nick, groups in gone:
+                self.on_presence('offline', nick, groups)
+
+    def _add_user(self, node_id, nick):
+        self.nodes.setdefault(node_id, set()).add(nick)
+        self.users[nick] = node_id
+
+    def _add_member(self, group, node_id, nick):
+        self.groups.setdefault(group, {}).setdefault(node_id, set()).add(nick)
+
+    def _remove_member(self, group, node_id, nick):
+        by_node = self.groups.get(group)
+        if by_node is None or node_id not in by_node:
+            return
+        by_node[node_id].discard(nick)
+        if not by_node[node_id]:
+            del by_node[node_id]
+            if not by_node:
+                del self.groups[group]
+
+    def _forget(self, node_id):
+        """Drop everything known about a remote node."""
+        for nick in self.nodes.pop(node_id, ()):
+            if self.users.get(nick) == node_id:
+                del self.users[nick]
+        for group in list(self.groups):
+            if self.groups[group].pop(node_id, None) is not None and not self.groups[group]:
+                del self.groups[group]
@@ -0,0 +1,144 @@
+"""
+Chat commands: one table from command name and opcode to handler, and the
+compact binary form of a command.
+
+Every command has a fixed opcode that client and server agree on (OPCODES)
+and a handler called as fn(session, target, text). For commands that take
+a target (a nickname or a group) target is their first argument and text
+the rest of the line; for the others target is '' and text is everything
+after the command name. Plain chat is the command with opcode SAY.
+
+Text form: the usual "/msg bob hi" line in a TEXT frame; a line whose
+first word is not a known command is said to everyone.
+
+Binary form, offered to clients that ask with protocol=binary at the
+handshake: a CMD frame whose payload is
+
+    opcode (1 byte) | target length (1 byte) | target | text
+
+so the server dispatches on the opcode byte and slices out the target
+and text without scanning the line.
+"""
+import struct
+
+from framing import encode_frame, CMD
+
+BINARY = 'binary'
+HEAD = struct.Struct('!BB')
+
+SAY = 0
+# name -> (opcode, takes a target); opcodes are part of the wire format, never reuse one
+OPCODES = {
+    '/msg': (1, True),
+    '/join': (2, True),
+    '/leave': (3, True),
+    '/group': (4, True),
+    '/files': (5, False),
+    '/download': (6, False),
+    '/cache': (7, False),
+    '/history': (8, False),
+    '/cluster': (9, False),
+    '/queues': (10, False),
+    '/stats': (11, False),
+    '/upload': (12, False),
+    '/users': (13, False),
+    '/presence': (14, False),
+}
+
+
+class Command:
+    __slots__ = ('name', 'opcode', 'targeted', 'fn', 'label', 'limit', 'admin', 'blocking')
+
+    def __init__(self, name, opcode, targeted, fn, limit=None, admin=False, blocking=False):
+        self.name = name
+        self.opcode = opcode
+        self.targeted = targeted
+        self.fn = fn
+        self.label = name[1:] if name else 'broadcast'  # metrics label
+        self.limit = limit  # rate limit class (see ratelimit.py), None = only the per-connection one
+        self.admin = admin  # only for sessions that logged in with the admin token
+        self.blocking = blocking  # reads or stats the disk: kept off the asyncio event loop
+
+
+class CommandTable:
+    """Handlers by command name and by opcode, both O(1) lookups."""
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_opcode = [None] * 256
+
+    def register(self, name, fn, opcode=None, targeted=None, limit=None, admin=False,
+                 blocking=False):
+        """
+        Add a handler. name is '/word', or None for plain chat; opcode and
+        targeted default to the OPCODES entry for name. limit names the
+        rate limit class the command counts against; admin commands are
+        refused to everyone but admin sessions, and blocking ones (disk
+        work) run on a worker thread under the asyncio engine.
+        """
+        if name is None:
+            opcode, targeted = SAY, False
+        elif opcode is None:
+            opcode, targeted = OPCODES[name]
+        if self.by_opcode[opcode] is not None:
+            raise ValueError(f"opcode {opcode} is taken by {self.by_opcode[opcode].label}")
+        command = Command(name, opcode, bool(targeted), fn, limit, admin, blocking)
+        self.by_opcode[opcode] = command
+        if name is not None:
+            self.by_name[name] = command
+        return command
+
+    def command(self, name=None, **kw):
+        """Decorator form of register()."""
+        def decorate(fn):
+            self.register(name, fn, **kw)
+            return fn
+        return decorate
+
+    def parse_text(self, line):
+        """(command, target, text) for a text line; unknown commands are chat."""
+        if line[:1] == '/':
+            name, _, rest = line.partition(' ')
+            command = self.by_name.get(name)
+            if command is not None:
+                if command.targeted:
+                    target, _, rest = rest.strip().partition(' ')
+                    return command, target, rest.strip()
+                return command, '', rest.strip()
+        return self.by_opcode[SAY], '', line
+
+    def parse_binary(self, payload):
+        """
+        (command or None, target, text) for the payload of a CMD frame;
+        ValueError if it is too short for its header or target.
+        """
+        if len(payload) < HEAD.size:
+            raise ValueError(f"{len(payload)}-byte command frame, the header alone is {HEAD.size}")
+        opcode, size = HEAD.unpack_from(payload)
+        end = HEAD.size + size
+        if end > len(payload):
+            raise ValueError(f"{size}-byte target in a {len(payload)}-byte command frame")
+        target = str(payload[HEAD.size:end], 'utf-8', errors='ignore')
+        return self.by_opcode[opcode], target, str(payload[end:], 'utf-8', errors='ignore')
+
+
+def encode_command(opcode, target='', text=''):
+    """A CMD frame for one command."""
+    target = target.encode('utf-8')
+    if len(target) > 255:
+        raise ValueError("target longer than 255 bytes")
+    return encode_frame(HEAD.pack(opcode, len(target)) + target + text.encode('utf-8'), CMD)
+
+
+def encode_line(line):
+    """The CMD frame for a line a user typed, parsed by the OPCODES table."""
+    if line[:1] == '/':
+        name, _, rest = line.partition(' ')
+        spec = OPCODES.get(name)
+        if spec is not None:
+            opcode, targeted = spec
+            if targeted:
+                target, _, rest = rest.strip().partition(' ')
+                return encode_command(opcode, target, rest.strip())
+            return encode_command(opcode, '', rest.strip())
+    return encode_command(SAY, '', line)
@@ -0,0 +1,99 @@
+"""
+zlib compression for the chat stream and for TCP downloads.
+
+Chat: a client that asks for it at the NICK handshake gets everything the
+server sends after the COMPRESS reply as one raw-deflate stream. Writers
+compress each batch they send and end it with a sync flush, so every batch
+can be decoded the moment it arrives, and the dictionary carries over from
+batch to batch: repeated nicknames and phrases cost a few bits each. Frames
+are still encoded once per fan-out; only the per-connection writer pays
+for compression.
+
+Downloads: a client whose chat stream the server agreed to compress asks
+for zlib on its data connections too. Each range
+then goes out as frames of at most one manifest chunk, deflated (ZDATA)
+or, where deflating did not pay, as they are (DATA). Before compressing a
+file at all the server deflates a sample of it and sends the file raw if
+the sample does not shrink (media, archives and other compressed formats).
+"""
+import zlib
+
+from framing import encode_frame, DATA, ZDATA
+
+ZLIB = 'zlib'
+CHAT_LEVEL = 1   # the stream is compressed per connection; keep it cheap
+FILE_LEVEL = 6   # chunks of hot files are compressed once and cached
+SAMPLE_BYTES = 3 * 16 * 1024
+MIN_SAVING = 0.1  # compress a file only if its sample shrinks by a tenth
+
+
+def normalize(mode):
+    """A configured mode as negotiated: 'zlib', or '' for off ('off', '', anything else)."""
+    return ZLIB if (mode or '').strip().lower() == ZLIB else ''
+
+
+class StreamCompressor:
+    """Compressing end of one connection's chat stream."""
+    __slots__ = ('z', 'raw_bytes', 'packed_bytes')
+
+    def __init__(self, level=CHAT_LEVEL):
+        self.z = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.raw_bytes = 0
+        self.packed_bytes = 0
+
+    def pack(self, frames):
+        """Compress a batch of frames into bytes the peer can decode right away."""
+        data = b''.join(frames)
+        packed = self.z.compress(data) + self.z.flush(zlib.Z_SYNC_FLUSH)
+        self.raw_bytes += len(data)
+        self.packed_bytes += len(packed)
+        return packed
+
+
+class StreamDecompressor:
+    """Receiving end of a compressed chat stream."""
+
+    def __init__(self):
+        self.z = zlib.decompressobj(-15)
+
+    def unpack(self, data):
+        return self.z.decompress(data)
+
+
+def deflate(data, level=FILE_LEVEL):
+    z = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return z.compress(data) + z.flush()
+
+
+def inflate(data):
+    return zlib.decompress(data, -15)
+
+
+def pack_block(data, level=FILE_LEVEL):
+    """One download block as a frame: ZDATA if deflating saved space, else DATA."""
+    packed = deflate(data, level)
+    if len(packed) < len(data):
+        return encode_frame(packed, ZDATA)
+    return encode_frame(bytes(data), DATA)
+
+
+def unpack_block(kind, payload):
+    return inflate(payload) if kind == ZDATA else payload
+
+
+def worth_compressing(sample):
+    """Whether a sample of a file deflates by at least MIN_SAVING."""
+    if len(sample) < 256:
+        return False
+    return len(deflate(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def sample(read_at, size):
+    """
+    Up to SAMPLE_BYTES taken from the start, middle and end of a file;
+    read_at(offset, n) reads from it.
+    """
+    piece = SAMPLE_BYTES // 3
+    if size <= SAMPLE_BYTES:
+        return read_at(0, size)
+    return b''.join(read_at(offset, piece) for offset in (0, (size - piece) // 2, size - piece))
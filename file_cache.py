@@ -0,0 +1,162 @@
+"""
+Hot-file cache for downloads.
+
+Files are read into memory once and served to every later download from
+the same buffer (memoryview slices, no copies), so a whole class fetching
+the same lecture file costs one disk read instead of hundreds. Entries
+are evicted least-recently-used under a byte budget and dropped when the
+file's size or mtime changes.
+
+Buffers are pinned copies rather than mmaps: a shared file truncated in
+place while mapped would kill the server with SIGBUS.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+class CacheEntry:
+    """
+    One cached file: its contents and the stat() it was read under, plus
+    forms derived from them (compressed chunks) and whether it compresses.
+    """
+    __slots__ = ('path', 'size', 'mtime_ns', 'data', 'derived', 'derived_bytes', 'compressible')
+
+    def __init__(self, path, size, mtime_ns, data):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.data = memoryview(data).toreadonly()
+        self.derived = {}
+        self.derived_bytes = 0
+        self.compressible = None  # unknown until a compressed download samples it
+
+
+class FileCache:
+    """LRU cache of whole files, bounded by total bytes."""
+
+    def __init__(self, budget=DEFAULT_BUDGET, max_entry=None):
+        self.budget = budget
+        # One file may take at most a quarter of the budget so a single huge
+        # download cannot flush everything else
+        self.max_entry = budget // 4 if max_entry is None else max_entry
+        self.entries = OrderedDict()  # path -> CacheEntry, least recently used first
+        self.bytes = 0
+        self.loading = {}  # path -> Event set when the load finishes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes_served = 0
+
+    def get(self, path):
+        """
+        Cached entry for path, loading it on a miss; None if the file is
+        missing, empty or too big to cache (the caller reads from disk).
+        """
+        while True:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if not 0 < st.st_size <= self.max_entry:
+                return None
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None:
+                    if (entry.size, entry.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                        self.entries.move_to_end(path)
+                        self.hits += 1
+                        return entry
+                    self._drop(path)
+                    self.invalidations += 1
+                loading = self.loading.get(path)
+                if loading is None:
+                    self.loading[path] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is reading this file; use their copy when it lands
+            loading.wait()
+
+        try:
+            entry = self._load(path)
+        finally:
+            with self.lock:
+                self.loading.pop(path).set()
+        if entry is not None:
+            with self.lock:
+                self.entries[path] = entry
+                self.bytes += entry.size
+                while self.bytes > self.budget and len(self.entries) > 1:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+        return entry
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                st = os.fstat(f.fileno())
+                data = bytearray(st.st_size)
+                view = memoryview(data)
+                n = 0
+                while n < st.st_size:
+                    more = f.readinto(view[n:])
+                    if not more:
+                        return None  # shrank while we read it
+                    n += more
+        except OSError:
+            return None
+        return CacheEntry(path, st.st_size, st.st_mtime_ns, data)
+
+    def derive(self, entry, key, make):
+        """
+        Bytes derived from an entry's data (a compressed chunk, say),
+        computed by make() once and then kept with the entry, counted
+        against the budget, until the entry goes.
+        """
+        data = entry.derived.get(key)
+        if data is not None:
+            return data
+        data = make()
+        with self.lock:
+            if key not in entry.derived:
+                entry.derived[key] = data
+                entry.derived_bytes += len(data)
+                if self.entries.get(entry.path) is entry:
+                    self.bytes += len(data)
+                    while self.bytes > self.budget and len(self.entries) > 1:
+                        self._drop(next(iter(self.entries)))
+                        self.evictions += 1
+        return data
+
+    def _drop(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry.size + entry.derived_bytes
+
+    def invalidate(self, path):
+        with self.lock:
+            if path in self.entries:
+                self._drop(path)
+                self.invalidations += 1
+
+    def note_served(self, nbytes):
+        with self.lock:
+            self.bytes_served += nbytes
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'bytes_served': self.bytes_served,
+        }
@@ -0,0 +1,133 @@
+"""
+In-memory index of the shared files directory.
+
+Built with one os.scandir() pass and kept as a sorted name list plus a
+name -> (size, mtime) dict, so /files answers from memory: prefixes are a
+bisect, globs only scan the names they could match, and pages are slices.
+
+The index refreshes lazily. At most once per poll interval a query stats
+the directory; a changed directory mtime (files added, removed or renamed)
+triggers a rescan, and a periodic full rescan picks up files rewritten in
+place. Code that changes the directory itself can call invalidate().
+"""
+import bisect
+import fnmatch
+import os
+import threading
+import time
+
+POLL_INTERVAL = 1.0     # seconds between directory mtime checks
+RESCAN_INTERVAL = 30.0  # full rescan even if the directory looks unchanged
+PAGE_SIZE = 50
+GLOB_CHARS = '*?['
+
+
+class FileIndex:
+    """
+    Sorted, cached listing of the regular files in one directory; names in
+    hidden (e.g. a staging area for files still arriving) are never listed.
+    """
+
+    def __init__(self, directory, poll_interval=POLL_INTERVAL, rescan_interval=RESCAN_INTERVAL,
+                 hidden=()):
+        self.directory = directory
+        self.hidden = frozenset(hidden)
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.names = []    # sorted
+        self.entries = {}  # name -> (size, mtime_ns)
+        self.dir_mtime = None
+        self.checked = float('-inf')
+        self.scanned = float('-inf')
+        self.scans = 0
+        self.lock = threading.Lock()  # one refresher at a time
+
+    def scan(self):
+        """Rebuild the index from one scandir() pass and swap it in."""
+        entries = {}
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name in self.hidden:
+                        continue
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        pass  # removed while we were scanning
+        except OSError:
+            dir_mtime = None
+        names = sorted(entries)
+        # Readers may hold the old list and dict; both are replaced, never mutated
+        self.entries, self.names = entries, names
+        self.dir_mtime = dir_mtime
+        self.scanned = time.monotonic()
+        self.scans += 1
+
+    def refresh(self):
+        """Rescan if the directory changed or the index is due a full rescan."""
+        now = time.monotonic()
+        if now - self.checked < self.poll_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return  # someone else is refreshing; serve the current snapshot
+        try:
+            self.checked = now
+            try:
+                dir_mtime = os.stat(self.directory).st_mtime_ns
+            except OSError:
+                dir_mtime = None
+            if dir_mtime != self.dir_mtime or now - self.scanned >= self.rescan_interval:
+                self.scan()
+        finally:
+            self.lock.release()
+
+    def invalidate(self):
+        """Force a rescan on the next query."""
+        self.checked = float('-inf')
+        self.scanned = float('-inf')
+
+    def __len__(self):
+        self.refresh()
+        return len(self.names)
+
+    def get(self, name):
+        """(size, mtime_ns) for name, or None."""
+        self.refresh()
+        return self.entries.get(name)
+
+    def matching(self, pattern=''):
+        """
+        Sorted names matching pattern: a glob if it contains *, ? or [,
+        otherwise a plain prefix. The literal part before the first glob
+        character narrows the scan with bisect either way.
+        """
+        self.refresh()
+        names = self.names
+        cut = min((pattern.find(c) for c in GLOB_CHARS if c in pattern), default=-1)
+        prefix = pattern if cut < 0 else pattern[:cut]
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + '\U0010ffff') if prefix else len(names)
+        if cut < 0:
+            return names[lo:hi]
+        return [n for n in names[lo:hi] if fnmatch.fnmatchcase(n, pattern)]
+
+    def page(self, pattern='', page=1, page_size=PAGE_SIZE):
+        """
+        One page of matches as (items, page, pages, total), items being
+        (name, size) pairs. Out-of-range page numbers are clamped.
+        """
+        names = self.matching(pattern)
+        entries = self.entries
+        total = len(names)
+        pages = max(1, -(-total // page_size))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * page_size
+        items = []
+        for name in names[start:start + page_size]:
+            entry = entries.get(name)
+            if entry is not None:
+                items.append((name, entry[0]))
+        return items, page, pages, total
@@ -0,0 +1,129 @@
+"""
+Length-prefixed framing for the chat protocol.
+
+Every message on a TCP chat connection is one frame: a 1-byte kind, a
+4-byte big-endian payload length, then the payload. TEXT frames carry
+UTF-8 protocol lines, DATA frames carry raw file bytes, ZDATA frames
+carry raw-deflate compressed file bytes (see compression.py), CMD
+frames carry chat commands in the binary form of commands.py and empty
+PING / PONG frames are the server's heartbeat and the client's answer.
+"""
+import struct
+
+HEADER = struct.Struct('!BI')
+HEADER_SIZE = HEADER.size
+
+TEXT = 1
+DATA = 2
+ZDATA = 3
+CMD = 4
+PING = 5
+PONG = 6
+
+MAX_FRAME = 16 * 1024 * 1024
+MIN_READ = 1024
+
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame we refuse to decode."""
+
+
+def encode_frame(payload, kind=TEXT):
+    """Return header + payload as one bytes object ready for sendall()."""
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def encode_text(text):
+    """Encode a protocol line as a TEXT frame."""
+    return encode_frame(text.encode('utf-8'))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder over a single reusable bytearray.
+
+    Bytes are read straight into the buffer (recv_into / BufferedProtocol)
+    and frames() yields (kind, memoryview) slices of it, so payloads are
+    never copied. A yielded payload is only valid until the decoder is
+    given more data; copy it (bytes(payload)) if it must live longer.
+    """
+
+    def __init__(self, size=4096, max_frame=MAX_FRAME):
+        self._initial = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._want = 0
+        self.max_frame = max_frame
+
+    def pending(self):
+        """Number of buffered bytes not yet returned as frames."""
+        return self._end - self._start
+
+    def _reserve(self, n):
+        """Make room for at least n more bytes after the buffered data."""
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self._initial and n <= self._initial:
+                # Give back memory a large frame made us grab
+                self._buf = bytearray(self._initial)
+                self._view = memoryview(self._buf)
+        if len(self._buf) - self._end >= n:
+            return
+        pending = self._end - self._start
+        if pending + n <= len(self._buf):
+            # Slide the partial frame to the front (memmove, no resize)
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            buf = bytearray(max(pending + n, 2 * len(self._buf)))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def get_buffer(self, sizehint=-1):
+        """Writable view of free space; pair with buffer_updated()."""
+        self._reserve(max(self._want, sizehint, MIN_READ))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def feed(self, data):
+        """Append bytes that were received somewhere else."""
+        n = len(data)
+        self._reserve(n)
+        self._view[self._end:self._end + n] = data
+        self._end += n
+
+    def recv_into(self, sock):
+        """Read once from sock into the buffer; returns 0 on EOF."""
+        n = sock.recv_into(self.get_buffer())
+        self._end += n
+        return n
+
+    def drain(self):
+        """Return and forget buffered bytes, e.g. when a stream switches to raw data."""
+        data = bytes(self._view[self._start:self._end])
+        self._start = self._end = 0
+        return data
+
+    def frames(self):
+        """Yield every complete (kind, payload) frame currently buffered."""
+        while True:
+            pending = self._end - self._start
+            if pending < HEADER_SIZE:
+                self._want = HEADER_SIZE - pending
+                return
+            kind, length = HEADER.unpack_from(self._buf, self._start)
+            if length > self.max_frame:
+                raise FrameError(f"frame of {length} bytes exceeds {self.max_frame}")
+            if pending < HEADER_SIZE + length:
+                self._want = HEADER_SIZE + length - pending
+                return
+            start = self._start + HEADER_SIZE
+            self._start = start + length
+            self._want = 0
+            yield kind, self._view[start:start + length]
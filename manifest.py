@@ -0,0 +1,151 @@
+"""
+Per-chunk hash manifests for resumable downloads.
+
+The server splits every shared file into fixed-size chunks and hashes each
+one. Clients check their partial download against the manifest, fetch only
+the byte ranges whose chunks are missing or wrong, and check the result.
+"""
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 16  # bytes of BLAKE2b per chunk
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def build(filepath, chunk_size=CHUNK_SIZE):
+    """Digests of every chunk of filepath, in order."""
+    digests = []
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(filepath, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            while n < chunk_size:
+                # readinto() may return short before EOF; fill the chunk
+                more = f.readinto(view[n:])
+                if not more:
+                    break
+                n += more
+            digests.append(chunk_digest(view[:n]))
+    return digests
+
+
+def encode(digests):
+    return b''.join(digests).hex()
+
+
+def decode(text):
+    raw = bytes.fromhex(text)
+    return [raw[i:i + DIGEST_SIZE] for i in range(0, len(raw), DIGEST_SIZE)]
+
+
+def verify(filepath, size, digests, chunk_size=CHUNK_SIZE, indices=None):
+    """
+    Which chunks of a local copy match the manifest. Returns one bool per
+    chunk; a missing or short file simply fails the chunks it lacks. With
+    indices, only those chunks are read and the rest are reported False.
+    """
+    good = [False] * len(digests)
+    try:
+        f = open(filepath, 'rb', buffering=0)
+    except OSError:
+        return good
+    with f:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        for i in (range(len(digests)) if indices is None else indices):
+            start = i * chunk_size
+            want = min(chunk_size, size - start)
+            n = 0
+            while n < want:
+                more = _read_at(f, view[n:want], start + n)
+                if not more:
+                    break
+                n += more
+            good[i] = n == want and chunk_digest(view[:n]) == digests[i]
+    return good
+
+
+def _read_at(f, view, offset):
+    """Positioned readinto(); preadv() where the platform has it."""
+    if hasattr(os, 'preadv'):
+        return os.preadv(f.fileno(), [view], offset)
+    f.seek(offset)
+    return f.readinto(view)
+
+
+def missing_ranges(good, size, chunk_size=CHUNK_SIZE, offset=0, length=None):
+    """
+    Coalesced (offset, length) byte ranges of the bad chunks, restricted to
+    the byte range [offset, offset + length).
+    """
+    end = size if length is None else min(size, offset + length)
+    ranges = []
+    for i, ok in enumerate(good):
+        start = max(i * chunk_size, offset)
+        stop = min((i + 1) * chunk_size, end)
+        if ok or start >= stop:
+            continue
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + stop - start)
+        else:
+            ranges.append((start, stop - start))
+    return ranges
+
+
+def split_ranges(ranges, parts, align=CHUNK_SIZE):
+    """
+    Divide byte ranges into at most `parts` lists of roughly equal total
+    size, cutting only at multiples of align, for parallel fetching.
+    """
+    total = sum(size for _, size in ranges)
+    if parts <= 1 or total <= align:
+        return [list(ranges)] if ranges else []
+    share = -(-total // parts)
+    share = -(-share // align) * align  # round up to a whole chunk
+    buckets = [[]]
+    room = share
+    for start, size in ranges:
+        while size:
+            if not room:
+                buckets.append([])
+                room = share
+            take = min(size, room)
+            if take < size:
+                # Cut on a chunk boundary where possible
+                cut = (start + take) // align * align
+                if cut > start:
+                    take = cut - start
+            buckets[-1].append((start, take))
+            start += take
+            size -= take
+            room = max(0, room - take)
+    return buckets
+
+
+class ManifestCache:
+    """Manifests by path, rebuilt when the file's size or mtime changes."""
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.entries = {}  # path -> (size, mtime_ns, digests)
+        self.lock = threading.Lock()
+
+    def get(self, filepath):
+        """Return (size, digests) for filepath, hashing it only if it changed."""
+        st = os.stat(filepath)
+        with self.lock:
+            entry = self.entries.get(filepath)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+            return entry[0], entry[2]
+        digests = build(filepath, self.chunk_size)
+        with self.lock:
+            self.entries[filepath] = (st.st_size, st.st_mtime_ns, digests)
+        return st.st_size, digests
@@ -0,0 +1,423 @@
+"""
+Persistent chat history: a segmented, append-only message log.
+
+Every logged message gets a sequential offset and is appended as one record
+to the newest segment file. Appends only queue the record; a writer thread
+writes whatever piled up together and fsync()s once per batch (group
+commit), so chat never waits on the disk and a burst costs a single flush.
+
+Each segment has a sparse index (an entry every INDEX_INTERVAL bytes mapping
+offset and timestamp to a file position) and, per channel, the numbers of
+the index blocks holding its records, so history() reads only the blocks
+that mention the channel: a quiet group costs a few block reads however
+busy the rest of the log is. The channel map is kept in a .channels file
+next to the segment, one `<channel>\t<block> <block> ...` line each.
+
+Disk use is bounded: segments roll at a fixed size or age, the oldest are
+deleted once the log exceeds its byte budget or retention age, and runs of
+small sealed segments (quiet days) are compacted into one, minus expired
+records.
+
+Record: length (u32) and CRC32 (u32) of the rest, offset (u64), timestamp
+(f64), channel length (u16), channel, UTF-8 text. A torn record at the end
+of the newest segment (crash mid-write) is cut off when the log is opened.
+"""
+import bisect
+import os
+import struct
+import threading
+import time
+import zlib
+
+PREFIX = struct.Struct('!II')       # length, crc32 of everything after it
+BODY = struct.Struct('!QdH')        # offset, timestamp, channel length
+INDEX_ENTRY = struct.Struct('!QdI')  # offset, timestamp, position in segment
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+SEGMENT_AGE = 24 * 3600.0  # quiet servers still roll daily so old days can expire
+INDEX_INTERVAL = 4096
+COMMIT_INTERVAL = 0.005  # seconds a commit waits for more records
+MAX_BYTES = 256 * 1024 * 1024
+RETENTION = 7 * 24 * 3600.0
+COMPACT_BELOW = SEGMENT_BYTES // 4  # sealed segments smaller than this get merged
+
+
+def encode_record(offset, timestamp, channel, text):
+    channel = channel.encode('utf-8')
+    body = BODY.pack(offset, timestamp, len(channel)) + channel + text.encode('utf-8')
+    return PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+def parse_records(data, start=0):
+    """
+    Yield (position, offset, timestamp, channel bytes, text bytes) for each
+    intact record in data; stops at the first torn or corrupt one.
+    """
+    end = len(data)
+    pos = start
+    while pos + PREFIX.size <= end:
+        length, crc = PREFIX.unpack_from(data, pos)
+        body_start = pos + PREFIX.size
+        if length < BODY.size or body_start + length > end:
+            return
+        body = data[body_start:body_start + length]
+        if zlib.crc32(body) != crc:
+            return
+        offset, timestamp, channel_len = BODY.unpack_from(body)
+        channel = bytes(body[BODY.size:BODY.size + channel_len])
+        yield pos, offset, timestamp, channel, body[BODY.size + channel_len:]
+        pos = body_start + length
+
+
+class Segment:
+    """One log file plus its sparse index and per-channel block lists."""
+    __slots__ = ('base', 'path', 'index_path', 'channels_path', 'size', 'index',
+                 'channels', 'first_ts', 'last_ts', 'next_offset', 'f', 'index_f')
+
+    def __init__(self, directory, base):
+        self.base = base
+        stem = os.path.join(directory, f"{base:020d}")
+        self.path = stem + '.log'
+        self.index_path = stem + '.index'
+        self.channels_path = stem + '.channels'
+        self.size = 0
+        self.index = []       # [(offset, timestamp, position)], every INDEX_INTERVAL bytes
+        self.channels = {}    # channel -> numbers of the index blocks holding its records
+        self.first_ts = None
+        self.last_ts = None
+        self.next_offset = base
+        self.f = None         # append handles, only while the segment is active
+        self.index_f = None
+
+    def note(self, position, offset, timestamp, channel, length):
+        """Account for a record written at position."""
+        if not self.index or position - self.index[-1][2] >= INDEX_INTERVAL:
+            self.index.append((offset, timestamp, position))
+            if self.index_f is not None:
+                self.index_f.write(INDEX_ENTRY.pack(offset, timestamp, position))
+        block = len(self.index) - 1
+        blocks = self.channels.get(channel)
+        if blocks is None:
+            self.channels[channel] = [block]
+        elif blocks[-1] != block:
+            blocks.append(block)
+        if self.first_ts is None:
+            self.first_ts = timestamp
+        self.last_ts = timestamp
+        self.next_offset = offset + 1
+        self.size = position + length
+
+    def open_for_append(self):
+        self.f = open(self.path, 'ab')
+        self.index_f = open(self.index_path, 'ab')
+
+    def save_channels(self):
+        with open(self.channels_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(f"{c.decode('utf-8')}\t{' '.join(map(str, self.channels[c]))}"
+                              for c in sorted(self.channels)))
+
+    def seal(self):
+        """Make the segment read-only: flush its index and record its channels."""
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.index_f.flush()
+        os.fsync(self.index_f.fileno())
+        self.index_f.close()
+        self.f = self.index_f = None
+        self.save_channels()
+
+    def delete(self):
+        for path in (self.path, self.index_path, self.channels_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def scan(self, truncate=False):
+        """Rebuild size, index, channels and timestamps by reading the file."""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.size = 0
+        self.index = []
+        self.channels = {}
+        self.first_ts = self.last_ts = None
+        self.next_offset = self.base
+        for pos, offset, timestamp, channel, text in parse_records(data):
+            self.note(pos, offset, timestamp, channel, PREFIX.size + BODY.size
+                      + len(channel) + len(text))
+        if truncate and self.size < len(data):
+            # Torn write from a crash: drop the partial record
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.size)
+        with open(self.index_path, 'wb') as f:
+            for entry in self.index:
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def load(self):
+        """
+        Load a sealed segment from its index and channel files; False if the
+        channel file predates block lists and the segment needs a scan().
+        """
+        with open(self.index_path, 'rb') as f:
+            raw = f.read()
+        self.index = [INDEX_ENTRY.unpack_from(raw, i)
+                      for i in range(0, len(raw) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        self.channels = {}
+        with open(self.channels_path, encoding='utf-8') as f:
+            for line in f.read().split('\n'):
+                if not line:
+                    continue
+                channel, tab, blocks = line.rpartition('\t')
+                if not tab:
+                    return False
+                self.channels[channel.encode('utf-8')] = [int(b) for b in blocks.split()]
+        self.size = os.path.getsize(self.path)
+        if not self.index:
+            return
+        self.first_ts = self.index[0][1]
+        # Only the last block needs reading to find the final record
+        with open(self.path, 'rb') as f:
+            f.seek(self.index[-1][2])
+            tail = f.read()
+        self.last_ts = self.index[-1][1]
+        self.next_offset = self.index[-1][0] + 1
+        for _, offset, timestamp, _, _ in parse_records(tail):
+            self.last_ts = timestamp
+            self.next_offset = offset + 1
+        return True
+
+
+class MessageLog:
+    """Append-only, segmented message store with group commit."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_BYTES,
+                 retention=RETENTION, commit_interval=COMMIT_INTERVAL, segment_age=SEGMENT_AGE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()  # guards segments and their index/size
+        self.cond = threading.Condition(threading.Lock())  # guards pending and committed
+        self.pending = []  # (offset, timestamp, channel, encoded record)
+        self.closed = False
+        self.commits = 0
+        self.records_committed = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = self._open_segments()
+        self.next_offset = self.segments[-1].next_offset
+        self.committed = self.next_offset  # every offset below this is on disk
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _open_segments(self):
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        segments = []
+        for i, base in enumerate(bases):
+            segment = Segment(self.directory, base)
+            last = i == len(bases) - 1
+            if not last and os.path.exists(segment.channels_path) and os.path.exists(segment.index_path):
+                if not segment.load():
+                    segment.scan()
+                    segment.save_channels()
+            else:
+                segment.scan(truncate=last)
+                if not last:
+                    segment.seal()
+            segments.append(segment)
+        if not segments:
+            segments.append(Segment(self.directory, 0))
+        segments[-1].open_for_append()
+        return segments
+
+    def append(self, channel, text, timestamp=None):
+        """Queue a message for the next group commit; returns its offset."""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.cond:
+            if self.closed:
+                return None
+            offset = self.next_offset
+            self.next_offset += 1
+            self.pending.append((offset, timestamp, channel.encode('utf-8'),
+                                 encode_record(offset, timestamp, channel, text)))
+            if len(self.pending) == 1:
+                self.cond.notify()
+        return offset
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending and self.closed:
+                    return
+            # Let the batch grow for a moment, then commit it in one go
+            time.sleep(self.commit_interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            self._commit(batch)
+
+    def _commit(self, batch):
+        segment = self.segments[-1]
+        rolled = False
+        with self.lock:
+            for offset, timestamp, channel, record in batch:
+                too_big = segment.size + len(record) > self.segment_bytes
+                too_old = segment.first_ts is not None and timestamp - segment.first_ts > self.segment_age
+                if segment.size and (too_big or too_old):
+                    segment.seal()
+                    segment = Segment(self.directory, offset)
+                    segment.open_for_append()
+                    self.segments.append(segment)
+                    rolled = True
+                segment.note(segment.size, offset, timestamp, channel, len(record))
+                segment.f.write(record)
+            segment.f.flush()
+        os.fsync(segment.f.fileno())
+        segment.index_f.flush()
+        with self.cond:
+            self.committed = batch[-1][0] + 1
+            self.commits += 1
+            self.records_committed += len(batch)
+            self.cond.notify_all()
+        if rolled:
+            self._enforce_limits()
+
+    def flush(self):
+        """Block until everything appended so far is on disk."""
+        with self.cond:
+            target = self.next_offset
+            while self.committed < target and not self.closed:
+                self.cond.wait()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        with self.lock:
+            self.segments[-1].seal()
+
+    def disk_bytes(self):
+        return sum(s.size for s in self.segments)
+
+    def _enforce_limits(self):
+        """Rotation and compaction; runs on the writer thread after a roll."""
+        cutoff = time.time() - self.retention
+        with self.lock:
+            sealed = self.segments[:-1]
+            total = self.disk_bytes()
+            doomed = []
+            for segment in sealed:
+                expired = segment.last_ts is not None and segment.last_ts < cutoff
+                if total > self.max_bytes or expired:
+                    doomed.append(segment)
+                    total -= segment.size
+                else:
+                    break
+            self.segments = self.segments[len(doomed):]
+        for segment in doomed:
+            segment.delete()
+        self._compact(cutoff)
+
+    def _compact(self, cutoff):
+        """Merge runs of small sealed segments, dropping expired records."""
+        with self.lock:
+            sealed = self.segments[:-1]
+        i = 0
+        while i < len(sealed):
+            run = [sealed[i]]
+            size = run[0].size
+            if size < COMPACT_BELOW:
+                while (i + len(run) < len(sealed) and sealed[i + len(run)].size < COMPACT_BELOW
+                       and size + sealed[i + len(run)].size <= self.segment_bytes):
+                    run.append(sealed[i + len(run)])
+                    size += run[-1].size
+            if len(run) > 1:
+                self._merge(run, cutoff)
+            i += len(run)
+
+    def _merge(self, run, cutoff):
+        merged = Segment(self.directory, run[0].base)
+        tmp = merged.path + '.compact'
+        with open(tmp, 'wb') as out:
+            for segment in run:
+                with open(segment.path, 'rb') as f:
+                    data = f.read()
+                for pos, offset, timestamp, channel, text in parse_records(data):
+                    if timestamp >= cutoff:
+                        record = data[pos:pos + PREFIX.size + BODY.size + len(channel) + len(text)]
+                        merged.note(out.tell(), offset, timestamp, channel, len(record))
+                        out.write(record)
+            out.flush()
+            os.fsync(out.fileno())
+        with self.lock:
+            # Readers that already opened the old files keep reading them
+            os.replace(tmp, merged.path)
+            with open(merged.index_path, 'wb') as f:
+                for entry in merged.index:
+                    f.write(INDEX_ENTRY.pack(*entry))
+            merged.save_channels()
+            first = self.segments.index(run[0])
+            self.segments[first:first + len(run)] = [merged]
+        for segment in run[1:]:
+            segment.delete()
+
+    def history(self, channel, limit=50, before=None, since=None):
+        """
+        The newest `limit` messages of channel with offset < before and
+        timestamp >= since, oldest first, as (offset, timestamp, text) tuples.
+        Only the index blocks listed for the channel are read.
+        """
+        key = channel.encode('utf-8')
+        with self.lock:
+            # Snapshot what is committed; the writer only ever appends
+            views = [(s.path, s.base, s.last_ts, list(s.index), s.size, list(s.channels[key]))
+                     for s in self.segments if key in s.channels]
+        found = []
+        for path, base, last_ts, index, size, blocks in reversed(views):
+            if before is not None and base >= before:
+                continue
+            if since is not None and last_ts is not None and last_ts < since:
+                break
+            if not index:
+                continue
+            last_block = len(index) - 1
+            if before is not None:
+                last_block = max(0, bisect.bisect_left(index, (before,)) - 1)
+            try:
+                f = open(path, 'rb', buffering=0)
+            except OSError:
+                continue  # compacted or rotated away since the snapshot
+            with f:
+                for b in reversed(blocks[:bisect.bisect_right(blocks, last_block)]):
+                    if since is not None and b + 1 < len(index) and index[b + 1][1] < since:
+                        break  # every record from here back is older than since
+                    start = index[b][2]
+                    end = index[b + 1][2] if b + 1 < len(index) else size
+                    f.seek(start)
+                    block = f.read(end - start)
+                    matches = [(offset, timestamp, str(text, 'utf-8', errors='replace'))
+                               for _, offset, timestamp, ch, text in parse_records(memoryview(block))
+                               if ch == key and (before is None or offset < before)
+                               and (since is None or timestamp >= since)]
+                    found = matches + found
+                    if len(found) >= limit:
+                        return found[-limit:]
+        return found[-limit:]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': self.disk_bytes(),
+                'next_offset': self.next_offset,
+                'commits': self.commits,
+                'records': self.records_committed,
+            }
@@ -0,0 +1,189 @@
+"""
+Cheap always-on server metrics with a Prometheus text endpoint.
+
+Counters, gauges and histograms, each optionally split by one label.
+Recording is a dict update under the metric's own lock and nothing is
+formatted until somebody asks (/stats or a scrape). A metric can also be
+given a function evaluated only at collection time, e.g. a sum over the
+live sessions, which costs the hot path nothing at all.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, 50us .. 2.5s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Recipients per fan-out
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+
+registry = []  # every metric, in registration order
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, label=None, fn=None):
+        """
+        label names the one label this metric is split by (values are then
+        keyed by label value). fn, if given, returns extra values at
+        collection time: a number, or a dict of label value -> number.
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self.fn = fn
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def collect(self):
+        """{label value (None if unlabelled): number}"""
+        with self.lock:
+            values = dict(self.values)
+        if self.fn is not None:
+            extra = self.fn()
+            if not isinstance(extra, dict):
+                extra = {None: extra}
+            for key, value in extra.items():
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def get(self, key=None):
+        return self.collect().get(key, 0)
+
+    def _labels(self, key, extra=''):
+        parts = []
+        if self.label is not None and key is not None:
+            parts.append(f'{self.label}="{escape(key)}"')
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.collect().items(), key=lambda kv: str(kv[0])):
+            lines.append(f"{self.name}{self._labels(key)} {number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, key=None):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, key=None):
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, n=1, key=None):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def dec(self, n=1, key=None):
+        self.inc(-n, key)
+
+
+class Histogram(Metric):
+    """Fixed buckets; per label value a count per bucket, a sum and a count."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, key=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # counts per bucket (+Inf last), sum, count
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self.lock:
+            return {key: (list(counts), total, n) for key, (counts, total, n) in self.values.items()}
+
+    def quantile(self, q, key=None):
+        """
+        Estimate of the q-quantile, interpolated inside its bucket the way
+        Prometheus' histogram_quantile() does; None without observations.
+        """
+        series = self.collect().get(key)
+        if series is None or not series[2]:
+            return None
+        counts, _, n = series
+        rank = q * n
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # beyond the last bound
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, n) in sorted(self.collect().items(), key=lambda kv: str(kv[0])):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float('inf'),), counts):
+                cumulative += c
+                le = '+Inf' if bound == float('inf') else number(bound)
+                labels = self._labels(key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {number(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {n}")
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the chat log
+
+
+def serve_http(host, port):
+    """Serve /metrics for Prometheus from a background thread."""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
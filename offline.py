@@ -0,0 +1,418 @@
+"""
+Store-and-forward queues for users who are not connected.
+
+Every recipient has a Backlog of encoded frames, oldest first. New frames
+sit in memory until the backlog holds more than MEMORY_PER_USER bytes
+there, or all backlogs together pass the store's memory budget; then the
+in-memory frames are handed to a writer thread, which appends them to the
+recipient's newest segment file. Older frames are therefore always on disk
+(or on their way there) and newer ones in memory, so reading segments
+first and memory last keeps the order; take() waits for a backlog's
+writes in flight before reading it.
+
+Segments are the frames back to back in their framing.py wire form (kind,
+length, payload), nothing else: compact, and what take() returns can be
+queued to the returning client as it is. A segment is closed once it
+passes SEGMENT_BYTES and deleted once it has been read to the end; how far
+the oldest one has been read is kept next to it in a .pos file.
+
+Backlogs on disk survive a restart; the in-memory tail of each does not.
+A torn frame at the end of the newest segment (crash mid-write) is cut off
+when the store is opened.
+
+The store also remembers who is away and which groups they were in, so
+their group messages are queued and /msg to them does not fail. That
+survives a restart too: every departure and return is a line appended to
+away.log, rewritten without the stale lines when it is opened and
+whenever they outnumber the live ones. Someone away for longer than
+away_ttl is forgotten, backlog and all.
+
+Only the writer thread writes away.log, appends to segments and removes
+expired backlogs, so put(), went_away() and came_back() never wait on the
+disk: they are called from the asyncio engine's event loop.
+"""
+import json
+import os
+import threading
+import time
+
+from framing import HEADER, HEADER_SIZE
+
+MEMORY_PER_USER = 64 * 1024
+MEMORY_BUDGET = 32 * 1024 * 1024
+MAX_BYTES = 16 * 1024 * 1024  # per recipient, memory and disk together
+SEGMENT_BYTES = 1024 * 1024
+BATCH_BYTES = 64 * 1024       # what one take() hands out at most (bar one larger frame)
+AWAY_TTL = 7 * 24 * 3600      # seconds before someone who has not come back is forgotten
+EXPIRE_EVERY = 60             # seconds between sweeps for them
+
+
+def whole_frames(path):
+    """Cut a segment back to its last whole frame."""
+    with open(path, 'r+b') as f:
+        data = f.read()
+        pos = 0
+        while pos + HEADER_SIZE <= len(data):
+            _, length = HEADER.unpack_from(data, pos)
+            if pos + HEADER_SIZE + length > len(data):
+                break
+            pos += HEADER_SIZE + length
+        if pos < len(data):
+            f.truncate(pos)
+
+
+class Backlog:
+    """One recipient's queued frames: segment files, then an in-memory tail."""
+    __slots__ = ('path', 'frames', 'memory_bytes', 'flushing', 'segments', 'disk_bytes', 'tail_bytes',
+                 'read_pos', 'next_seq')
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = []        # in memory, newer than anything on disk
+        self.memory_bytes = 0
+        self.flushing = 0       # bytes handed to the writer thread, not yet on disk
+        self.segments = []      # [seq], oldest first
+        self.disk_bytes = 0     # unread bytes in the segments
+        self.tail_bytes = 0     # size of the newest segment, writes in flight included
+        self.read_pos = 0       # position reached in the oldest segment
+        self.next_seq = 0
+
+    def segment_path(self, seq, suffix='.seg'):
+        return os.path.join(self.path, f"{seq:010d}{suffix}")
+
+    def size(self):
+        return self.memory_bytes + self.flushing + self.disk_bytes
+
+
+class OfflineStore:
+    """Backlogs by nickname, under one directory (a subdirectory per recipient)."""
+
+    def __init__(self, directory, memory_budget=MEMORY_BUDGET, max_bytes=MAX_BYTES, away_ttl=AWAY_TTL):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.max_bytes = max_bytes
+        self.away_ttl = away_ttl
+        self.backlogs = {}      # nickname -> Backlog, only while it holds something
+        self.memory_bytes = 0
+        self.spills = 0
+        self.away = {}          # nickname -> (groups, when it left); oldest first
+        self.members = {}       # group -> nicknames away from it
+        self.away_lines = 0     # lines in away.log
+        self.expired = 0
+        self.swept = 0.0
+        self.lock = threading.Condition()  # guards the above; notified when a spill lands
+        self.cond = threading.Condition(threading.Lock())  # guards jobs
+        self.jobs = []          # (fn, args) for the writer thread, in order
+        self.closed = False
+        self.away_file = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.away_path = os.path.join(directory, 'away.log')
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        self._load_away()
+
+    def _load(self):
+        """Pick up the backlogs left on disk by an earlier run."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                nickname = bytes.fromhex(name).decode('utf-8')
+            except ValueError:
+                continue
+            if not os.path.isdir(path):
+                continue
+            backlog = Backlog(path)
+            backlog.segments = sorted(int(f[:-4]) for f in os.listdir(path) if f.endswith('.seg'))
+            if backlog.segments:
+                backlog.next_seq = backlog.segments[-1] + 1
+                whole_frames(backlog.segment_path(backlog.segments[-1]))
+                backlog.tail_bytes = os.path.getsize(backlog.segment_path(backlog.segments[-1]))
+            backlog.disk_bytes = sum(os.path.getsize(backlog.segment_path(seq)) for seq in backlog.segments)
+            try:
+                with open(backlog.segment_path(backlog.segments[0], '.pos')) as f:
+                    backlog.read_pos = int(f.read())
+                backlog.disk_bytes -= backlog.read_pos
+            except (IndexError, OSError, ValueError):
+                pass
+            if backlog.disk_bytes:
+                self.backlogs[nickname] = backlog
+            else:
+                self._remove(backlog)
+
+    def _load_away(self):
+        """Replay away.log, forget whoever has been away too long, compact."""
+        try:
+            with open(self.away_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    nickname = entry[0]
+                    self._unmark(nickname)
+                    if len(entry) == 3:
+                        self._mark(nickname, entry[2], entry[1])
+        except OSError:
+            pass
+        for nickname, backlog in self.backlogs.items():
+            if nickname not in self.away:
+                # A backlog with no departure on record still expires, counted from its last write
+                self._mark(nickname, (), os.path.getmtime(backlog.path))
+        self.away = dict(sorted(self.away.items(), key=lambda item: item[1][1]))
+        self._expire(time.time())
+        self._compact()
+
+    def _mark(self, nickname, groups, since):
+        self.away[nickname] = (frozenset(groups), since)
+        for group in groups:
+            self.members.setdefault(group, set()).add(nickname)
+
+    def _unmark(self, nickname):
+        groups, _ = self.away.pop(nickname, ((), 0))
+        for group in groups:
+            members = self.members.get(group)
+            if members is not None:
+                members.discard(nickname)
+                if not members:
+                    del self.members[group]
+        return groups
+
+    def _submit(self, fn, *args):
+        """Queue fn(*args) for the writer thread."""
+        with self.cond:
+            self.jobs.append((fn, args))
+            if len(self.jobs) == 1:
+                self.cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                jobs, self.jobs = self.jobs, []
+            for fn, args in jobs:
+                try:
+                    fn(*args)
+                except OSError as e:
+                    print(f"Offline store write failed: {e}")
+
+    def close(self):
+        """Finish the writes queued so far and stop the writer thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        if self.away_file is not None:
+            self.away_file.close()
+
+    def _log(self, entry):
+        self._submit(self._append_away, json.dumps(entry) + '\n')
+        self.away_lines += 1
+        if self.away_lines > 2 * len(self.away) + 1024:
+            self._compact()
+
+    def _append_away(self, line):
+        self.away_file.write(line)
+        self.away_file.flush()
+
+    def _compact(self):
+        """Have away.log rewritten with one line per user who is away."""
+        self.away_lines = len(self.away)
+        self._submit(self._rewrite_away, list(self.away.items()))
+
+    def _rewrite_away(self, away):
+        if self.away_file is not None:
+            self.away_file.close()
+        temp = self.away_path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            for nickname, (groups, since) in away:
+                f.write(json.dumps([nickname, since, sorted(groups)]) + '\n')
+        os.replace(temp, self.away_path)
+        self.away_file = open(self.away_path, 'a', encoding='utf-8')
+
+    def _expire(self, now):
+        """Forget the users away for longer than away_ttl, and drop their backlogs."""
+        self.swept = now
+        while self.away:
+            nickname, (_, since) = next(iter(self.away.items()))
+            if now - since < self.away_ttl:
+                break
+            self._unmark(nickname)
+            self.expired += 1
+            backlog = self.backlogs.pop(nickname, None)
+            if backlog is not None:
+                self.memory_bytes -= backlog.memory_bytes
+                self._submit(self._remove, backlog)  # after its spills still queued
+
+    def went_away(self, nickname, groups):
+        """nickname disconnected while in groups: queue for it from now on."""
+        now = time.time()
+        with self.lock:
+            self._unmark(nickname)
+            self._mark(nickname, groups, now)
+            self._log([nickname, now, sorted(groups)])
+            if now - self.swept > EXPIRE_EVERY:
+                self._expire(now)
+
+    def came_back(self, nickname):
+        """nickname is connected again; returns the groups it was in."""
+        with self.lock:
+            if nickname not in self.away:
+                return set()
+            groups = self._unmark(nickname)
+            self._log([nickname])
+            return set(groups)
+
+    def known(self, nickname):
+        """Whether messages for nickname should be kept: it is away, or has some waiting."""
+        return nickname in self.away or nickname in self.backlogs
+
+    def away_members(self, group):
+        """Snapshot of the nicknames away from group."""
+        with self.lock:
+            now = time.time()
+            if now - self.swept > EXPIRE_EVERY:
+                self._expire(now)
+            members = self.members.get(group)
+            return list(members) if members else []
+
+    def __len__(self):
+        return len(self.backlogs)
+
+    def pending(self, nickname):
+        """Bytes waiting for nickname."""
+        backlog = self.backlogs.get(nickname)
+        return backlog.size() if backlog is not None else 0
+
+    def put(self, nickname, frame):
+        """Queue one encoded frame for nickname; False if their backlog is full."""
+        with self.lock:
+            backlog = self.backlogs.get(nickname)
+            if backlog is None:
+                backlog = self.backlogs[nickname] = Backlog(
+                    os.path.join(self.directory, nickname.encode('utf-8').hex()))
+            if backlog.size() + len(frame) > self.max_bytes:
+                return False
+            backlog.frames.append(frame)
+            backlog.memory_bytes += len(frame)
+            self.memory_bytes += len(frame)
+            if backlog.memory_bytes > MEMORY_PER_USER or self.memory_bytes > self.memory_budget:
+                self._spill(backlog)
+            return True
+
+    def _spill(self, backlog):
+        """Hand the backlog's in-memory frames to the writer, for its newest segment."""
+        if not backlog.segments or backlog.tail_bytes >= SEGMENT_BYTES:
+            backlog.segments.append(backlog.next_seq)
+            backlog.next_seq += 1
+            backlog.tail_bytes = 0
+        data = b''.join(backlog.frames)
+        backlog.tail_bytes += len(data)
+        backlog.flushing += len(data)
+        self.memory_bytes -= backlog.memory_bytes
+        backlog.frames = []
+        backlog.memory_bytes = 0
+        self.spills += 1
+        self._submit(self._append_segment, backlog, backlog.segment_path(backlog.segments[-1]), data)
+
+    def _append_segment(self, backlog, path, data):
+        written = 0
+        try:
+            os.makedirs(backlog.path, exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(data)
+            written = len(data)
+        finally:
+            with self.lock:
+                backlog.flushing -= len(data)
+                backlog.disk_bytes += written
+                self.lock.notify_all()
+
+    def take(self, nickname, limit=BATCH_BYTES):
+        """
+        Remove and return the oldest whole frames queued for nickname, up to
+        limit bytes (or one frame, if that alone is bigger), as one bytes
+        object of frames back to back; b'' once nothing is left.
+        """
+        with self.lock:
+            while True:
+                backlog = self.backlogs.get(nickname)
+                if backlog is None:
+                    return b''
+                if not backlog.flushing:
+                    break
+                self.lock.wait()  # for its spills to land (it may be expired meanwhile)
+            data = b''
+            while backlog.segments and not data:
+                data = self._read_segment(backlog, limit)
+            if not data:
+                n = 0
+                size = 0
+                while n < len(backlog.frames) and (not n or size + len(backlog.frames[n]) <= limit):
+                    size += len(backlog.frames[n])
+                    n += 1
+                data = b''.join(backlog.frames[:n])
+                del backlog.frames[:n]
+                backlog.memory_bytes -= size
+                self.memory_bytes -= size
+            if not backlog.size():
+                del self.backlogs[nickname]
+                self._remove(backlog)
+            return data
+
+    def _read_segment(self, backlog, limit):
+        """Whole frames from the oldest segment; deletes it once read to the end."""
+        path = backlog.segment_path(backlog.segments[0])
+        with open(path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            f.seek(backlog.read_pos)
+            data = f.read(limit)
+            # Cut at the last whole frame; a first frame bigger than limit is read on its own
+            pos = 0
+            while pos + HEADER_SIZE <= len(data):
+                _, length = HEADER.unpack_from(data, pos)
+                if pos + HEADER_SIZE + length > len(data):
+                    if not pos:
+                        data += f.read(HEADER_SIZE + length - len(data))
+                        pos = len(data) if len(data) == HEADER_SIZE + length else 0
+                    break
+                pos += HEADER_SIZE + length
+        data = data[:pos]
+        backlog.read_pos += len(data)
+        if not data or backlog.read_pos >= end:
+            # Read to the end, or only a torn frame is left (the segment was damaged)
+            backlog.disk_bytes -= end - (backlog.read_pos - len(data))
+            seq = backlog.segments.pop(0)
+            backlog.read_pos = 0
+            os.remove(path)
+            try:
+                os.remove(backlog.segment_path(seq, '.pos'))
+            except OSError:
+                pass
+        else:
+            backlog.disk_bytes -= len(data)
+            with open(backlog.segment_path(backlog.segments[0], '.pos'), 'w') as f:
+                f.write(str(backlog.read_pos))
+        return data
+
+    def _remove(self, backlog):
+        try:
+            for filename in os.listdir(backlog.path):
+                os.remove(os.path.join(backlog.path, filename))
+            os.rmdir(backlog.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backlogs': len(self.backlogs),
+                'memory_bytes': self.memory_bytes,
+                'disk_bytes': sum(b.disk_bytes for b in self.backlogs.values()),
+                'spills': self.spills,
+                'away': len(self.away),
+                'expired': self.expired,
+            }
@@ -0,0 +1,213 @@
+"""
+Bounded per-connection outbound queues.
+
+Senders never touch a client's socket: they append frames to its queue and
+return immediately. Each connection has its own writer (a thread in the
+thread engine, transport callbacks in the asyncio engine) that drains the
+queue, so one slow receiver only ever fills its own queue.
+
+When the queue is full the overflow policy either drops the oldest frames
+or marks the consumer for disconnection. File transfers do not go through
+here; they use their own data connections.
+
+With a replay budget the queue also keeps the last frames handed to the
+writer, so a client that reconnects can be sent whatever it did not get
+(see resume.py).
+"""
+import threading
+import time
+from collections import deque
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DISCONNECT)
+
+IOV_MAX = 1024  # buffers per sendmsg() call
+
+
+class OutboundQueue:
+    """Bounded send queue for one connection."""
+    __slots__ = ('frames', 'max_frames', 'max_bytes', 'policy', 'waker', 'cond',
+                 'closed', 'overflowed', 'queued_bytes', 'high_water', 'dropped',
+                 'sent_frames', 'sent_bytes', 'writes', 'replay', 'replay_bytes',
+                 'replay_limit', 'taken_bytes', 'drain_waiter')
+
+    def __init__(self, max_frames=1024, max_bytes=4 * 1024 * 1024,
+                 policy=DROP_OLDEST, waker=None, replay_limit=0):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.waker = waker  # called when the queue goes from empty to non-empty
+        self.cond = threading.Condition(threading.Lock())
+        self.closed = False
+        self.overflowed = False
+        self.queued_bytes = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.writes = 0
+        self.replay = deque()   # frames already taken by the writer, newest last
+        self.replay_bytes = 0
+        self.replay_limit = replay_limit
+        self.taken_bytes = 0    # stream position: bytes of frames taken so far
+        self.drain_waiter = None  # called once when the writer next empties the queue
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        """
+        Queue a frame without blocking. Returns False if the queue is closed
+        or the overflow policy says the consumer must be disconnected.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if (len(self.frames) >= self.max_frames
+                    or self.queued_bytes + len(frame) > self.max_bytes):
+                if self.policy == DISCONNECT:
+                    self.overflowed = True
+                    self.closed = True
+                    self.cond.notify_all()
+                    return False
+                # DROP_OLDEST: make room by discarding the stalest frames
+                while self.frames and (len(self.frames) >= self.max_frames
+                                       or self.queued_bytes + len(frame) > self.max_bytes):
+                    self.queued_bytes -= len(self.frames.popleft())
+                    self.dropped += 1
+            was_empty = not self.frames
+            self.frames.append(frame)
+            self.queued_bytes += len(frame)
+            if len(self.frames) > self.high_water:
+                self.high_water = len(self.frames)
+            self.cond.notify()
+        if was_empty and self.waker is not None:
+            self.waker()
+        return True
+
+    def _take(self):
+        """Pop everything queued."""
+        batch = list(self.frames)
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.sent_frames += len(batch)
+        if self.replay_limit:
+            for frame in batch:
+                self.replay.append(frame)
+                self.replay_bytes += len(frame)
+                self.taken_bytes += len(frame)
+            while self.replay_bytes > self.replay_limit:
+                self.replay_bytes -= len(self.replay.popleft())
+        return batch
+
+    def unsent(self, position):
+        """
+        The frames from byte `position` of the stream on: those taken but
+        still in the replay ring, then those never taken. Also returns how
+        many bytes after position had already left the ring.
+        """
+        with self.cond:
+            start = self.taken_bytes - self.replay_bytes  # stream position of replay[0]
+            frames = []
+            for frame in self.replay:
+                end = start + len(frame)
+                if end > position:
+                    # An entry may hold several frames (an offline batch); cut at the client's position
+                    frames.append(frame if start >= position else frame[position - start:])
+                start = end
+            frames.extend(self.frames)
+            return frames, max(self.taken_bytes - self.replay_bytes - position, 0)
+
+    def get_batch(self, timeout=None, linger=0):
+        """
+        Block until frames are queued; returns [] once closed and drained.
+        With linger > 0 the writer waits that long after the first frame so
+        frames arriving in the meantime go out in the same syscall.
+        """
+        with self.cond:
+            while not self.frames:
+                if self.closed:
+                    return []
+                if not self.cond.wait(timeout):
+                    return []
+        if linger:
+            time.sleep(linger)
+        with self.cond:
+            batch = self._take()
+            waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None:
+            waiter()
+        return batch
+
+    def take_batch(self):
+        """Non-blocking variant of get_batch() for event-loop writers."""
+        with self.cond:
+            batch = self._take()
+            waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None:
+            waiter()
+        return batch
+
+    def when_drained(self, fn, max_bytes=0):
+        """
+        Call fn once no more than max_bytes are queued: right away (also if
+        the queue is closed), or when the writer next takes the queue.
+        """
+        with self.cond:
+            if self.queued_bytes > max_bytes and not self.closed:
+                self.drain_waiter = fn
+                return
+        fn()
+
+    def note_sent(self, nbytes):
+        """Record one writer flush (a single gathered write) of nbytes."""
+        self.sent_bytes += nbytes
+        self.writes += 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'bytes': self.queued_bytes,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+            'writes': self.writes,
+            'overflowed': self.overflowed,
+        }
+
+
+def send_frames(sock, frames):
+    """
+    Write a batch of frames with as few syscalls as possible: sendmsg()
+    gathers the shared frame buffers straight from the list (writev), so
+    nothing is joined or copied. Returns the number of bytes written.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        # Windows has no sendmsg(); fall back to one joined write
+        data = b''.join(frames)
+        sock.sendall(data)
+        return len(data)
+    total = 0
+    pending = list(frames)
+    while pending:
+        sent = sock.sendmsg(pending[:IOV_MAX])
+        total += sent
+        # Drop buffers that went out whole, trim the one that went out in part
+        i = 0
+        while i < len(pending) and sent >= len(pending[i]):
+            sent -= len(pending[i])
+            i += 1
+        del pending[:i]
+        if sent:
+            pending[0] = memoryview(pending[0])[sent:]
+    return total
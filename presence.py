@@ -0,0 +1,126 @@
+"""
+Presence: who is online, as a versioned roster plus batched deltas.
+
+Connects, disconnects and group joins and leaves are recorded as they
+happen but not sent right away: the first one opens a window of `window`
+seconds, and at its end everything recorded goes out as one delta per
+scope, '*' for the whole server and '#<group>' for the online members of
+one group. Someone who came and went within the window cancels out. A
+reconnect storm of N clients thus costs each subscriber one frame per
+window instead of N frames, and each delta is encoded once for all of its
+subscribers.
+
+    PRESENCE:<version>:<scope>
+    +alice
+    -bob
+
+Every delta has the next version number. /users answers with a snapshot,
+
+    USERS:<version>:<scope>:<count>
+    alice
+    carol
+
+taken after delta <version> went out; it may already show changes of the
+next delta, which is harmless since applying a delta twice changes nothing.
+A client keeps a roster with the snapshot and the deltas numbered after it.
+
+Clients choose the deltas they get: everything ('*', the default: the
+whole server plus the groups they are in), only those of some groups, or
+none. Group members hear of joins and leaves only this way.
+"""
+import threading
+import time
+
+from framing import encode_text
+
+ALL = '*'
+WINDOW = 0.25
+
+
+def parse_subscription(text):
+    """'all' -> ALL, 'off' -> None, 'g1 #g2' or 'g1,g2' -> frozenset of groups."""
+    words = text.replace(',', ' ').split()
+    if not words or words == ['off'] or words == ['none']:
+        return None
+    if words == ['all'] or words == [ALL]:
+        return ALL
+    return frozenset(word.lstrip('#') for word in words)
+
+
+def describe(subscription):
+    if subscription is None:
+        return "off"
+    if subscription == ALL:
+        return "all users"
+    return "groups " + ', '.join(sorted(subscription))
+
+
+def encode_delta(version, scope, changes):
+    """The PRESENCE frame for changes ({nick: online}) in scope."""
+    lines = [f"PRESENCE:{version}:{scope}"]
+    lines.extend(('+' if online else '-') + nick for nick, online in sorted(changes.items()))
+    return encode_text('\n'.join(lines))
+
+
+def encode_roster(version, scope, nicks):
+    """The USERS frame: a snapshot of who is online in scope."""
+    return encode_text('\n'.join([f"USERS:{version}:{scope}:{len(nicks)}"] + sorted(nicks)))
+
+
+class Presence:
+    """Changes recorded since the last delta, by scope."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.version = 0     # number of the last delta handed out
+        self.pending = {}    # scope -> {nick: True (online) / False (offline)}
+        self.events = 0      # changes recorded, before coalescing
+        self.cond = threading.Condition()
+
+    def _note(self, scope, nick, online):
+        changes = self.pending.setdefault(scope, {})
+        if changes.get(nick) is (not online):
+            # Came and went (or went and came back) within the window
+            del changes[nick]
+            if not changes:
+                del self.pending[scope]
+        else:
+            changes[nick] = online
+
+    def _record(self, nick, online, scopes):
+        with self.cond:
+            for scope in scopes:
+                self._note(scope, nick, online)
+            self.events += 1
+            self.cond.notify()
+
+    def online(self, nick, groups=()):
+        """nick connected (already in groups)."""
+        self._record(nick, True, [ALL] + ['#' + g for g in groups])
+
+    def offline(self, nick, groups=()):
+        """nick disconnected (while still in groups)."""
+        self._record(nick, False, [ALL] + ['#' + g for g in groups])
+
+    def joined(self, nick, group):
+        self._record(nick, True, ['#' + group])
+
+    def left(self, nick, group):
+        self._record(nick, False, ['#' + group])
+
+    def next_delta(self):
+        """
+        Block until something changes, let the window pass, then return
+        (version, {scope: {nick: online}}); the dict is empty if every
+        change cancelled out.
+        """
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+        if self.window:
+            time.sleep(self.window)
+        with self.cond:
+            pending, self.pending = self.pending, {}
+            if pending:
+                self.version += 1
+            return self.version, pending
@@ -0,0 +1,139 @@
+"""
+Token buckets for per-client rate limits and flood protection.
+
+Every session gets a RateLimiter holding one bucket per limit class: 'conn'
+for every frame the client sends, plus one per command class ('chat',
+'msg', 'group', 'join' for /join and /leave, 'history', 'files',
+'download', 'upload', 'users'). A frame must get a token from both its
+class and 'conn' to be handled, and a refused frame takes from neither.
+Buckets refill lazily from the clock
+when asked, so idle clients cost nothing and there is no timer.
+
+Limits are written "class=rate/burst,...", e.g. "chat=5/10,download=0.5/2":
+rate tokens per second, bursts of up to burst at once; a rate of 0 means
+no limit for that class.
+"""
+import threading
+import time
+
+DEFAULT_LIMITS = ("conn=50/100,chat=10/20,msg=10/20,group=10/20,join=2/10,history=2/5,"
+                  "files=2/5,download=1/3,upload=1/3,users=2/5")
+CLASSES = ('conn', 'chat', 'msg', 'group', 'join', 'history', 'files', 'download', 'upload', 'users')
+PACE_SLICE = 256 * 1024  # bytes sent between waits on a byte-rate bucket
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = None
+
+    def available(self):
+        """Refill from the clock and return the tokens there are now."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def take(self, n=1):
+        """Take n tokens if there are enough; never waits."""
+        if self.available() < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def wait(self, n):
+        """
+        Take n tokens, sleeping until they have accumulated; the balance may
+        go negative so a request bigger than the burst still gets through.
+        Safe to share between threads (e.g. the streams of one download).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - n
+            self.stamp = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def byte_bucket(rate):
+    """A thread-safe bucket pacing transfers at rate bytes per second (None if 0)."""
+    if not rate:
+        return None
+    bucket = TokenBucket(rate, max(rate, PACE_SLICE))
+    bucket.lock = threading.Lock()
+    return bucket
+
+
+def parse_limits(spec):
+    """'chat=5/10,files=1/2' -> {'chat': (5.0, 10.0), 'files': (1.0, 2.0)}"""
+    limits = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name not in CLASSES:
+            raise ValueError(f"unknown rate limit class '{name}' (one of {', '.join(CLASSES)})")
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1.0)
+        if rate < 0 or burst < 1:
+            raise ValueError(f"bad rate limit '{item}'")
+        limits[name] = (rate, burst)
+    return limits
+
+
+class RateLimiter:
+    """
+    One client's buckets, created on first use. Not locked: each session's
+    frames are handled by one reader thread (or the event loop) at a time.
+    """
+    __slots__ = ('limits', 'buckets', 'throttled', 'strikes', 'warned_at', 'transfer')
+
+    def __init__(self, limits, transfer=None):
+        self.limits = limits
+        self.buckets = {}
+        self.throttled = 0   # frames refused so far
+        self.strikes = 0     # frames refused since the last one let through
+        self.warned_at = 0.0
+        self.transfer = transfer  # byte bucket shared by this client's TCP downloads
+
+    def allow(self, name):
+        """
+        Take a token for class name and one for 'conn' if both have one;
+        returns the class that ran dry (nothing taken), or None if the frame
+        may be handled.
+        """
+        charged = []
+        for key in (name, 'conn'):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                limit = self.limits.get(key)
+                if limit is None or not limit[0]:
+                    continue
+                bucket = self.buckets[key] = TokenBucket(*limit)
+            if bucket.available() < 1:
+                self.throttled += 1
+                self.strikes += 1
+                return key
+            charged.append(bucket)
+        for bucket in charged:
+            bucket.tokens -= 1
+        self.strikes = 0
+        return None
+
+    def should_warn(self, interval=1.0):
+        """True at most once per interval, so refusals stay cheap for us and the peer."""
+        now = time.monotonic()
+        if now - self.warned_at < interval:
+            return False
+        self.warned_at = now
+        return True
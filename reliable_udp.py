@@ -0,0 +1,627 @@
+"""
+Reliable UDP file transfer: sliding-window selective repeat.
+
+The server streams a file as near-MTU DATA datagrams. The client answers
+with ACKs carrying a cumulative sequence number plus a SACK bitmap of the
+packets it holds beyond it; gaps in the bitmap act as NACKs. A packet is
+retransmitted as soon as one sent after it is acknowledged (time-based, as
+in RACK, so lost retransmissions are caught too) or when its retransmit
+timer (RTO from smoothed RTT, RFC 6298) fires. The window follows slow
+start / AIMD congestion control and packets are paced over the measured
+RTT. A tail loss probe resends the newest packet when ACKs stop arriving,
+so losses at the end of a burst are found without waiting for the RTO.
+
+The server runs many transfers over one socket. START assigns each one a
+transfer ID that every later datagram carries, and the event loop hands
+out send turns round-robin so one large download cannot starve the rest.
+Requests beyond the concurrency limit are queued and told so with QUEUED.
+Files are opened (or read into the cache) on a worker thread, so a cold
+64 MB file never holds up the datagrams of the transfers already running.
+
+A request names a byte range of the file (offset, length; length 0 means
+to the end), so interrupted downloads can fetch just what they lack.
+
+Datagrams (all integers big-endian):
+    REQUEST  type, offset (u64), length (u64), filename (UTF-8)
+    START    type, transfer id (u32), file size (u64), offset (u64),
+             length (u64), chunk size (u32)
+    DATA     type, transfer id (u32), seq (u32), send timestamp (f64), payload
+    ACK      type, transfer id (u32), cumulative seq (u32), echoed timestamp (f64),
+             bitmap length (u16), bitmap (bit i = seq cum + 1 + i received)
+    ERROR    type, message (UTF-8)
+    QUEUED   type, position in the wait queue (u32)
+"""
+import math
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import count
+
+REQUEST = 1
+START = 2
+DATA = 3
+ACK = 4
+ERROR = 5
+QUEUED = 6
+
+TYPE = struct.Struct('!B')
+REQUEST_HEADER = struct.Struct('!BQQ')
+START_HEADER = struct.Struct('!BIQQQI')
+DATA_HEADER = struct.Struct('!BIId')
+ACK_HEADER = struct.Struct('!BIIdH')
+QUEUED_HEADER = struct.Struct('!BI')
+
+MAX_DATAGRAM = 1472  # 1500-byte Ethernet MTU minus IPv4 and UDP headers
+CHUNK_SIZE = MAX_DATAGRAM - DATA_HEADER.size
+RECV_WINDOW = 1024  # packets; the SACK bitmap covers this many
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+INITIAL_CWND = 4.0
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 4.0
+MIN_REORDER = 0.001  # seconds of reordering tolerated before declaring loss
+MIN_PROBE = 0.01  # floor for the tail loss probe timer
+MAX_PROBES = 2  # tail loss probes per silence before waiting for the RTO
+PACING_GAIN = 1.25
+PACING_BURST = 8
+MAX_BACKOFFS = 8  # consecutive timeouts before the transfer is abandoned
+MAX_TRANSFERS = 32  # transfers the server runs at once; later requests wait
+TURN_PACKETS = PACING_BURST  # packets a transfer may send per round-robin turn
+
+REQUEST_RETRY = 0.5
+IDLE_TIMEOUT = 10.0
+LINGER = 1.0  # receiver re-ACKs at most this long after completion (see receive_file)
+
+
+def tune_socket(sock):
+    """Large kernel buffers so a full window fits without local drops."""
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+        except OSError:
+            pass
+
+
+def read_at(f, offset, size):
+    """
+    Positioned read that leaves the file offset alone where possible. f may
+    also be an in-memory buffer (a cached file), which is sliced instead.
+    """
+    if isinstance(f, memoryview):
+        return f[offset:offset + size]
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    f.seek(offset)
+    return f.read(size)
+
+
+def write_at(f, offset, data):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(f.fileno(), data, offset)
+    else:
+        f.seek(offset)
+        f.write(data)
+
+
+def encode_ack(transfer_id, cum, echo_ts, received):
+    """ACK for cumulative seq `cum` plus a SACK bitmap built from `received`."""
+    top = max(received) if received else cum
+    bitmap = bytearray(max(0, math.ceil((top - cum) / 8)))
+    for seq in received:
+        i = seq - cum - 1
+        bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return ACK_HEADER.pack(ACK, transfer_id, cum, echo_ts, len(bitmap)) + bitmap
+
+
+def decode_sack(cum, bitmap):
+    """Sequence numbers the bitmap reports as received."""
+    seqs = []
+    for byte_index, byte in enumerate(bitmap):
+        if byte:
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    seqs.append(cum + 1 + byte_index * 8 + bit)
+    return seqs
+
+
+class Sender:
+    """Selective-repeat sender state for one file; the caller owns the socket."""
+
+    def __init__(self, f, size, chunk_size=CHUNK_SIZE, transfer_id=0, offset=0, file_size=None,
+                 max_rate=0):
+        self.f = f
+        self.transfer_id = transfer_id
+        self.offset = offset       # sequence 0 starts here in the file
+        self.file_size = offset + size if file_size is None else file_size
+        self.size = size
+        self.chunk_size = chunk_size
+        self.total = math.ceil(size / chunk_size)
+        self.next_seq = 0          # next never-sent sequence number
+        self.cum = 0               # everything below is acknowledged
+        self.sacked = set()        # acknowledged above cum
+        self.inflight = OrderedDict()  # seq -> last send time, oldest first
+        self.lost = deque()        # seqs waiting for retransmission
+        self.rack_time = 0.0       # latest send time of any acknowledged packet
+        self.recovery_point = 0    # one window reduction per loss episode
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = float(RECV_WINDOW)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.backoffs = 0
+        self.pace_at = 0.0
+        self.min_interval = chunk_size / max_rate if max_rate else 0.0  # byte-rate cap
+        self.probes = 0
+        self.started = time.monotonic()
+        self.last_ack = self.started
+        self.last_send = self.started
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.timeouts = 0
+
+    @property
+    def done(self):
+        return self.cum >= self.total
+
+    @property
+    def failed(self):
+        return self.backoffs >= MAX_BACKOFFS
+
+    def start_packet(self):
+        return START_HEADER.pack(START, self.transfer_id, self.file_size, self.offset,
+                                 self.size, self.chunk_size)
+
+    def _packet(self, seq, now):
+        start = seq * self.chunk_size
+        payload = read_at(self.f, self.offset + start, min(self.chunk_size, self.size - start))
+        return DATA_HEADER.pack(DATA, self.transfer_id, seq, now) + payload
+
+    def _acked(self, seq):
+        return seq < self.cum or seq in self.sacked
+
+    def packets(self, now, limit=None):
+        """Datagrams the window and pacing allow right now (at most limit)."""
+        out = []
+        interval = (self.srtt / self.cwnd / PACING_GAIN) if self.srtt else 0.0
+        interval = max(interval, self.min_interval)
+        self.pace_at = max(self.pace_at, now - interval * PACING_BURST)
+        while len(self.inflight) < self.cwnd and self.pace_at <= now:
+            if limit is not None and len(out) >= limit:
+                break
+            seq = None
+            while self.lost:
+                candidate = self.lost.popleft()
+                if not self._acked(candidate):
+                    seq = candidate
+                    self.retransmits += 1
+                    break
+            if seq is None:
+                if self.next_seq >= self.total or self.next_seq >= self.cum + RECV_WINDOW:
+                    break
+                seq = self.next_seq
+                self.next_seq += 1
+            self.inflight[seq] = now
+            self.inflight.move_to_end(seq)
+            self.last_send = now
+            out.append(self._packet(seq, now))
+            self.packets_sent += 1
+            self.pace_at += interval
+        return out
+
+    def _rtt_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+        self.backoffs = 0
+
+    def _reduce_window(self, timeout):
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0 if timeout else self.ssthresh
+        self.recovery_point = self.next_seq
+
+    def on_ack(self, datagram, now):
+        _, _, cum, echo_ts, length = ACK_HEADER.unpack_from(datagram)
+        if cum < self.cum:
+            return  # older than one already handled (reordered or forged)
+        # Trust nothing beyond what was sent: a forged ACK must not make us loop
+        cum = min(cum, self.next_seq)
+        bitmap = datagram[ACK_HEADER.size:ACK_HEADER.size + min(length, RECV_WINDOW // 8)]
+        self.last_ack = now
+        self.probes = 0
+        if echo_ts > 0:
+            self._rtt_sample(max(now - echo_ts, 1e-6))
+
+        newly = 0
+        if cum > self.cum:
+            for seq in range(self.cum, cum):
+                if seq in self.sacked:
+                    self.sacked.discard(seq)
+                else:
+                    newly += 1
+                    self._delivered(seq)
+            self.cum = cum
+        for seq in decode_sack(cum, bitmap):
+            if seq >= self.next_seq:
+                break  # never sent; decode_sack() yields in order
+            if seq not in self.sacked:
+                self.sacked.add(seq)
+                newly += 1
+                self._delivered(seq)
+
+        if newly:
+            if self.cwnd < self.ssthresh:
+                self.cwnd += newly  # slow start
+            else:
+                self.cwnd += newly / self.cwnd  # congestion avoidance
+            self.cwnd = min(self.cwnd, float(RECV_WINDOW))
+
+        # Anything sent before an acknowledged packet (beyond the reordering
+        # window) is lost. inflight is in send order, so only its head is checked.
+        reorder = max(MIN_REORDER, self.srtt / 4) if self.srtt else MIN_REORDER
+        new_episode = False
+        while self.inflight:
+            seq, sent = next(iter(self.inflight.items()))
+            if sent + reorder >= self.rack_time:
+                break
+            del self.inflight[seq]
+            self.lost.append(seq)
+            if seq >= self.recovery_point:
+                new_episode = True
+        if new_episode:
+            self._reduce_window(timeout=False)
+
+    def _delivered(self, seq):
+        sent = self.inflight.pop(seq, None)
+        if sent is not None and sent > self.rack_time:
+            self.rack_time = sent
+
+    def _probe_time(self):
+        return max(self.last_ack, self.last_send) + max(2 * self.srtt, MIN_PROBE)
+
+    def _can_probe(self):
+        return self.inflight and self.srtt and self.probes < MAX_PROBES
+
+    def check_timeouts(self, now):
+        """Move packets whose retransmit timer expired to the lost queue."""
+        if self._can_probe() and now >= self._probe_time():
+            # Tail loss probe: resend the newest packet; its ACK exposes older losses
+            seq = next(reversed(self.inflight))
+            del self.inflight[seq]
+            self.lost.appendleft(seq)
+            self.probes += 1
+        expired = False
+        while self.inflight:
+            seq, sent = next(iter(self.inflight.items()))
+            if sent + self.rto > now:
+                break
+            del self.inflight[seq]
+            if not self._acked(seq):
+                self.lost.append(seq)
+                expired = True
+        if expired:
+            self.timeouts += 1
+            self.backoffs += 1
+            self._reduce_window(timeout=True)
+            self.rto = min(MAX_RTO, self.rto * 2)
+
+    def next_deadline(self, now):
+        """When the driver should wake up even if no ACK arrives."""
+        deadline = now + self.rto
+        if self.inflight:
+            deadline = min(deadline, next(iter(self.inflight.values())) + self.rto)
+            if self._can_probe():
+                deadline = min(deadline, self._probe_time())
+        if (self.lost or self.next_seq < self.total) and len(self.inflight) < self.cwnd:
+            deadline = min(deadline, self.pace_at)
+        return deadline
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'bytes': self.size,
+            'packets': self.packets_sent,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+            'srtt_ms': round(self.srtt * 1000, 3) if self.srtt else None,
+            'elapsed': elapsed,
+        }
+
+
+class Receiver:
+    """Reassembles DATA packets into a preallocated file with positioned writes."""
+
+    def __init__(self, f, size, chunk_size, transfer_id=0, offset=0):
+        self.f = f
+        self.transfer_id = transfer_id
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size
+        self.total = math.ceil(size / chunk_size)
+        self.cum = 0
+        self.received = set()  # seqs held above cum
+        self.duplicates = 0
+        self.echo_ts = 0.0
+
+    @property
+    def done(self):
+        return self.cum >= self.total
+
+    def on_data(self, datagram):
+        _, transfer_id, seq, ts = DATA_HEADER.unpack_from(datagram)
+        if transfer_id != self.transfer_id:
+            return  # left over from another transfer
+        self.echo_ts = ts
+        if seq < self.cum or seq in self.received or seq >= self.cum + RECV_WINDOW:
+            self.duplicates += 1
+            return
+        write_at(self.f, self.offset + seq * self.chunk_size, memoryview(datagram)[DATA_HEADER.size:])
+        self.received.add(seq)
+        while self.cum in self.received:
+            self.received.discard(self.cum)
+            self.cum += 1
+
+    def ack(self):
+        return encode_ack(self.transfer_id, self.cum, self.echo_ts, self.received)
+
+
+def receive_file(sock, addr, filename, filepath, offset=0, length=0, progress=None):
+    """
+    Fetch filename (or length bytes of it from offset; 0 = to the end) from
+    the UDP file server at addr into the same place in filepath, which is
+    created or resized to the server's file size but otherwise left alone.
+    progress(bytes received), if given, is called after every ACK.
+    Returns the receiver stats; raises ConnectionError on failure.
+    """
+    tune_socket(sock)
+    request = REQUEST_HEADER.pack(REQUEST, offset, length) + filename.encode('utf-8')
+    heard = time.monotonic()
+    start = None
+    while start is None:
+        now = time.monotonic()
+        if now - heard > IDLE_TIMEOUT:
+            raise ConnectionError("no response from UDP file server")
+        sock.sendto(request, addr)
+        asked = now
+        retry_at = now + REQUEST_RETRY
+        while start is None:
+            wait = retry_at - time.monotonic()
+            if wait <= 0:
+                break
+            sock.settimeout(wait)
+            try:
+                data, _ = sock.recvfrom(65536)
+            except socket.timeout:
+                break
+            if data[0] == ERROR:
+                raise ConnectionError(data[1:].decode('utf-8', errors='ignore'))
+            if data[0] == QUEUED:
+                heard = time.monotonic()  # the server is busy, not gone
+            elif data[0] == START:
+                start = START_HEADER.unpack_from(data)
+    rtt = time.monotonic() - asked
+    _, transfer_id, file_size, offset, size, chunk_size = start
+    started = time.monotonic()
+
+    with open(filepath, 'r+b' if os.path.exists(filepath) else 'w+b') as f:
+        if os.fstat(f.fileno()).st_size != file_size:
+            f.truncate(file_size)  # preallocate
+        receiver = Receiver(f, size, chunk_size, transfer_id, offset)
+        sock.settimeout(IDLE_TIMEOUT)
+        while not receiver.done:
+            try:
+                data, _ = sock.recvfrom(65536)
+            except socket.timeout:
+                raise ConnectionError(
+                    f"transfer stalled at {offset + receiver.cum * chunk_size} of {file_size} bytes")
+            # Drain whatever else is queued, then answer with a single ACK
+            sock.setblocking(False)
+            try:
+                while True:
+                    if data[0] == DATA:
+                        receiver.on_data(data)
+                    data, _ = sock.recvfrom(65536)
+            except BlockingIOError:
+                pass
+            finally:
+                sock.settimeout(IDLE_TIMEOUT)
+            sock.sendto(receiver.ack(), addr)
+            if progress is not None:
+                progress(min(size, (receiver.cum + len(receiver.received)) * chunk_size))
+
+        # Our last ACK may be lost: answer retransmissions until the sender goes
+        # quiet. It resends the tail within a few RTTs (loss probe) or one RTO,
+        # so a silence longer than both means it heard us.
+        elapsed = time.monotonic() - started
+        sock.settimeout(min(LINGER, max(MIN_RTO, 4 * rtt)))
+        try:
+            while True:
+                data, _ = sock.recvfrom(65536)
+                if data[0] == DATA:
+                    receiver.on_data(data)
+                    sock.sendto(receiver.ack(), addr)
+        except socket.timeout:
+            pass
+
+    return {'bytes': size, 'elapsed': elapsed, 'duplicates': receiver.duplicates}
+
+
+class Transfer:
+    """One download the server is running."""
+    __slots__ = ('id', 'key', 'addr', 'filename', 'sender')
+
+    def __init__(self, transfer_id, key, filename, sender):
+        self.id = transfer_id
+        self.key = key  # (request datagram, client address)
+        self.addr = key[1]
+        self.filename = filename
+        self.sender = sender
+
+
+def serve(sock, resolve, on_done=None, max_transfers=MAX_TRANSFERS, cache=None, on_start=None,
+          max_rate=0):
+    """
+    UDP file server loop. resolve(filename) returns a path or None. Up to
+    max_transfers downloads run at once, taking round-robin send turns;
+    further requests wait in arrival order. With a FileCache, hot files are
+    sent from memory instead of being read from disk per packet; a file is
+    loaded on a worker thread and its transfer starts once it is. max_rate
+    caps each transfer at that many bytes per second (0 = no cap).
+    on_start(filename, addr) and on_done(filename, addr, stats) bracket
+    every transfer that got going.
+    """
+    tune_socket(sock)
+    ids = count(1)
+    active = OrderedDict()   # transfer id -> Transfer, in round-robin order
+    by_key = {}              # (request, addr) -> Transfer
+    waiting = OrderedDict()  # (request, addr) -> None, in arrival order
+    finished = {}            # (request, addr) -> completion time, to spot stale retries
+    loading = set()          # (request, addr) whose file a worker thread is opening
+    loaded = deque()         # what the workers opened, for begin()
+    wake_r, wake_w = socket.socketpair()  # a worker tells the select() below it is done
+
+    def send_queued(key):
+        position = list(waiting).index(key) + 1
+        sock.sendto(QUEUED_HEADER.pack(QUEUED, position), key[1])
+
+    def on_request(data, addr):
+        key = (data, addr)
+        transfer = by_key.get(key)
+        if transfer is not None:
+            # Our START got lost; the client is asking again
+            sock.sendto(transfer.sender.start_packet(), addr)
+        elif key in waiting:
+            send_queued(key)
+        elif key in loading:
+            pass  # START follows once the file is open
+        elif time.monotonic() - finished.get(key, -LINGER * 2) >= LINGER * 2:
+            waiting[key] = None
+            if len(active) + len(loading) >= max_transfers:
+                send_queued(key)
+
+    def start(key):
+        data, addr = key
+        if len(data) < REQUEST_HEADER.size:
+            return
+        _, offset, length = REQUEST_HEADER.unpack_from(data)
+        filename = data[REQUEST_HEADER.size:].decode('utf-8', errors='ignore').strip()
+        filepath = resolve(filename)
+        if filepath is None:
+            sock.sendto(TYPE.pack(ERROR) + b"File not found", addr)
+            return
+        loading.add(key)
+        threading.Thread(target=load, args=(key, filename, filepath, offset, length),
+                         daemon=True).start()
+
+    def load(key, filename, filepath, offset, length):
+        """Worker thread: the file from the cache (read in on a miss) or opened."""
+        f = error = None
+        file_size = 0
+        try:
+            entry = cache.get(filepath) if cache is not None else None
+            if entry is not None:
+                f = entry.data
+                file_size = entry.size
+            else:
+                f = open(filepath, 'rb')
+                file_size = os.fstat(f.fileno()).st_size
+        except Exception as e:  # the request must leave `loading` whatever happened
+            error = str(e)
+        loaded.append((key, filename, f, file_size, offset, length, error))
+        wake_w.send(b'\0')
+
+    def begin(key, filename, f, file_size, offset, length, error):
+        loading.discard(key)
+        addr = key[1]
+        if error is not None:
+            sock.sendto(TYPE.pack(ERROR) + error.encode('utf-8'), addr)
+            return
+        if offset > file_size:
+            if not isinstance(f, memoryview):
+                f.close()
+            sock.sendto(TYPE.pack(ERROR) + b"Range starts past the end of the file", addr)
+            return
+        length = file_size - offset if not length else min(length, file_size - offset)
+        transfer_id = next(ids) & 0xFFFFFFFF
+        sender = Sender(f, length, transfer_id=transfer_id, offset=offset, file_size=file_size,
+                        max_rate=max_rate)
+        transfer = Transfer(transfer_id, key, filename, sender)
+        active[transfer_id] = transfer
+        by_key[key] = transfer
+        if on_start is not None:
+            on_start(filename, addr)
+        sock.sendto(sender.start_packet(), addr)
+
+    def finish(transfer):
+        del active[transfer.id]
+        del by_key[transfer.key]
+        if isinstance(transfer.sender.f, memoryview):
+            cache.note_served(transfer.sender.size)
+        else:
+            transfer.sender.f.close()
+        now = time.monotonic()
+        for key in [k for k, t in finished.items() if now - t >= LINGER * 2]:
+            del finished[key]
+        finished[transfer.key] = now
+        stats = transfer.sender.stats()
+        stats['completed'] = transfer.sender.done
+        if on_done is not None:
+            on_done(transfer.filename, transfer.addr, stats)
+
+    while True:
+        while waiting and len(active) + len(loading) < max_transfers:
+            key, _ = waiting.popitem(last=False)
+            start(key)
+
+        # Round-robin turns of up to TURN_PACKETS until no transfer can send more
+        turn = list(active.values())
+        while turn:
+            now = time.monotonic()
+            ready = []
+            for transfer in turn:
+                packets = transfer.sender.packets(now, TURN_PACKETS)
+                for packet in packets:
+                    sock.sendto(packet, transfer.addr)
+                if len(packets) == TURN_PACKETS:
+                    ready.append(transfer)
+            turn = ready
+        if len(active) > 1:
+            # A different transfer goes first next time
+            active.move_to_end(next(iter(active)))
+
+        now = time.monotonic()
+        wait = None
+        if active:
+            wait = max(0.0, min(t.sender.next_deadline(now) for t in active.values()) - now)
+        readable, _, _ = select.select([sock, wake_r], [], [], wait)
+        if wake_r in readable:
+            wake_r.recv(4096)
+            while loaded:
+                begin(*loaded.popleft())
+        while sock in readable:
+            try:
+                data, source = sock.recvfrom(65536)
+            except OSError:
+                # e.g. Windows reporting an ICMP port unreachable from a gone client
+                data = b''
+            if data and data[0] == REQUEST:
+                on_request(data, source)
+            elif data and data[0] == ACK and len(data) >= ACK_HEADER.size:
+                transfer = active.get(ACK_HEADER.unpack_from(data)[1])
+                if transfer is not None and transfer.addr == source:
+                    transfer.sender.on_ack(data, time.monotonic())
+            readable, _, _ = select.select([sock], [], [], 0)
+
+        now = time.monotonic()
+        for transfer in list(active.values()):
+            transfer.sender.check_timeouts(now)
+            if transfer.sender.done or transfer.sender.failed:
+                finish(transfer)
@@ -0,0 +1,187 @@
+"""
+Session resume: reconnecting without starting over.
+
+Every client gets a token at login (SESSION:<token>, the first frame of
+its outbound queue). When its connection goes away the server parks what
+the session had: nickname, groups, presence subscription and the outbound
+queue itself, which still holds the frames not yet written plus a replay
+ring of the last frames that were. A parked session is still fanned out
+to like a live one, so what is sent while it is away collects in its gap
+buffer (up to `gap_bytes`, oldest dropped first). A client that
+reconnects within `ttl` seconds sends
+
+    resume=<token>:<position>
+
+in its nickname reply, where position is how many bytes of frames it
+decoded, counting from the start of the SESSION frame. The server answers
+with a new SESSION token, RESUMED:<missed bytes>:<nickname>, the frames
+from that position on, then the gap buffer, and the session's groups
+again, all in the reply to the one hello. Missed bytes are frames that
+had already left the replay ring or were pushed out of the gap buffer (0
+when nothing was lost).
+
+A token whose connection still looks alive (a half-open peer not reaped
+yet) takes that session over. Tokens are per server: in a cluster,
+reconnecting to another node is an ordinary login.
+"""
+import secrets
+import threading
+import time
+from collections import deque
+
+TTL = 120                  # seconds a parked session waits for its client
+REPLAY_BYTES = 256 * 1024  # sent frames each queue keeps for replay
+GAP_BYTES = 4 * 1024 * 1024  # frames a parked session collects while away
+
+
+def new_token():
+    return secrets.token_urlsafe(18)
+
+
+def parse_resume(text):
+    """'<token>:<position>' -> (token, position), or (None, 0) if malformed."""
+    token, _, position = text.partition(':')
+    try:
+        return token, max(int(position or 0), 0)
+    except ValueError:
+        return None, 0
+
+
+class Parked:
+    """
+    What a session that went away leaves for its client to resume. Has
+    send(), groups and presence like a Session, so fan-out can include it.
+    """
+    __slots__ = ('token', 'nickname', 'groups', 'presence', 'outq', 'expires',
+                 'gap', 'gap_bytes', 'gap_limit', 'missed', 'lock')
+
+    def __init__(self, token, session, expires, gap_limit):
+        self.token = token
+        self.nickname = session.nickname
+        self.groups = set(session.groups)
+        self.presence = session.presence
+        self.outq = session.outq  # closed; frames come out through unsent()
+        self.expires = expires
+        self.gap = deque()        # frames sent since it was parked
+        self.gap_bytes = 0
+        self.gap_limit = gap_limit
+        self.missed = 0           # bytes pushed out of the gap buffer
+        self.lock = threading.Lock()
+
+    def send(self, frame):
+        with self.lock:
+            self.gap.append(frame)
+            self.gap_bytes += len(frame)
+            while self.gap_bytes > self.gap_limit:
+                dropped = len(self.gap.popleft())
+                self.gap_bytes -= dropped
+                self.missed += dropped
+
+
+class ResumeTable:
+    """Tokens of live sessions, and parked sessions by token, oldest first."""
+
+    def __init__(self, ttl=TTL, gap_bytes=GAP_BYTES):
+        self.ttl = ttl
+        self.gap_bytes = gap_bytes
+        self.live = {}     # token -> Session
+        self.parked = {}   # token -> Parked; insertion order is expiry order
+        self.by_nick = {}  # nickname -> Parked
+        self.groups = {}   # group -> set of Parked members
+        self.lock = threading.Lock()
+        self.resumed = 0
+        self.expired = 0
+        self.replayed_bytes = 0
+        self.missed_bytes = 0
+
+    def add(self, token, session):
+        with self.lock:
+            self.live[token] = session
+
+    def session(self, token):
+        """The live session holding token, if any."""
+        return self.live.get(token)
+
+    def everyone(self):
+        """Snapshot of the parked sessions, for fan-out."""
+        with self.lock:
+            return list(self.parked.values())
+
+    def members(self, group):
+        """Snapshot of the parked sessions in group."""
+        with self.lock:
+            members = self.groups.get(group)
+            return list(members) if members else []
+
+    def find(self, nickname):
+        return self.by_nick.get(nickname)
+
+    def park(self, token, session):
+        """session is gone: keep it for ttl seconds under token."""
+        now = time.monotonic()
+        with self.lock:
+            if self.live.pop(token, None) is None:
+                return
+            self._expire(now)
+            parked = self.parked[token] = Parked(token, session, now + self.ttl, self.gap_bytes)
+            self.by_nick[parked.nickname] = parked
+            for group in parked.groups:
+                self.groups.setdefault(group, set()).add(parked)
+
+    def release(self, nickname):
+        """Drop the parked session of nickname (it logged in afresh)."""
+        with self.lock:
+            parked = self.by_nick.get(nickname)
+            if parked is not None:
+                self._drop(parked)
+
+    def claim(self, token, position):
+        """
+        Take the parked session for token, if it has not expired: returns
+        (parked, frames from position on, bytes missed), or None.
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            parked = self.parked.get(token)
+            if parked is None:
+                return None
+            self._drop(parked)
+        frames, missed = parked.outq.unsent(position)
+        with parked.lock:
+            frames.extend(parked.gap)
+            missed += parked.missed
+        self.resumed += 1
+        self.replayed_bytes += sum(map(len, frames))
+        self.missed_bytes += missed
+        return parked, frames, missed
+
+    def _drop(self, parked):
+        del self.parked[parked.token]
+        if self.by_nick.get(parked.nickname) is parked:
+            del self.by_nick[parked.nickname]
+        for group in parked.groups:
+            members = self.groups.get(group)
+            if members is not None:
+                members.discard(parked)
+                if not members:
+                    del self.groups[group]
+
+    def _expire(self, now):
+        while self.parked:
+            parked = next(iter(self.parked.values()))
+            if parked.expires > now:
+                break
+            self._drop(parked)
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return {
+                'live': len(self.live),
+                'parked': len(self.parked),
+                'resumed': self.resumed,
+                'expired': self.expired,
+                'replayed_bytes': self.replayed_bytes,
+                'missed_bytes': self.missed_bytes,
+            }
@@ -1,43 +1,240 @@
 import threading
 import socket
 import os
+import errno
+import shutil
+import time
+import re
+import secrets
+import argparse
+from collections import deque
+
+import framing
+from framing import FrameDecoder, encode_frame, encode_text
+from sessions import SessionRegistry
+from outbound import OutboundQueue, POLICIES, send_frames
+import manifest
+from file_index import FileIndex
+from file_cache import FileCache
+from message_log import MessageLog
+from offline import OfflineStore
+import offline
+import bus
+from cluster import Cluster
+import reliable_udp
+import metrics
+import compression
+import commands
+import ratelimit
+import presence as presence_feed
+from presence import Presence, ALL
+import resume
+from resume import ResumeTable
+from timerwheel import TimerWheel
 
 
 host = '127.0.0.1'
 port = 55555
-file_port = 55556  # UDP port for file transfers
+file_port = 55556  # UDP port for file transfers, TCP port for download connections
 shared_dir = os.environ.get("SERVER_SHARED_FILES", "./SharedFiles")
+engine = os.environ.get("SERVER_ENGINE", "thread")  # 'thread' or 'async'
+
+# Per-client outbound queue limits and what to do with a consumer that overflows them
+queue_frames = int(os.environ.get("SERVER_QUEUE_FRAMES", 1024))
+queue_bytes = int(os.environ.get("SERVER_QUEUE_BYTES", 4 * 1024 * 1024))
+overflow_policy = os.environ.get("SERVER_OVERFLOW", "drop-oldest")  # or 'disconnect'
+# Writers wait this long (seconds) after the first queued frame so bursts share one syscall
+flush_window = float(os.environ.get("SERVER_FLUSH_WINDOW", 0.001))
+# UDP downloads served at once; further requests wait their turn
+udp_transfers = int(os.environ.get("SERVER_UDP_TRANSFERS", reliable_udp.MAX_TRANSFERS))
+
+registry = SessionRegistry()
+
+# token -> [filepath, filename, expiry, offset, length, streams left, byte bucket, (low, high) the
+# ranges may span] for TCP downloads not yet picked up
+pending_downloads = {}
+downloads_lock = threading.Lock()
+DOWNLOAD_TOKEN_TTL = 60
+MAX_STREAMS = 8  # parallel connections a client may use for one download
+# token -> [nickname, filename, size, expiry] for uploads whose data connection is not open yet
+pending_uploads = {}
+uploads_lock = threading.Lock()
+upload_names = {}  # filename -> nickname for uploads in flight, so two never race for one name
+upload_usage = {}  # nickname -> bytes uploaded or reserved since the server started
+MAX_UPLOADS = 4    # uploads one user may have in flight
+UPLOAD_BUFFER = 1024 * 1024  # bytes gathered from the socket per positioned write
+UPLOAD_STALE = 3600  # seconds before an untouched partial upload is deleted at startup
+UPLOAD_STAGING = '.uploads'  # under shared_dir; never listed or served
+# Per-chunk hashes of shared files, for resumable downloads
+manifests = manifest.ManifestCache()
+# Cached listing of shared_dir for /files
+file_index = FileIndex(shared_dir, hidden=(UPLOAD_STAGING,))
+# Hot shared files kept in memory for downloads, LRU under this byte budget
+file_cache_bytes = int(os.environ.get("SERVER_FILE_CACHE_BYTES", 256 * 1024 * 1024))
+file_cache = None  # created in main() once the budget is known
+# Persistent chat history (broadcast, /msg and /group); '' turns it off
+log_dir = os.environ.get("SERVER_LOG_DIR", "./MessageLog")
+log_max_bytes = int(os.environ.get("SERVER_LOG_MAX_BYTES", 256 * 1024 * 1024))
+log_retention_days = float(os.environ.get("SERVER_LOG_RETENTION_DAYS", 7))
+message_log = None
+# Store-and-forward for users who are offline: per-recipient backlogs ('' turns it off)
+offline_dir = os.environ.get("SERVER_OFFLINE_DIR", "./OfflineQueue")
+offline_memory = int(os.environ.get("SERVER_OFFLINE_MEMORY", offline.MEMORY_BUDGET))
+offline_max_bytes = int(os.environ.get("SERVER_OFFLINE_MAX_BYTES", offline.MAX_BYTES))
+offline_rate = float(os.environ.get("SERVER_OFFLINE_RATE", 1024 * 1024))  # bytes/s of backlog delivered, in total
+offline_store = None
+# Who is away, and in which groups, is kept by the store; forgotten after this many days
+offline_away_days = float(os.environ.get("SERVER_OFFLINE_AWAY_DAYS", offline.AWAY_TTL / 86400))
+returning = deque()   # sessions with a backlog to deliver, served in turns
+forwarding = set()
+returning_cond = threading.Condition()
+HISTORY_DEFAULT = 20
+HISTORY_MAX = 200
+# Cluster mode: share users and groups with other nodes over this bus ('' = standalone)
+bus_url = os.environ.get("SERVER_BUS", "")
+node_id = os.environ.get("SERVER_NODE_ID", "")
+cluster = None
+reuse_port = False  # several nodes may listen on the same chat port (SO_REUSEPORT)
+# Offered to clients that ask at the handshake: zlib for the chat stream and TCP downloads ('' = off)
+compression_mode = compression.normalize(os.environ.get("SERVER_COMPRESSION", compression.ZLIB))
+# Per-client token buckets by command class (see ratelimit.py; '' = off), clients
+# refused this many frames in a row are disconnected, and download bytes/s per client (0 = off)
+rate_limits = os.environ.get("SERVER_RATE_LIMITS", ratelimit.DEFAULT_LIMITS)
+limits = {}  # parsed in main()
+flood_strikes = int(os.environ.get("SERVER_FLOOD_STRIKES", 200))
+download_rate = float(os.environ.get("SERVER_DOWNLOAD_RATE", 0))
+# Bytes each user may upload into shared_dir per server run (0 = uploads off)
+upload_quota = int(os.environ.get("SERVER_UPLOAD_QUOTA", 1024 * 1024 * 1024))
+upload_dir = None  # shared_dir/UPLOAD_STAGING, set in main(); same filesystem, so the final rename is atomic
+# Ping clients silent for heartbeat_interval seconds and drop them after idle_timeout (0 = off)
+heartbeat_interval = float(os.environ.get("SERVER_HEARTBEAT", 30))
+idle_timeout = float(os.environ.get("SERVER_IDLE_TIMEOUT", 90))
+# One timer per session, all in one wheel, advanced once a second
+heartbeats = TimerWheel(1.0)
+PING_FRAME = encode_frame(b'', framing.PING)
+# Joins and leaves are batched into one presence delta per window (seconds)
+presence_window = float(os.environ.get("SERVER_PRESENCE_WINDOW", presence_feed.WINDOW))
+presence = Presence(presence_window)
+# A client reconnecting within resume_ttl seconds gets its nickname, groups and the frames
+# it missed back (0 = off), replayed from the last resume_replay bytes sent to it
+resume_ttl = float(os.environ.get("SERVER_RESUME_TTL", resume.TTL))
+resume_replay = int(os.environ.get("SERVER_RESUME_REPLAY", resume.REPLAY_BYTES))
+resumes = None
+# Seconds a new connection has to send its nickname (0 = no limit)
+handshake_timeout = float(os.environ.get("SERVER_HANDSHAKE_TIMEOUT", 10))
+# Prometheus text on http://host:metrics_port/metrics (0 = off); /stats works regardless
+metrics_port = int(os.environ.get("SERVER_METRICS_PORT", 0))
+# /stats, /queues and /cache answer only clients that send admin=<token> at the handshake ('' = nobody)
+admin_token = os.environ.get("SERVER_ADMIN_TOKEN", "")
+started_at = time.time()
+
+# Metrics: recorded on the hot paths, only formatted for /stats or a scrape
+command_seconds = metrics.Histogram('chat_command_seconds',
+                                    "Time to handle one chat line, by command", 'command')
+fanout_recipients = metrics.Histogram('chat_fanout_recipients', "Sessions one frame was queued to",
+                                      buckets=metrics.SIZE_BUCKETS)
+bytes_in = metrics.Counter('chat_received_bytes_total', "Bytes of chat frames received from clients")
+# Sessions count their own output; these add up the live ones when read
+bytes_out = metrics.Counter('chat_sent_bytes_total', "Bytes written to chat clients",
+                            fn=lambda: sum(s.outq.sent_bytes for s in registry.sessions()))
+frames_dropped = metrics.Counter('chat_dropped_frames_total', "Frames dropped from full client queues",
+                                 fn=lambda: sum(s.outq.dropped for s in registry.sessions()))
+metrics.Gauge('chat_clients', "Connected clients", fn=lambda: len(registry))
+metrics.Gauge('chat_queued_frames', "Frames waiting in client queues",
+              fn=lambda: sum(len(s.outq) for s in registry.sessions()))
+queue_depth_max = metrics.Gauge('chat_queue_depth_max', "Deepest client queue",
+                                fn=lambda: max((len(s.outq) for s in registry.sessions()), default=0))
+compression_saved = metrics.Counter('compression_saved_bytes_total', "Bytes compression kept off the wire",
+                                    'stream', fn=lambda: {'chat': sum(
+                                        s.compressor.raw_bytes - s.compressor.packed_bytes
+                                        for s in registry.sessions() if s.compressor is not None)})
+throttled = metrics.Counter('chat_throttled_total', "Frames refused by rate limits, by limit", 'limit')
+flood_kicks = metrics.Counter('chat_flood_disconnects_total', "Clients disconnected for flooding")
+# Refusals are pre-encoded and sent at most once a second per client, so they cost next to nothing
+THROTTLED_FRAMES = {name: encode_text(f"RATE_LIMITED:{name}:Slow down, over the '{name}' rate limit; "
+                                      f"some of your messages were dropped")
+                    for name in ratelimit.CLASSES}
+# Clients wait on an answer to these, so each refused one is answered with an error naming its file
+REFUSAL_REPLIES = {'/download': 'FILE_ERROR', '/upload': 'UPLOAD_ERROR'}
+pings_sent = metrics.Counter('chat_heartbeat_pings_total', "Heartbeat pings sent to quiet clients")
+reaped = metrics.Counter('chat_reaped_connections_total', "Clients dropped for not answering heartbeats")
+metrics.Gauge('chat_heartbeat_timers', "Heartbeat timers in the timer wheel", fn=lambda: len(heartbeats))
+downloads_active = metrics.Gauge('file_downloads_active', "Downloads being served", 'protocol')
+download_bytes = metrics.Counter('file_download_bytes_total', "File bytes sent to clients", 'protocol')
+download_seconds = metrics.Histogram('file_download_seconds', "Duration of finished downloads",
+                                     'protocol', buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800))
+offline_queued = metrics.Counter('chat_offline_queued_total', "Messages kept for users who were offline")
+offline_refused = metrics.Counter('chat_offline_refused_total', "Messages refused because a backlog was full")
+offline_forwarded = metrics.Counter('chat_offline_forwarded_bytes_total', "Backlog bytes delivered to returning users")
+metrics.Gauge('chat_offline_backlogs', "Users with messages waiting",
+              fn=lambda: len(offline_store) if offline_store is not None else 0)
+metrics.Gauge('chat_offline_away', "Users remembered as away, with their groups",
+              fn=lambda: len(offline_store.away) if offline_store is not None else 0)
+metrics.Counter('chat_offline_forgotten_total', "Away users forgotten after --offline-away-days",
+                fn=lambda: offline_store.expired if offline_store is not None else 0)
+presence_deltas = metrics.Counter('chat_presence_deltas_total', "Presence deltas sent, each batching a window of changes")
+metrics.Gauge('chat_presence_changes', "Joins, leaves and group changes recorded for presence",
+              fn=lambda: presence.events)
+metrics.Gauge('chat_resume_parked', "Sessions waiting for their client to resume them",
+              fn=lambda: len(resumes.parked) if resumes is not None else 0)
+metrics.Counter('chat_resumed_total', "Sessions resumed with a token",
+                fn=lambda: resumes.resumed if resumes is not None else 0)
+uploads_active = metrics.Gauge('file_uploads_active', "Uploads being received")
+upload_bytes = metrics.Counter('file_upload_bytes_total', "File bytes received from clients")
+upload_seconds = metrics.Histogram('file_upload_seconds', "Duration of finished uploads",
+                                   buckets=download_seconds.buckets)
 
-# Create shared directory if it doesn't exist
-if not os.path.exists(shared_dir):
-    os.makedirs(shared_dir)
-    print(f"Created shared files directory: {shared_dir}")
+def fanout(sessions, frame, exclude=None):
+    """Queue one encoded frame to many sessions; they all share the same bytes."""
+    fanout_recipients.observe(len(sessions))
+    for session in sessions:
+        if session is not exclude:
+            session.send(frame)
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server.bind((host, port))
-server.listen()
-print(f"Server started on {host}:{port}")
-print(f"File transfer port (UDP): {file_port}")
-print(f"Shared files directory: {shared_dir}")
+def everyone():
+    """Live sessions, plus parked ones (resume.py) which keep what they are sent."""
+    if resumes is None or not resumes.parked:
+        return registry.sessions()
+    return registry.sessions() + resumes.everyone()
 
-clients = []
-nicknames = []
-groups = {}
+def group_members(group):
+    """
+    A group's live members, plus its parked ones unless offline delivery
+    is on (then their group messages are queued in the offline store).
+    """
+    if resumes is None or offline_store is not None or not resumes.parked:
+        return registry.members(group)
+    return registry.members(group) + resumes.members(group)
+
+def find_user(nickname):
+    """The session for nickname: live, or parked when there is no offline store."""
+    session = registry.find(nickname)
+    if session is None and resumes is not None and offline_store is None:
+        session = resumes.find(nickname)
+    return session
 
-def broadcast(message, sender=None):
+def broadcast(message, sender=None, channel=None):
     """
-    Send message (bytes) to all clients except the sender.
-    If sender is None, send to everyone.
+    Send message (bytes) to all sessions except the sender.
+    If sender is None, send to everyone. In cluster mode the other nodes
+    deliver it to their users as well, logging it under channel if given.
     """
-    for client in clients:
-        if client != sender:
-            client.send(message)
+    frame = encode_frame(message)
+    fanout(everyone(), frame, exclude=sender)
+    if cluster is not None:
+        cluster.broadcast(frame, channel)
 
-def send_text(sock, text):
-    """Helper to send UTF-8 text as bytes with newline delimiter."""
+def group_send(group, text, sender=None, channel=None):
+    """Send text to every member of group on this node and, in cluster mode, the others."""
+    frame = encode_text(text)
+    fanout(group_members(group), frame, exclude=sender)
+    if cluster is not None:
+        cluster.group(group, frame, channel)
+
+def send_text(session, text):
+    """Helper to send UTF-8 text as one TEXT frame."""
     try:
-        sock.sendall((text + "\n").encode('utf-8'))
+        session.send(encode_text(text))
     except:
         pass
 
@@ -45,233 +242,1293 @@ def format_chat(nick, text):
     """Create standard chat line '<nick>: <text>'"""
     return f"{nick}: {text}"
 
-def get_file_list():
-    """Get list of files in shared directory with sizes."""
+def log_message(channel, line):
+    """Append a delivered chat line to the persistent history, if enabled."""
+    if message_log is not None:
+        message_log.append(channel, line)
+
+def deliver_remote_broadcast(frame, channel):
+    """Cluster bus: a broadcast from a user on another node."""
+    fanout(everyone(), frame)
+    if channel:
+        log_message(channel, str(frame[framing.HEADER_SIZE:], 'utf-8'))
+
+def deliver_remote_group(group, frame, channel):
+    """Cluster bus: a group message or notice from another node."""
+    members = group_members(group)
+    fanout(members, frame)
+    if channel:
+        line = str(frame[framing.HEADER_SIZE:], 'utf-8')
+        if members:
+            log_message(channel, line)
+        queue_group_offline(group, line)
+
+def deliver_remote_private(nick, sender_nick, line):
+    """Cluster bus: a /msg from a user on another node to one of ours."""
+    target_session = find_user(nick)
+    if target_session is not None:
+        send_text(target_session, line)
+        log_message(private_channel(sender_nick, nick), line)
+
+def queue_offline(nickname, line):
+    """
+    Keep line for a user who is offline until they are back. Returns True
+    if it was queued, False if their backlog is full and None if nickname
+    has not been seen (or offline delivery is off).
+    """
+    if offline_store is None or not offline_store.known(nickname):
+        return None
+    if not offline_store.put(nickname, encode_text(f"[Queued {time.strftime('%H:%M:%S')}] {line}")):
+        offline_refused.inc()
+        return False
+    offline_queued.inc()
+    session = registry.find(nickname)
+    if session is not None:
+        forward(session)  # came back while we were queueing
+    return True
+
+def queue_group_offline(group, line):
+    """Queue a group message for the members of group who are offline."""
+    if offline_store is None:
+        return
+    for nickname in offline_store.away_members(group):
+        queue_offline(nickname, line)
+
+def forward(session):
+    """Have the forwarder deliver session's backlog."""
+    with returning_cond:
+        if session not in forwarding:
+            forwarding.add(session)
+            returning.append(session)
+            returning_cond.notify()
+
+def forward_loop():
+    """
+    Deliver backlogs to users who came back: one batch per user per turn,
+    so a long backlog never holds up the others, no faster than
+    offline_rate bytes a second in total and only while the user's queue
+    has room, so live chat is never pushed out by the backlog.
+    """
+    bucket = ratelimit.byte_bucket(offline_rate)
+    while True:
+        with returning_cond:
+            while not returning:
+                returning_cond.wait()
+            session = returning.popleft()
+            forwarding.discard(session)
+        if registry.get(session.conn) is not session:
+            continue  # left again; the rest waits for next time
+        if session.outq.queued_bytes > offline.BATCH_BYTES:
+            # Still writing the last batch: its writer puts it back in line once it takes the queue
+            session.outq.when_drained(lambda session=session: forward(session), offline.BATCH_BYTES)
+            continue
+        batch = offline_store.take(session.nickname)
+        if not batch:
+            continue
+        session.send(batch)  # whole frames back to back, as the writer sends them anyway
+        offline_forwarded.inc(len(batch))
+        if bucket is not None:
+            bucket.wait(len(batch))
+        forward(session)
+
+def welcome_back(session, groups=()):
+    """
+    Put a returning user back in their groups (those given and those kept
+    while it was away) and start delivering their backlog.
+    """
+    nickname = session.nickname
+    groups = set(groups)
+    if offline_store is not None:
+        groups |= offline_store.came_back(nickname)
+    for g in sorted(groups):
+        registry.join(session, g)
+        presence.joined(nickname, g)
+        if cluster is not None:
+            cluster.group_joined(g, nickname)
+        send_text(session, f"Rejoined group '{g}'")
+    if offline_store is not None and offline_store.pending(nickname):
+        send_text(session, "Delivering messages sent while you were away...")
+        forward(session)
+
+def private_channel(a, b):
+    """History channel shared by the two ends of a /msg conversation."""
+    return '@' + ','.join(sorted((a, b)))
+
+def send_history(session, args):
+    """
+    /history [#group|@nick] [count] [before <id>] [since <HH:MM>]: one page
+    of stored messages, oldest first, as a single HISTORY frame.
+    """
+    if message_log is None:
+        send_text(session, "History is not enabled on this server")
+        return
+    label, channel = 'all', 'all'
+    if args and args[0][0] in '#@':
+        label = args.pop(0)
+        if label[0] == '#':
+            if not registry.in_group(session, label[1:]):
+                send_text(session, f"Join group '{label[1:]}' to read its history")
+                return
+            channel = label
+        else:
+            channel = private_channel(session.nickname, label[1:])
+    count, before, since = HISTORY_DEFAULT, None, None
     try:
-        files = []
-        for filename in os.listdir(shared_dir):
-            filepath = os.path.join(shared_dir, filename)
-            if os.path.isfile(filepath):
-                size = os.path.getsize(filepath)
-                files.append((filename, size))
-        return files
+        while args:
+            arg = args.pop(0)
+            if arg == 'before':
+                before = int(args.pop(0))
+            elif arg == 'since':
+                hours, minutes = (int(x) for x in args.pop(0).split(':'))
+                now = time.localtime()
+                since = time.mktime(now[:3] + (hours, minutes, 0) + now[6:])
+                if since > time.time():
+                    since -= 24 * 3600  # a time later than now means yesterday
+            else:
+                count = min(max(int(arg), 1), HISTORY_MAX)
+    except (ValueError, IndexError):
+        send_text(session, "Usage: /history [#group|@nick] [count] [before <id>] [since <HH:MM>]")
+        return
+    message_log.flush()  # wait for the group commit, so the last few ms are included
+    records = message_log.history(channel, count, before, since)
+    more = records[0][0] if len(records) == count else ''
+    lines = [f"HISTORY:{label}:{more}"]
+    lines.extend(f"{timestamp:.3f}:{text}" for _, timestamp, text in records)
+    send_text(session, '\n'.join(lines))
+
+def stats_report():
+    """Text for /stats: the metrics a person usually wants, summarised."""
+    up = int(time.time() - started_at)
+    lines = [f"Server stats (up {up // 3600}h{up % 3600 // 60:02d}m, {len(registry)} clients):"]
+    per_command = []
+    for command, (_, _, n) in sorted(command_seconds.collect().items()):
+        p50 = command_seconds.quantile(0.5, command) * 1000
+        p99 = command_seconds.quantile(0.99, command) * 1000
+        per_command.append(f"{command} {n} (p50 {p50:.2f} ms, p99 {p99:.2f} ms)")
+    lines.append("  commands: " + (', '.join(per_command) or 'none yet'))
+    fanouts = fanout_recipients.collect().get(None)
+    if fanouts:
+        lines.append(f"  fan-out: {fanouts[2]} frames, {fanouts[1] / fanouts[2]:.1f} recipients on average, "
+                     f"p99 {fanout_recipients.quantile(0.99):.0f}")
+    lines.append(f"  traffic: {bytes_in.get():,} bytes in, {bytes_out.get():,} bytes out; "
+                 f"queues: {sum(len(s.outq) for s in registry.sessions())} frames waiting, "
+                 f"deepest {queue_depth_max.get()}, {frames_dropped.get()} dropped")
+    saved = compression_saved.collect()
+    lines.append(f"  compression: {saved.get('chat', 0):,} bytes saved on chat, "
+                 f"{saved.get('download', 0):,} on downloads")
+    lines.append(f"  heartbeats: {len(heartbeats)} timers, {pings_sent.get()} pings sent, "
+                 f"{reaped.get()} silent clients reaped")
+    lines.append(f"  presence: {presence.events} changes sent as {presence_deltas.get()} deltas "
+                 f"(version {presence.version}, {presence.window * 1000:g} ms window)")
+    if resumes is not None:
+        r = resumes.stats()
+        lines.append(f"  resume: {r['live']} tokens out, {r['parked']} sessions parked, {r['resumed']} resumed "
+                     f"({r['replayed_bytes']:,} bytes replayed, {r['missed_bytes']:,} missed), {r['expired']} expired")
+    if offline_store is not None:
+        backlogs = offline_store.stats()
+        lines.append(f"  offline: {backlogs['backlogs']} users with messages waiting "
+                     f"({backlogs['memory_bytes']:,} bytes in memory, {backlogs['disk_bytes']:,} on disk), "
+                     f"{offline_queued.get()} queued, {offline_refused.get()} refused, "
+                     f"{offline_forwarded.get():,} bytes delivered; {backlogs['away']} users away, "
+                     f"{backlogs['expired']} forgotten")
+    refused = throttled.collect()
+    by_limit = ', '.join(f"{name} {n}" for name, n in sorted(refused.items()))
+    lines.append(f"  rate limits: {sum(refused.values())} frames refused{' (' + by_limit + ')' if by_limit else ''}, "
+                 f"{flood_kicks.get()} clients disconnected for flooding")
+    durations = download_seconds.collect()
+    for protocol in ('tcp', 'udp'):
+        _, seconds, done = durations.get(protocol, (None, 0, 0))
+        nbytes = download_bytes.get(protocol)
+        rate = nbytes / seconds / 1e6 if seconds else 0
+        lines.append(f"  {protocol} downloads: {downloads_active.get(protocol)} active, {done} finished, "
+                     f"{nbytes:,} bytes at {rate:.1f} MB/s each on average")
+    _, seconds, done = upload_seconds.collect().get(None, (None, 0, 0))
+    nbytes = upload_bytes.get()
+    rate = nbytes / seconds / 1e6 if seconds else 0
+    lines.append(f"  uploads: {uploads_active.get()} active, {done} finished, "
+                 f"{nbytes:,} bytes at {rate:.1f} MB/s each on average")
+    return '\n'.join(lines)
+
+def file_listing(pattern='', page=1):
+    """One page of the shared files index as a single FILES frame's text."""
+    items, page, pages, total = file_index.page(pattern, page)
+    lines = [f"FILES:{page}:{pages}:{total}:{pattern}"]
+    lines.extend(f"{filename}:{size}" for filename, size in items)
+    return '\n'.join(lines)
+
+def shared_file_path(filename):
+    """
+    Path of filename inside shared_dir, or None if there is no such file.
+    Partial uploads in the staging directory and anything outside shared_dir
+    are never found.
+    """
+    name = os.path.normpath(filename)
+    first = name.replace('\\', '/').split('/', 1)[0].lower()
+    if os.path.isabs(name) or first in ('..', UPLOAD_STAGING):
+        return None
+    filepath = os.path.join(shared_dir, name)
+    return filepath if os.path.isfile(filepath) else None
+
+def offer_download(session, filename, protocol, offset=0, length=0, streams=1):
+    """
+    Send the file's chunk manifest, then where to fetch the requested range:
+    a data-connection token for TCP (good for `streams` connections) or the
+    UDP server address. Runs in its own thread since hashing a new or
+    changed file can take a while.
+    """
+    filepath = shared_file_path(filename)
+    if filepath is None:
+        send_text(session, f"FILE_ERROR:File not found\n{filename}")
+        return
+    try:
+        filesize, digests = manifests.get(filepath)
+    except OSError as e:
+        send_text(session, f"FILE_ERROR:{e}\n{filename}")
+        return
+    if offset > filesize:
+        send_text(session, f"FILE_ERROR:Range starts past the end of the file\n{filename}")
+        return
+    length = filesize - offset if not length else min(length, filesize - offset)
+    send_text(session, f"MANIFEST:{filesize}:{manifests.chunk_size}:{manifest.encode(digests)}:{filename}")
+    if protocol == 'udp':
+        send_text(session, f"UDP_INFO:{host}:{file_port}:{offset}:{length}:{streams}:{filename}")
+        return
+    token = secrets.token_hex(16)
+    now = time.monotonic()
+    with downloads_lock:
+        # Forget offers that were never picked up
+        for t in [t for t, d in pending_downloads.items() if d[2] < now]:
+            del pending_downloads[t]
+        bucket = session.limiter.transfer if session.limiter is not None else None
+        # Ranges may reach out to whole manifest chunks, so the client can check what it fetched
+        cs = manifests.chunk_size
+        bounds = (offset // cs * cs, min(filesize, -(-(offset + length) // cs) * cs))
+        pending_downloads[token] = [filepath, filename, now + DOWNLOAD_TOKEN_TTL, offset, length, streams,
+                                    bucket, bounds]
+    send_text(session, f"FILE_READY:{file_port}:{token}:{filesize}:{offset}:{length}:{streams}:{filename}")
+
+def parse_ranges(specs, offset, length, bounds=None):
+    """
+    Turn 'offset:length' strings into (offset, length) pairs inside bounds
+    (low, high), by default the offered range; no specs means the whole
+    offer. Returns None if any is bad.
+    """
+    if not specs:
+        return [(offset, length)]
+    low, high = bounds if bounds is not None else (offset, offset + length)
+    ranges = []
+    for spec in specs:
+        try:
+            start, size = (int(x) for x in spec.split(':'))
+        except ValueError:
+            return None
+        if start < low or size < 0 or start + size > high:
+            return None
+        ranges.append((start, size))
+    return ranges
+
+def paced(ranges, bucket):
+    """
+    The ranges as they are, or, under a byte-rate limit, cut into slices
+    that are each handed out only once the bucket has room for them.
+    """
+    if bucket is None:
+        yield from ranges
+        return
+    for start, size in ranges:
+        end = start + size
+        while start < end:
+            n = min(ratelimit.PACE_SLICE, end - start)
+            bucket.wait(n)
+            yield start, n
+            start += n
+
+def send_compressed(conn, source, entry, ranges, bucket=None):
+    """
+    Send ranges as frames of at most one manifest chunk each, deflated
+    where that saves space (see compression.pack_block). source is the
+    open file or the cache entry's buffer; whole chunks of a cached file
+    are compressed once and kept with the entry. bucket, if given, paces
+    the frames. Returns bytes sent.
+    """
+    chunk_size = manifests.chunk_size
+    sent = 0
+    for start, size in ranges:
+        end = start + size
+        while start < end:
+            stop = min(end, (start // chunk_size + 1) * chunk_size)
+            if entry is not None and start % chunk_size == 0 and stop == min(start + chunk_size, entry.size):
+                # A whole chunk of a cached file: compressed once, kept with the entry
+                frame = file_cache.derive(entry, ('zlib', start // chunk_size),
+                                          lambda: compression.pack_block(entry.data[start:stop]))
+            else:
+                frame = compression.pack_block(reliable_udp.read_at(source, start, stop - start))
+            if bucket is not None:
+                bucket.wait(len(frame))
+            conn.sendall(frame)
+            sent += len(frame)
+            start = stop
+    return sent
+
+def compresses(entry, source):
+    """Whether deflating a file pays, judged from a sample (remembered for cached files)."""
+    if entry is not None and entry.compressible is not None:
+        return entry.compressible
+    size = entry.size if entry is not None else os.fstat(source.fileno()).st_size
+    worth = compression.worth_compressing(
+        compression.sample(lambda offset, n: reliable_udp.read_at(source, offset, n), size))
+    if entry is not None:
+        entry.compressible = worth
+    return worth
+
+def serve_transfer(conn, address):
+    """One TCP data connection: a download (GET <token> ...) or an upload (PUT <token>)."""
+    try:
+        conn.settimeout(30)
+        decoder = FrameDecoder()
+        parts = read_frame(conn, decoder).split()
+        if len(parts) == 2 and parts[0] == 'PUT':
+            receive_upload(conn, address, parts[1], decoder)
+        else:
+            send_file_tcp(conn, address, parts)
     except Exception as e:
-        print(f"Error listing files: {e}")
-        return []
+        print(f"Error on data connection from {address}: {e}")
+    finally:
+        conn.close()
 
-def send_file_tcp(client_sock, filename):
-    """Send file to client via TCP."""
+def send_file_tcp(conn, address, parts):
+    """
+    Serve one download: check its token, then sendfile() the requested
+    ranges back to back, or send them compressed if the client asked for
+    zlib and the file compresses.
+    """
     try:
-        filepath = os.path.join(shared_dir, filename)
-        if not os.path.exists(filepath):
-            send_text(client_sock, "FILE_ERROR:File not found")
+        with downloads_lock:
+            offer = pending_downloads.get(parts[1]) if len(parts) >= 2 and parts[0] == 'GET' else None
+            if offer is not None:
+                # One use per parallel stream the client asked for
+                offer[5] -= 1
+                if not offer[5]:
+                    del pending_downloads[parts[1]]
+        if offer is None:
+            conn.sendall(encode_text("ERROR:Invalid or expired download token"))
             return
+        filepath, filename, _, offset, length, _, bucket, bounds = offer
+        # An option word (compression) may come before the ranges; drop one we do not offer
+        option = parts[2] if len(parts) > 2 and ':' not in parts[2] else None
+        compress = option == compression.ZLIB and compression_mode == compression.ZLIB
+        ranges = parse_ranges(parts[2 if option is None else 3:], offset, length, bounds)
+        if ranges is None:
+            conn.sendall(encode_text("ERROR:Invalid range"))
+            return
+        total = sum(size for _, size in ranges)
+        started = time.perf_counter()
+        downloads_active.inc(key='tcp')
+        try:
+            entry = file_cache.get(filepath) if file_cache is not None else None
+            if entry is not None and not all(start + size <= entry.size for start, size in ranges):
+                entry = None
+            f = open(filepath, 'rb') if entry is None else None
+            try:
+                source = entry.data if entry is not None else f
+                compress = compress and compresses(entry, source)
+                if compress:
+                    conn.sendall(encode_text(f"OK:{total}:{compression.ZLIB}"))
+                    sent = send_compressed(conn, source, entry, ranges, bucket)
+                    compression_saved.inc(total - sent, 'download')
+                elif entry is not None:
+                    # Hot file: straight from the shared in-memory copy
+                    conn.sendall(encode_text(f"OK:{total}"))
+                    for start, size in paced(ranges, bucket):
+                        conn.sendall(entry.data[start:start + size])
+                    sent = total
+                else:
+                    conn.sendall(encode_text(f"OK:{total}"))
+                    # Kernel copies page cache straight to the socket (os.sendfile)
+                    sent = 0
+                    for start, size in paced(ranges, bucket):
+                        if size:
+                            sent += conn.sendfile(f, start, size)
+            finally:
+                if f is not None:
+                    f.close()
+            if entry is not None:
+                file_cache.note_served(total)
+            origin = ("cache" if entry is not None else "disk") + (", zlib" if compress else "")
+        finally:
+            downloads_active.dec(key='tcp')
+        download_bytes.inc(sent, 'tcp')
+        download_seconds.observe(time.perf_counter() - started, 'tcp')
+        print(f"Sent file {filename} via TCP to {address} "
+              f"({sent} bytes in {len(ranges)} range(s) from {origin})")
+    except Exception as e:
+        print(f"Error sending file to {address}: {e}")
 
-        filesize = os.path.getsize(filepath)
-        send_text(client_sock, f"FILE_START:{filename}:{filesize}")
+def reserve_upload(nickname, filename, size):
+    """
+    Check an upload against the name rules, the free disk space and the
+    user's quota, and hold its name and bytes for it. Returns (token, None)
+    or (None, reason).
+    """
+    if not upload_quota:
+        return None, "Uploads are turned off"
+    if filename.startswith('.') or os.path.basename(filename) != filename or '\\' in filename:
+        return None, "Invalid file name"
+    if shared_file_path(filename) is not None:
+        return None, "A file with that name is already shared"
+    if shutil.disk_usage(shared_dir).free < size:
+        return None, "Not enough disk space"
+    now = time.monotonic()
+    with uploads_lock:
+        # Give back what uploads that never connected were holding
+        for t in [t for t, u in pending_uploads.items() if u[3] < now]:
+            owner, name, nbytes, _ = pending_uploads.pop(t)
+            upload_names.pop(name, None)
+            upload_usage[owner] -= nbytes
+        if filename in upload_names:
+            return None, "That file is already being uploaded"
+        if sum(1 for owner in upload_names.values() if owner == nickname) >= MAX_UPLOADS:
+            return None, f"At most {MAX_UPLOADS} uploads at a time"
+        used = upload_usage.get(nickname, 0)
+        if used + size > upload_quota:
+            return None, f"Upload quota exceeded ({used:,} of {upload_quota:,} bytes used)"
+        token = secrets.token_hex(16)
+        upload_names[filename] = nickname
+        upload_usage[nickname] = used + size
+        pending_uploads[token] = [nickname, filename, size, now + DOWNLOAD_TOKEN_TTL]
+    return token, None
+
+def preallocate(f, size):
+    """Give f its full size up front, so a full disk fails the upload before any data moves."""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+    f.truncate(size)  # filesystems without fallocate
 
-        with open(filepath, 'rb') as f:
-            while True:
-                chunk = f.read(4096)
-                if not chunk:
-                    break
-                client_sock.send(chunk)
+def receive_into(conn, f, size, leftover=b''):
+    """
+    Copy size bytes from conn into f: recv_into() fills one reused buffer
+    and each full buffer is one positioned write. Returns bytes received,
+    fewer than size if the peer went away.
+    """
+    received = len(leftover)
+    if leftover:
+        reliable_udp.write_at(f, 0, leftover)
+    view = memoryview(bytearray(UPLOAD_BUFFER))
+    while received < size:
+        want = min(UPLOAD_BUFFER, size - received)
+        filled = 0
+        while filled < want:
+            n = conn.recv_into(view[filled:want])
+            if not n:
+                break
+            filled += n
+        if filled:
+            reliable_udp.write_at(f, received, view[:filled])
+            received += filled
+        if filled < want:
+            break
+    return received
 
-        send_text(client_sock, "FILE_END")
-        print(f"Sent file {filename} via TCP ({filesize} bytes)")
+def receive_upload(conn, address, token, decoder):
+    """
+    Serve one upload: check its token, write the bytes into a preallocated
+    file in upload_dir and rename it into shared_dir once all of them are
+    there, so /files and downloads never see a partial file.
+    """
+    with uploads_lock:
+        upload = pending_uploads.pop(token, None)
+    if upload is None:
+        conn.sendall(encode_text("ERROR:Invalid or expired upload token"))
+        return
+    nickname, filename, size, _ = upload
+    filepath = os.path.join(shared_dir, filename)
+    temppath = os.path.join(upload_dir, token)
+    started = time.perf_counter()
+    received = 0
+    done = False
+    uploads_active.inc()
+    try:
+        with open(temppath, 'wb', buffering=0) as f:
+            preallocate(f, size)
+            conn.sendall(encode_text(f"OK:{size}"))
+            received = receive_into(conn, f, size, decoder.drain()[:size])
+        if received < size:
+            raise ConnectionError(f"connection closed after {received:,} of {size:,} bytes")
+        if os.path.exists(filepath):
+            raise FileExistsError("A file with that name is already shared")  # appeared meanwhile
+        os.replace(temppath, filepath)
+        done = True
     except Exception as e:
-        print(f"Error sending file {filename}: {e}")
-        send_text(client_sock, f"FILE_ERROR:{str(e)}")
+        print(f"Upload of {filename} from {nickname} at {address} failed: {e}")
+        try:
+            conn.sendall(encode_text(f"ERROR:{e}"))
+        except OSError:
+            pass
+        return
+    finally:
+        uploads_active.dec()
+        upload_bytes.inc(received)
+        with uploads_lock:
+            upload_names.pop(filename, None)
+            if not done:
+                upload_usage[nickname] -= size
+        if not done:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+    # New name in shared_dir: make /files and the caches see it now
+    file_index.invalidate()
+    if file_cache is not None:
+        file_cache.invalidate(filepath)
+    upload_seconds.observe(time.perf_counter() - started)
+    conn.sendall(encode_text(f"DONE:{size}"))
+    print(f"Received {filename} from {nickname} at {address} ({size} bytes)")
+    broadcast(f"{nickname} shared {filename} ({size:,} bytes)".encode('utf-8'))
+
+def serve_transfers(data_server):
+    """Accept TCP data connections; each download or upload gets its own thread."""
+    while True:
+        conn, address = data_server.accept()
+        threading.Thread(target=serve_transfer, args=(conn, address), daemon=True).start()
 
 def handle_udp_file_transfer():
-    """Handle UDP file transfer requests."""
+    """Handle UDP file transfer requests with the reliable UDP protocol."""
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_sock.bind((host, file_port))
     print(f"UDP file transfer server listening on {host}:{file_port}")
 
+    def started(filename, addr):
+        downloads_active.inc(key='udp')
+
+    def report(filename, addr, stats):
+        downloads_active.dec(key='udp')
+        if stats['completed']:
+            download_bytes.inc(stats['bytes'], 'udp')
+            download_seconds.observe(stats['elapsed'], 'udp')
+            print(f"Sent file {filename} via UDP to {addr} ({stats['bytes']} bytes, "
+                  f"{stats['retransmits']} retransmits)")
+        else:
+            print(f"UDP transfer of {filename} to {addr} abandoned: client stopped responding")
+
     while True:
         try:
-            data, addr = udp_sock.recvfrom(1024)
-            request = data.decode('utf-8', errors='ignore')
-
-            if request.startswith('REQUEST:'):
-                filename = request.split(':', 1)[1].strip()
-                filepath = os.path.join(shared_dir, filename)
-
-                if not os.path.exists(filepath):
-                    udp_sock.sendto(b"ERROR:File not found", addr)
-                    continue
-
-                filesize = os.path.getsize(filepath)
-                # Send file info
-                udp_sock.sendto(f"START:{filesize}".encode(), addr)
-
-                # Send file data in chunks
-                with open(filepath, 'rb') as f:
-                    seq = 0
-                    while True:
-                        chunk = f.read(1024)
-                        if not chunk:
-                            break
-                        udp_sock.sendto(f"DATA:{seq}:".encode() + chunk, addr)
-                        seq += 1
-
-                udp_sock.sendto(b"END", addr)
-                print(f"Sent file {filename} via UDP to {addr} ({filesize} bytes)")
+            reliable_udp.serve(udp_sock, shared_file_path, on_done=report,
+                               max_transfers=udp_transfers, cache=file_cache, on_start=started,
+                               max_rate=download_rate)
         except Exception as e:
             print(f"UDP error: {e}")
 
-def handle(client):
-    while True:
+def handle_message(session, data, kind=framing.TEXT, offload=None):
+    """
+    Process one frame received from a registered session, timed per
+    command. offload(fn, *args), if given, runs blocking commands somewhere
+    other than the caller (the asyncio engine's worker threads).
+    """
+    session.seen = heartbeats.now  # any frame shows the client is alive
+    if kind == framing.PONG:
+        return
+    started = time.perf_counter()
+    bytes_in.inc(len(data) + framing.HEADER_SIZE)
+    if kind == framing.CMD:
         try:
-            data = client.recv(1024)
-            if not data:
-                raise ConnectionError()
-
-            # Resolve sender nickname
-            if client in clients:
-                sender_idx = clients.index(client)
-                sender_nick = nicknames[sender_idx]
+            command, target, text = command_table.parse_binary(data)
+        except ValueError as e:
+            send_text(session, f"Usage: CMD frames are opcode, target length, target, text ({e})")
+            return
+        if command is None:
+            send_text(session, f"Unknown opcode {data[0]}")
+            return
+    else:
+        decoded = str(data, 'utf-8', errors='ignore').strip()
+        # Older clients send '<nick>: ' in front of every line; strip it to avoid double-nick
+        if decoded.startswith(session.nickname) and decoded.startswith(': ', len(session.nickname)):
+            decoded = decoded[len(session.nickname) + 2:]
+        command, target, text = command_table.parse_text(decoded)
+    limiter = session.limiter
+    if limiter is not None:
+        refused = limiter.allow(command.limit)
+        if refused is not None:
+            throttled.inc(key=refused)
+            if limiter.strikes >= flood_strikes:
+                if limiter.strikes == flood_strikes:
+                    flood_kicks.inc()
+                    print(f"Disconnecting {session.nickname}: {limiter.strikes} frames over its rate limits in a row")
+                    session.kick()
+                # Whatever it already had buffered is dropped on the way out
             else:
-                sender_nick = "Unknown"
-
-            decoded = data.decode('utf-8', errors='ignore').strip()
-
-            # If the client sent with a '<nick>: ' prefix, strip it to avoid double-nick
-            if decoded.startswith(f"{sender_nick}: "):
-                decoded = decoded[len(sender_nick) + 2:]
-
-            # Commands
-            if decoded.startswith('/msg '):
-                try:
-                    _, target, text = decoded.split(' ', 2)
-                    if target in nicknames:
-                        target_client = clients[nicknames.index(target)]
-                        send_text(target_client, f"[Private] {sender_nick}: {text}")
-                        # Optional feedback to sender
-                        send_text(client, f"[To {target}] {text}")
-                    else:
-                        send_text(client, f"User '{target}' not found")
-                except ValueError:
-                    send_text(client, "Usage: /msg <nickname> <message>")
-
-            elif decoded.startswith('/join '):
-                parts = decoded.split(' ', 1)
-                group = parts[1].strip() if len(parts) > 1 else ''
-                if not group:
-                    send_text(client, "Usage: /join <group>")
-                else:
-                    members = groups.setdefault(group, set())
-                    members.add(client)
-                    send_text(client, f"Joined group '{group}'")
-                    # Notify group members except sender
-                    for m in list(members):
-                        if m != client:
-                            send_text(m, f"{sender_nick} joined group '{group}'")
-
-            elif decoded.startswith('/leave '):
-                parts = decoded.split(' ', 1)
-                group = parts[1].strip() if len(parts) > 1 else ''
-                if not group:
-                    send_text(client, "Usage: /leave <group>")
-                else:
-                    members = groups.get(group)
-                    if members and client in members:
-                        members.remove(client)
-                        send_text(client, f"Left group '{group}'")
-                        for m in list(members):
-                            send_text(m, f"{sender_nick} left group '{group}'")
-                        if not members:
-                            # Clean up empty group
-                            groups.pop(group, None)
-                    else:
-                        send_text(client, f"Not a member of group '{group}'")
-
-            elif decoded.startswith('/group '):
-                try:
-                    _, group, text = decoded.split(' ', 2)
-                except ValueError:
-                    send_text(client, "Usage: /group <group> <message>")
-                    continue
-                members = groups.get(group)
-                if not members or client not in members:
-                    send_text(client, f"You are not in group '{group}'")
-                else:
-                    for m in list(members):
-                        if m != client:
-                            send_text(m, f"[{group}] {sender_nick}: {text}")
-            elif decoded == '/files':
-                files = get_file_list()
-                if not files:
-                    send_text(client, "No files available in shared directory")
-                else:
-                    send_text(client, "FILES_LIST_START")
-                    for filename, size in files:
-                        send_text(client, f"FILE:{filename}:{size}")
-                    send_text(client, "FILES_LIST_END")
-
-            elif decoded.startswith('/download '):
-                parts = decoded.split()
-                if len(parts) < 3:
-                    send_text(client, "Usage: /download <filename> <tcp|udp>")
-                else:
-                    filename = parts[1]
-                    protocol = parts[2].lower()
+                if command.name in REFUSAL_REPLIES:
+                    filename = text.split(maxsplit=1)[0] if text else ''
+                    send_text(session, f"{REFUSAL_REPLIES[command.name]}:Over the '{refused}' rate limit, "
+                                       f"try again shortly\n{filename}")
+                if limiter.should_warn():
+                    session.send(THROTTLED_FRAMES[refused])
+            return
+    if command.admin and not session.admin:
+        send_text(session, f"{command.name} is for server admins")
+        return
+    if command.blocking and offload is not None:
+        offload(run_command, command, session, target, text, started)
+        return
+    run_command(command, session, target, text, started)
 
-                    if protocol == 'tcp':
-                        send_file_tcp(client, filename)
-                    elif protocol == 'udp':
-                        # Send UDP server info to client
-                        send_text(client, f"UDP_INFO:{host}:{file_port}:{filename}")
-                    else:
-                        send_text(client, "Protocol must be 'tcp' or 'udp'")
+def run_command(command, session, target, text, started):
+    try:
+        command.fn(session, target, text)
+    finally:
+        command_seconds.observe(time.perf_counter() - started, command.label)
 
-            else:
-                # Normal broadcast chat
-                line = format_chat(sender_nick, decoded)
-                broadcast(line.encode('utf-8'), sender=client)
+# Handlers: fn(session, target, text); see commands.py for how lines are split
+command_table = commands.CommandTable()
+
+@command_table.command(limit='chat')
+def say(session, target, text):
+    """Normal broadcast chat"""
+    line = format_chat(session.nickname, text)
+    broadcast(line.encode('utf-8'), sender=session, channel='all')
+    log_message('all', line)
+
+@command_table.command('/msg', limit='msg')
+def private_message(session, target, text):
+    sender_nick = session.nickname
+    if not target or not text:
+        send_text(session, "Usage: /msg <nickname> <message>")
+        return
+    target_session = find_user(target)
+    line = f"[Private] {sender_nick}: {text}"
+    if target_session is not None:
+        send_text(target_session, line)
+    elif cluster is None or not cluster.private(target, sender_nick, line):
+        queued = queue_offline(target, line)
+        if queued is None:
+            send_text(session, f"User '{target}' not found")
+        elif not queued:
+            send_text(session, f"User '{target}' is offline and has too many messages waiting")
+        else:
+            log_message(private_channel(sender_nick, target), line)
+            send_text(session, f"[To {target}, offline - queued] {text}")
+        return
+    log_message(private_channel(sender_nick, target), line)
+    # Optional feedback to sender
+    send_text(session, f"[To {target}] {text}")
+
+@command_table.command('/join', limit='join')
+def join_group(session, group, text):
+    if not group:
+        send_text(session, "Usage: /join <group>")
+        return
+    registry.join(session, group)
+    presence.joined(session.nickname, group)
+    if cluster is not None:
+        cluster.group_joined(group, session.nickname)
+    # The other members see it in the group's next presence delta
+    send_text(session, f"Joined group '{group}'")
+
+@command_table.command('/leave', limit='join')
+def leave_group(session, group, text):
+    if not group:
+        send_text(session, "Usage: /leave <group>")
+    elif registry.leave(session, group):
+        presence.left(session.nickname, group)
+        if cluster is not None:
+            cluster.group_left(group, session.nickname)
+        send_text(session, f"Left group '{group}'")
+    else:
+        send_text(session, f"Not a member of group '{group}'")
+
+@command_table.command('/group', limit='group')
+def group_message(session, group, text):
+    if not group or not text:
+        send_text(session, "Usage: /group <group> <message>")
+    elif not registry.in_group(session, group):
+        send_text(session, f"You are not in group '{group}'")
+    else:
+        line = f"[{group}] {session.nickname}: {text}"
+        group_send(group, line, sender=session, channel=f"#{group}")
+        log_message(f"#{group}", line)
+        queue_group_offline(group, line)
+
+@command_table.command('/files', limit='files', blocking=True)
+def list_files(session, target, text):
+    # /files [prefix|glob] [page]; a trailing number is the page
+    args = text.split()
+    page = 1
+    if args and args[-1].isdigit():
+        page = int(args.pop())
+    pattern = args[0] if args else ''
+    send_text(session, file_listing(pattern, page))
+
+@command_table.command('/download', limit='download')
+def request_download(session, target, text):
+    parts = text.split()
+    streams = 1
+    if '-n' in parts[:-1]:
+        # -n <streams>: fetch over several connections at once
+        i = parts.index('-n')
+        streams = int(parts[i + 1]) if parts[i + 1].isdigit() else 0
+        del parts[i:i + 2]
+    if len(parts) < 2:
+        send_text(session, "Usage: /download <filename> <tcp|udp> [offset [length]] [-n streams]")
+        return
+    filename = parts[0]
+    protocol = parts[1].lower()
+    try:
+        offset = int(parts[2]) if len(parts) > 2 else 0
+        length = int(parts[3]) if len(parts) > 3 else 0
+    except ValueError:
+        offset = length = -1
+    if protocol not in ('tcp', 'udp'):
+        send_text(session, "Protocol must be 'tcp' or 'udp'")
+    elif offset < 0 or length < 0:
+        send_text(session, "Offset and length must be non-negative byte counts")
+    elif not 1 <= streams <= MAX_STREAMS:
+        send_text(session, f"Streams must be between 1 and {MAX_STREAMS}")
+    else:
+        threading.Thread(target=offer_download,
+                         args=(session, filename, protocol, offset, length, streams),
+                         daemon=True).start()
+
+@command_table.command('/upload', limit='upload', blocking=True)
+def request_upload(session, target, text):
+    # /upload <filename> <size>; the bytes follow on a data connection
+    parts = text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        send_text(session, "Usage: /upload <filename> <size in bytes>")
+        return
+    filename, size = parts[0], int(parts[1])
+    token, error = reserve_upload(session.nickname, filename, size)
+    if error:
+        send_text(session, f"UPLOAD_ERROR:{error}\n{filename}")
+        return
+    send_text(session, f"UPLOAD_READY:{file_port}:{token}:{size}:{filename}")
+
+@command_table.command('/users', limit='users')
+def list_users(session, target, text):
+    # /users [group]: a roster snapshot to apply presence deltas to
+    group = text.strip().lstrip('#')
+    version = presence.version  # read first: the snapshot is at least this new
+    if group:
+        nicks = {s.nickname for s in registry.members(group)}
+        scope = '#' + group
+    else:
+        nicks = {s.nickname for s in registry.sessions()}
+        scope = ALL
+    if cluster is not None:
+        nicks.update(cluster.remote_users(group or None))
+    session.send(presence_feed.encode_roster(version, scope, nicks))
+
+@command_table.command('/presence')
+def set_presence(session, target, text):
+    # /presence all|off|<group> [group ...]: which presence deltas to get
+    if not text:
+        send_text(session, f"Presence updates: {presence_feed.describe(session.presence)}; "
+                           f"change with /presence <all|off|group [group ...]>")
+        return
+    session.presence = presence_feed.parse_subscription(text)
+    send_text(session, f"Presence updates: {presence_feed.describe(session.presence)}")
+
+@command_table.command('/cache', admin=True)
+def cache_stats(session, target, text):
+    if file_cache is None:
+        send_text(session, "File cache is off")
+        return
+    c = file_cache.stats()
+    send_text(session, f"File cache: {c['entries']} files, {c['bytes']:,} of {c['budget']:,} bytes, "
+                       f"{c['hits']} hits / {c['misses']} misses ({c['hit_rate']:.0%}), "
+                       f"{c['evictions']} evicted, {c['invalidations']} invalidated, "
+                       f"{c['bytes_served']:,} bytes served from memory")
+
+@command_table.command('/history', limit='history', blocking=True)
+def history(session, target, text):
+    send_history(session, text.split())
+
+@command_table.command('/cluster')
+def cluster_info(session, target, text):
+    if cluster is None:
+        send_text(session, "This server is not part of a cluster")
+        return
+    c = cluster.stats()
+    nodes = ', '.join(f"{n} ({count} users)" for n, count in sorted(c['nodes'].items()))
+    send_text(session, f"Node {c['node']} with {len(registry)} local users; "
+                       f"other nodes: {nodes or 'none'}; {c['groups']} groups; "
+                       f"{c['remote_messages']} messages received from other nodes")
+
+@command_table.command('/stats', admin=True)
+def stats(session, target, text):
+    send_text(session, stats_report())
+
+@command_table.command('/queues', admin=True)
+def queues(session, target, text):
+    send_text(session, "Outbound queues (depth / bytes / peak / dropped / frames per write):")
+    for s in registry.sessions():
+        q = s.outq.stats()
+        per_write = q['sent_frames'] / q['writes'] if q['writes'] else 0
+        send_text(session, f"  {s.nickname}: {q['depth']} / {q['bytes']} / "
+                           f"{q['high_water']} / {q['dropped']} / {per_write:.1f}")
+
+def parse_hello(hello):
+    """
+    Split the handshake reply into the nickname and its options: the first
+    line is the nickname, further lines are key=value (e.g. compress=zlib).
+    """
+    nickname, *lines = hello.split('\n')
+    options = dict(line.partition('=')[::2] for line in lines if line)
+    return nickname.strip(), options
+
+def register(conn, hello, address=None):
+    """
+    Create the session for a client that completed the NICK handshake, or
+    give it back the one its resume token names.
+    """
+    nickname, options = parse_hello(hello)
+    resumed = None
+    if resumes is not None and 'resume' in options:
+        token, position = resume.parse_resume(options['resume'])
+        old = resumes.session(token)
+        if old is not None:
+            forget(old)  # its connection is half-open; this client is the same one, back
+        resumed = resumes.claim(token, position)
+        if resumed is not None:
+            nickname = resumed[0].nickname
+    if options.get('protocol') == commands.BINARY:
+        # CMD frames are understood from anyone; this tells the client it may send them
+        conn.sendall(encode_text(f"PROTOCOL:{commands.BINARY}"))
+    compressor = None
+    if compression_mode and options.get('compress') == compression_mode:
+        # Sent before the session has a writer, so it is the last plain frame
+        conn.sendall(encode_text(f"COMPRESS:{compression_mode}"))
+        compressor = compression.StreamCompressor()
+    outq = OutboundQueue(queue_frames, queue_bytes, overflow_policy,
+                         replay_limit=resume_replay if resumes is not None else 0)
+    token = None
+    if resumes is not None:
+        # First in the queue, so the client counts its position from here
+        token = resume.new_token()
+        outq.put(encode_text(f"SESSION:{token}"))
+    session = registry.add(conn, nickname, address, outq)
+    session.token = token
+    session.compressor = compressor
+    if admin_token:
+        session.admin = secrets.compare_digest(options.get('admin', '').encode('utf-8'),
+                                               admin_token.encode('utf-8'))
+    if limits or download_rate:
+        session.limiter = ratelimit.RateLimiter(limits, ratelimit.byte_bucket(download_rate))
+    if heartbeat_interval:
+        session.seen = heartbeats.now
+        session.timer = heartbeats.schedule(session, session.seen + heartbeat_interval)
+    if resumed is not None:
+        parked, frames, missed = resumed
+        session.presence = parked.presence
+        send_text(session, f"RESUMED:{missed}:{nickname}")
+        for frame in frames:
+            session.send(frame)
+    if 'presence' in options:
+        session.presence = presence_feed.parse_subscription(options['presence'])
+    if token is not None:
+        resumes.add(token, session)
+        if resumed is None:
+            resumes.release(nickname)  # logged in afresh: a parked session of its own is stale
+    if cluster is not None:
+        cluster.user_joined(nickname)
+
+    print(f"Username of the client is {nickname}" + (" (resumed)" if resumed is not None else ""))
+    # The others hear of it in the next presence delta; a quick resume cancels out
+    presence.online(nickname)
+    if resumed is not None:
+        welcome_back(session, resumed[0].groups)
+        return session
+    send_text(session, 'Connected to the server!')
+    if offline_store is not None:
+        welcome_back(session)
+    return session
+
+def disconnect(session):
+    """Remove a session from all server state; the next presence delta tells the others."""
+    forget(session)
+
+def forget(session):
+    """
+    Drop a session from all server state (its groups hear of it through
+    presence); False if it was already gone.
+    """
+    if not registry.remove(session):
+        return False
+    if session.timer is not None:
+        heartbeats.cancel(session.timer)
+        session.timer = None
+    session.kick()  # wakes a reader thread still blocked on the socket (a reaped half-open peer)
+    session.close()
+    # Keep the totals once the session no longer counts itself
+    bytes_out.inc(session.outq.sent_bytes)
+    frames_dropped.inc(session.outq.dropped)
+    if session.compressor is not None:
+        compression_saved.inc(session.compressor.raw_bytes - session.compressor.packed_bytes, 'chat')
+    nickname = session.nickname
+    if cluster is not None:
+        cluster.user_left(nickname, session.groups)
+    # Its groups hear of it in the next presence delta, as '#<group>' scopes
+    presence.offline(nickname, session.groups)
+    if offline_store is not None:
+        # Still a member while away: /msg and group messages are queued for it
+        offline_store.went_away(nickname, session.groups)
+    if session.token is not None:
+        resumes.park(session.token, session)
+    return True
 
+def check_heartbeats():
+    """
+    Expire the heartbeat timers that are due: clients that spoke since are
+    simply rescheduled, quiet ones get a PING, and those still silent at
+    idle_timeout are reaped together. Runs once per wheel tick.
+    """
+    now = time.monotonic()
+    dead = []
+    for session in heartbeats.advance(now):
+        if registry.get(session.conn) is not session:
+            continue  # disconnected while its timer was being expired
+        idle = now - session.seen
+        if idle < heartbeat_interval:
+            session.timer = heartbeats.schedule(session, session.seen + heartbeat_interval)
+        elif idle < idle_timeout:
+            session.send(PING_FRAME)
+            pings_sent.inc()
+            session.timer = heartbeats.schedule(session, session.seen + idle_timeout)
+        else:
+            session.timer = None
+            dead.append(session)
+    if dead:
+        reap(dead)
+
+def reap(sessions):
+    """Disconnect dead peers in one batch; they leave in the same presence delta."""
+    gone = []
+    for session in sessions:
+        if forget(session):
+            gone.append(session.nickname)
+    if gone:
+        reaped.inc(len(gone))
+        names = ', '.join(gone[:10]) + (f" and {len(gone) - 10} others" if len(gone) > 10 else '')
+        print(f"Reaped {len(gone)} connection(s) silent for {idle_timeout:g}s: {names}")
+
+def presence_loop():
+    """
+    Send each window's presence changes: one frame per scope, encoded once
+    and queued to the sessions subscribed to it.
+    """
+    while True:
+        version, changes = presence.next_delta()
+        if not changes:
+            continue
+        frames = {scope: presence_feed.encode_delta(version, scope, c) for scope, c in changes.items()}
+        subscribers = {scope: [] for scope in frames}
+        for session in everyone():
+            wants = session.presence
+            if wants == ALL:
+                # Everything: the whole server and the groups it is in
+                if ALL in subscribers:
+                    subscribers[ALL].append(session)
+                for group in session.groups:
+                    if '#' + group in subscribers:
+                        subscribers['#' + group].append(session)
+            elif wants:
+                for group in wants:
+                    if '#' + group in subscribers:
+                        subscribers['#' + group].append(session)
+        for scope, frame in frames.items():
+            fanout(subscribers[scope], frame)
+        presence_deltas.inc()
+
+def remote_presence(change, nick, groups):
+    """Cluster: users on other nodes count for presence like local ones."""
+    if change == 'online':
+        presence.online(nick, groups)
+    elif change == 'offline':
+        presence.offline(nick, groups)
+    else:
+        for group in groups:
+            (presence.joined if change == 'joined' else presence.left)(nick, group)
+
+def heartbeat_loop():
+    """Thread engine: advance the heartbeat wheel once per tick."""
+    while True:
+        time.sleep(heartbeats.tick)
+        try:
+            check_heartbeats()
+        except Exception as e:
+            print(f"Heartbeat error: {e}")
+
+def handle(session, decoder):
+    """Thread engine: serve one client until it disconnects."""
+    while True:
+        try:
+            # Frames already buffered (pipelined after the nickname) come first
+            for kind, payload in decoder.frames():
+                handle_message(session, payload, kind)
+            if decoder.recv_into(session.conn) == 0:
+                raise ConnectionError()
         except:
-            # Disconnect cleanup
-            if client in clients:
-                index = clients.index(client)
-                clients.remove(client)
-                client.close()
-                nickname = nicknames[index]
-                nicknames.remove(nickname)
-                # Remove from all groups
-                for g, members in list(groups.items()):
-                    if client in members:
-                        members.remove(client)
-                        for m in list(members):
-                            send_text(m, f"{nickname} left group '{g}'")
-                        if not members:
-                            groups.pop(g, None)
-                # Broadcast leave message to everyone else
-                broadcast(f"{nickname} left the chat!".encode('utf-8'))
+            disconnect(session)
+            break
+
+def write_loop(session):
+    """Thread engine: drain one session's outbound queue onto its socket."""
+    outq = session.outq
+    while True:
+        batch = outq.get_batch(linger=flush_window)
+        if not batch:
             break
+        if session.compressor is not None:
+            batch = [session.compressor.pack(batch)]
+        try:
+            sent = send_frames(session.conn, batch)
+        except OSError:
+            session.kick()
+            break
+        outq.note_sent(sent)
+
+def read_frame(sock, decoder):
+    """Block until one whole TEXT frame arrives and return it as str."""
+    while True:
+        for kind, payload in decoder.frames():
+            return str(payload, 'utf-8')
+        if decoder.recv_into(sock) == 0:
+            raise ConnectionError("connection closed")
+
+def serve_client(client, address):
+    """Thread engine: the NICK handshake, then serve the client until it disconnects."""
+    decoder = FrameDecoder()
+    try:
+        client.settimeout(handshake_timeout or None)
+        client.sendall(encode_text('NICK'))
+        hello = read_frame(client, decoder)
+        client.settimeout(None)
+    except Exception as e:
+        print(f"Handshake with {str(address)} failed: {e}")
+        client.close()
+        return
+    session = register(client, hello, address)
+
+    writer = threading.Thread(target=write_loop, args=(session,), daemon=True)
+    writer.start()
+    handle(session, decoder)
 
-def receive():
+def receive(server):
+    """
+    Thread engine: accept clients and start one handler thread each. The
+    handshake runs on that thread, so a slow client never holds up accept.
+    """
     while True:
         client, address = server.accept()
         print(f"Connected with {str(address)}")
+        thread = threading.Thread(target=serve_client, args=(client, address))
+        thread.start()
 
-        client.send('NICK'.encode('utf-8'))
-        nickname = client.recv(1024).decode('utf-8')
-        nicknames.append(nickname)
-        clients.append(client)
+def node_dir(directory):
+    """
+    directory, or in a cluster this node's own subdirectory of it: nodes
+    started from one working directory must not write the same files.
+    """
+    if not directory or not bus_url:
+        return directory
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', node_id))
 
-        print(f"Username of the client is {nickname}")
-        # Broadcast join message to everyone except the new client
-        broadcast(f"{nickname} joined the chat!".encode('utf-8'), sender=client)
-        client.send('Connected to the server!'.encode('utf-8'))
+def main():
+    global port, file_port, engine, queue_frames, queue_bytes, overflow_policy, flush_window
+    global udp_transfers, file_cache_bytes, file_cache
+    global log_dir, log_max_bytes, log_retention_days, message_log
+    global bus_url, node_id, cluster, reuse_port, metrics_port, admin_token
+    global rate_limits, limits, flood_strikes, download_rate, heartbeat_interval, idle_timeout
+    global upload_quota, upload_dir
+    global offline_dir, offline_memory, offline_max_bytes, offline_rate, offline_store, offline_away_days
+    global presence_window, resume_ttl, resume_replay, resumes, handshake_timeout
+    parser = argparse.ArgumentParser(description="Chat server with file sharing")
+    parser.add_argument('port', nargs='?', type=int, default=port,
+                        help="TCP chat port (file transfer port is port + 1)")
+    parser.add_argument('--file-port', type=int, default=0,
+                        help="UDP/TCP file transfer port (default port + 1)")
+    parser.add_argument('--engine', choices=['thread', 'async'], default=engine,
+                        help="thread-per-client or asyncio event loop")
+    parser.add_argument('--queue-frames', type=int, default=queue_frames,
+                        help="max chat frames queued per client")
+    parser.add_argument('--queue-bytes', type=int, default=queue_bytes,
+                        help="max bytes queued per client")
+    parser.add_argument('--overflow', choices=POLICIES, default=overflow_policy,
+                        help="what to do when a client's queue is full")
+    parser.add_argument('--flush-window', type=float, default=flush_window * 1000,
+                        help="milliseconds writers wait to coalesce frames (0 = none)")
+    parser.add_argument('--udp-transfers', type=int, default=udp_transfers,
+                        help="UDP downloads served concurrently")
+    parser.add_argument('--file-cache', type=int, default=file_cache_bytes // (1024 * 1024),
+                        help="MB of hot shared files kept in memory (0 = off)")
+    parser.add_argument('--log-dir', default=log_dir,
+                        help="directory for the persistent message log ('' = no history)")
+    parser.add_argument('--log-max-mb', type=int, default=log_max_bytes // (1024 * 1024),
+                        help="disk budget of the message log in MB")
+    parser.add_argument('--log-retention-days', type=float, default=log_retention_days,
+                        help="messages older than this are dropped from the log")
+    parser.add_argument('--offline-dir', default=offline_dir,
+                        help="directory for messages kept for offline users ('' = no offline delivery)")
+    parser.add_argument('--offline-memory', type=int, default=offline_memory // (1024 * 1024),
+                        help="MB of offline messages kept in memory before they spill to disk")
+    parser.add_argument('--offline-away-days', type=float, default=offline_away_days,
+                        help="days an offline user keeps group membership and queued messages")
+    parser.add_argument('--offline-max-mb', type=int, default=offline_max_bytes // (1024 * 1024),
+                        help="MB of messages kept for any one offline user")
+    parser.add_argument('--offline-rate', type=float, default=offline_rate / (1024 * 1024),
+                        help="MB/s of queued messages delivered to returning users, in total (0 = unpaced)")
+    parser.add_argument('--bus', default=bus_url,
+                        help="join a cluster over this bus: 'tcp://host:port' (see bus.py) or 'local'")
+    parser.add_argument('--node-id', default=node_id,
+                        help="this node's name in the cluster (default host:file port)")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="share the chat port with other nodes via SO_REUSEPORT")
+    parser.add_argument('--metrics-port', type=int, default=metrics_port,
+                        help="serve Prometheus metrics over HTTP on this port (0 = off)")
+    parser.add_argument('--admin-token', default=admin_token,
+                        help="clients sending admin=<token> may use /stats, /queues and /cache "
+                             "('' = nobody; prefer SERVER_ADMIN_TOKEN, arguments show in ps)")
+    parser.add_argument('--rate-limits', default=rate_limits,
+                        help="per-client token buckets, class=rate/burst,... ('' = off); classes: "
+                             + ', '.join(ratelimit.CLASSES))
+    parser.add_argument('--flood-strikes', type=int, default=flood_strikes,
+                        help="disconnect a client after this many refused frames in a row (0 = never)")
+    parser.add_argument('--download-rate', type=float, default=download_rate / (1024 * 1024),
+                        help="MB/s each client may download over TCP, and each UDP transfer (0 = unlimited)")
+    parser.add_argument('--upload-quota', type=int, default=upload_quota // (1024 * 1024),
+                        help="MB each user may upload per server run (0 = uploads off)")
+    parser.add_argument('--presence-window', type=float, default=presence_window * 1000,
+                        help="milliseconds joins and leaves are collected into one presence delta")
+    parser.add_argument('--resume-ttl', type=float, default=resume_ttl,
+                        help="seconds a disconnected session can be resumed with its token (0 = off)")
+    parser.add_argument('--resume-replay', type=float, default=resume_replay / (1024 * 1024),
+                        help="MB of sent frames kept per client to replay on resume")
+    parser.add_argument('--handshake-timeout', type=float, default=handshake_timeout,
+                        help="seconds a new connection has to send its nickname (0 = no limit)")
+    parser.add_argument('--heartbeat', type=float, default=heartbeat_interval,
+                        help="seconds of client silence before the server pings it (0 = no heartbeats)")
+    parser.add_argument('--idle-timeout', type=float, default=idle_timeout,
+                        help="seconds of silence, pings unanswered, before a client is dropped")
+    args = parser.parse_args()
+    heartbeat_interval = args.heartbeat
+    presence_window = presence.window = args.presence_window / 1000
+    idle_timeout = max(args.idle_timeout, heartbeat_interval)
+    resume_ttl = args.resume_ttl
+    resume_replay = int(args.resume_replay * 1024 * 1024)
+    handshake_timeout = args.handshake_timeout
+    try:
+        limits = ratelimit.parse_limits(args.rate_limits)
+    except ValueError as e:
+        parser.error(str(e))
+    rate_limits = args.rate_limits
+    flood_strikes = args.flood_strikes or float('inf')
+    download_rate = args.download_rate * 1024 * 1024
+    upload_quota = args.upload_quota * 1024 * 1024
+    port = args.port
+    file_port = args.file_port or port + 1
+    engine = args.engine
+    queue_frames = args.queue_frames
+    queue_bytes = args.queue_bytes
+    # Parked sessions collect up to one outbound queue's worth while away
+    resumes = ResumeTable(resume_ttl, queue_bytes) if resume_ttl else None
+    overflow_policy = args.overflow
+    flush_window = args.flush_window / 1000
+    udp_transfers = args.udp_transfers
+    file_cache_bytes = args.file_cache * 1024 * 1024
+    file_cache = FileCache(file_cache_bytes) if file_cache_bytes else None
+    bus_url = args.bus
+    if bus_url:
+        node_id = args.node_id or f"{socket.gethostname()}:{file_port}"
+    log_dir = node_dir(args.log_dir)
+    log_max_bytes = args.log_max_mb * 1024 * 1024
+    log_retention_days = args.log_retention_days
+    if log_dir:
+        message_log = MessageLog(log_dir, max_bytes=log_max_bytes,
+                                 retention=log_retention_days * 24 * 3600)
+        print(f"Message log: {log_dir} (next message #{message_log.next_offset})")
+    offline_dir = node_dir(args.offline_dir)
+    offline_memory = args.offline_memory * 1024 * 1024
+    offline_max_bytes = args.offline_max_mb * 1024 * 1024
+    offline_rate = args.offline_rate * 1024 * 1024
+    if offline_dir:
+        offline_away_days = args.offline_away_days
+        offline_store = OfflineStore(offline_dir, offline_memory, offline_max_bytes,
+                                     offline_away_days * 86400)
+        threading.Thread(target=forward_loop, daemon=True).start()
+        print(f"Offline messages: {offline_dir} ({len(offline_store)} users with messages waiting)")
+    threading.Thread(target=presence_loop, daemon=True).start()
+    reuse_port = args.reuse_port
+    metrics_port = args.metrics_port
+    admin_token = args.admin_token
+    if metrics_port:
+        metrics.serve_http(host, metrics_port)
+        print(f"Metrics on http://{host}:{metrics_port}/metrics")
+    if bus_url:
+        cluster = Cluster(bus.connect(bus_url), node_id, deliver_remote_broadcast,
+                          deliver_remote_group, deliver_remote_private, remote_presence)
+        print(f"Cluster node {node_id} on bus {bus_url}")
 
-        thread = threading.Thread(target=handle, args=(client,))
-        thread.start()
+    # Create shared directory if it doesn't exist
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir)
+        print(f"Created shared files directory: {shared_dir}")
+    # Uploads in progress. Cluster nodes may share the directory, so only files
+    # nobody has written to for UPLOAD_STALE seconds are left over from a restart
+    upload_dir = os.path.join(shared_dir, UPLOAD_STAGING)
+    os.makedirs(upload_dir, exist_ok=True)
+    for name in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) > UPLOAD_STALE:
+                os.remove(path)
+        except OSError:
+            pass
+
+    # Start UDP file transfer handler in background
+    udp_thread = threading.Thread(target=handle_udp_file_transfer, daemon=True)
+    udp_thread.start()
 
-# Start UDP file transfer handler in background
-udp_thread = threading.Thread(target=handle_udp_file_transfer, daemon=True)
-udp_thread.start()
+    # TCP download and upload connections share the file transfer port number
+    data_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    data_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    data_server.bind((host, file_port))
+    data_server.listen()
+    threading.Thread(target=serve_transfers, args=(data_server,), daemon=True).start()
+
+    try:
+        if engine == 'async':
+            import async_server
+            print(f"Server started on {host}:{port} (asyncio engine)")
+            print(f"File transfer port (UDP/TCP): {file_port}")
+            print(f"Shared files directory: {shared_dir}")
+            print("Server is listening...")
+            async_server.run(host, port, register, handle_message, disconnect, flush_window,
+                             reuse_port, on_tick=check_heartbeats if heartbeat_interval else None,
+                             tick=heartbeats.tick, handshake_timeout=handshake_timeout)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server.bind((host, port))
+            server.listen()
+            print(f"Server started on {host}:{port}")
+            print(f"File transfer port (UDP/TCP): {file_port}")
+            print(f"Shared files directory: {shared_dir}")
+            print("Server is listening...")
+            if heartbeat_interval:
+                threading.Thread(target=heartbeat_loop, daemon=True).start()
+            receive(server)
+    finally:
+        if cluster is not None:
+            # Let the other nodes drop our users right away
+            cluster.close()
+        if offline_store is not None:
+            offline_store.close()  # finish its queued writes
 
-print("Server is listening...")
-receive()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Session registry: O(1) lookups of connected users by socket and nickname,
+plus group membership in both directions (group -> sessions and
+session -> groups) so command paths and disconnect never scan lists.
+"""
+import socket
+import threading
+
+from outbound import OutboundQueue
+
+
+class Session:
+    """One registered connection."""
+    __slots__ = ('conn', 'nickname', 'address', 'groups', 'outq', 'compressor', 'limiter',
+                 'seen', 'timer', 'presence', 'token', 'admin')
+
+    def __init__(self, conn, nickname, address=None, outq=None):
+        self.conn = conn
+        self.nickname = nickname
+        self.address = address
+        self.groups = set()
+        self.outq = outq if outq is not None else OutboundQueue()
+        self.compressor = None  # StreamCompressor once the client negotiated compression
+        self.limiter = None     # ratelimit.RateLimiter when rate limits are on
+        self.seen = 0.0         # when the client last sent anything (heartbeat clock)
+        self.timer = None       # its heartbeat timer, if heartbeats are on
+        self.presence = '*'     # presence deltas it wants: '*' (all), a set of groups, or None
+        self.token = None       # its resume token, if resuming is on
+        self.admin = False      # logged in with the server's admin token
+
+    def send(self, frame):
+        """Queue a frame for this session's writer; never blocks the caller."""
+        if not self.outq.put(frame):
+            # Queue closed or overflowed under the 'disconnect' policy
+            self.kick()
+
+    def kick(self):
+        """Tear the connection down so its reader runs the disconnect path."""
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.outq.close()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f"<Session {self.nickname} {self.address}>"
+
+
+class SessionRegistry:
+    """Connected sessions indexed by connection object and by nickname."""
+
+    def __init__(self):
+        self.by_conn = {}
+        self.by_nick = {}
+        self.groups = {}  # group name -> set of Session
+        self.lock = threading.Lock()  # guards mutations from handler threads
+
+    def __len__(self):
+        return len(self.by_conn)
+
+    def sessions(self):
+        """Snapshot of all sessions, safe to iterate while others connect."""
+        return list(self.by_conn.values())
+
+    def add(self, conn, nickname, address=None, outq=None):
+        session = Session(conn, nickname, address, outq)
+        with self.lock:
+            self.by_conn[conn] = session
+            self.by_nick[nickname] = session
+        return session
+
+    def get(self, conn):
+        return self.by_conn.get(conn)
+
+    def find(self, nickname):
+        return self.by_nick.get(nickname)
+
+    def remove(self, session):
+        """
+        Drop a session from every index. Its groups set is left intact so the
+        caller can still notify the groups it was in.
+        """
+        with self.lock:
+            if self.by_conn.pop(session.conn, None) is None:
+                return False
+            if self.by_nick.get(session.nickname) is session:
+                del self.by_nick[session.nickname]
+            for group in session.groups:
+                members = self.groups.get(group)
+                if members is not None:
+                    members.discard(session)
+                    if not members:
+                        # Clean up empty group
+                        self.groups.pop(group, None)
+        return True
+
+    def members(self, group):
+        """Snapshot of a group's members (empty list if the group is unknown)."""
+        members = self.groups.get(group)
+        return list(members) if members else []
+
+    def join(self, session, group):
+        with self.lock:
+            self.groups.setdefault(group, set()).add(session)
+            session.groups.add(group)
+
+    def leave(self, session, group):
+        """Remove session from group; returns False if it was not a member."""
+        with self.lock:
+            members = self.groups.get(group)
+            if not members or session not in members:
+                return False
+            members.discard(session)
+            session.groups.discard(group)
+            if not members:
+                # Clean up empty group
+                self.groups.pop(group, None)
+        return True
+
+    def in_group(self, session, group):
+        return group in session.groups
@@ -0,0 +1,95 @@
+"""
+Hierarchical timing wheel: many timers, O(1) to add, cancel and expire.
+
+Time advances in ticks. Level 0 has a slot per tick for the next SLOTS
+ticks; each level above has slots SLOTS times wider. A timer sits in the
+lowest level whose span reaches its deadline, and when a lower level wraps
+around the next slot of the level above is emptied into it (cascaded).
+Advancing by one tick touches one slot per level that wrapped and the
+timers actually due, never the rest, so 50k sleeping timers cost nothing
+until they are due.
+
+Not a scheduler: the owner calls advance() from its own loop (a thread or
+the event loop) and decides what expiring means.
+"""
+import threading
+import time
+
+SLOTS = 64
+LEVELS = 4  # 64**4 ticks: over six months at one-second ticks
+
+
+class Timer:
+    __slots__ = ('item', 'tick', 'slot')
+
+    def __init__(self, item, tick):
+        self.item = item
+        self.tick = tick
+        self.slot = None
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.levels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.start = time.monotonic()
+        self.now = self.start  # time of the last advance(), a cheap coarse clock
+        self.current = 0       # ticks advanced so far
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, item, when):
+        """Have advance() return item once monotonic time `when` has passed."""
+        ticks = -(-(when - self.start) // self.tick)  # round up: never early
+        with self.lock:
+            timer = Timer(item, max(int(ticks), self.current + 1))
+            self._place(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.count -= 1
+
+    def _place(self, timer):
+        delta = timer.tick - self.current
+        for level in range(LEVELS):
+            if delta < SLOTS ** (level + 1) or level == LEVELS - 1:
+                # Past the top level's reach it waits in the farthest slot and is placed again later
+                tick = min(timer.tick, self.current + SLOTS ** LEVELS - 1)
+                slot = self.levels[level][(tick // SLOTS ** level) % SLOTS]
+                slot.add(timer)
+                timer.slot = slot
+                return
+
+    def advance(self, now=None):
+        """Move time forward to now; returns the items whose timers expired."""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.start) // self.tick)
+        expired = []
+        with self.lock:
+            self.now = now
+            while self.current < target:
+                self.current += 1
+                # Cascade every level whose lower neighbour just wrapped around
+                for level in range(1, LEVELS):
+                    if self.current % SLOTS ** level:
+                        break
+                    slot = self.levels[level][(self.current // SLOTS ** level) % SLOTS]
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        self._place(timer)
+                slot = self.levels[0][self.current % SLOTS]
+                for timer in slot:
+                    timer.slot = None
+                    expired.append(timer.item)
+                self.count -= len(slot)
+                slot.clear()
+        return expired